@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+
+def load_batch_config(config_path):
+    '''
+    Reads a batch configuration file and fills in the per-visit defaults.
+
+    The file is JSON with the keys "visits" (list of visit dicts), and optionally "max_workers",
+    "memory_per_worker_GB", "retries", "output_dir", and "defaults" (dict merged into every visit).
+    Each visit needs a "name" and a "data_dir", and may give "programID", "target_name",
+    "visit_number", "download_dir", "download", "collect", "precision", and "stages", a list of
+    [stage_1 function name, kwargs] pairs run in order.
+
+    :param config_path: str. Path to the JSON configuration file.
+    :return: dict of the configuration with defaults applied to each visit.
+    '''
+    with open(config_path) as f:
+        config = json.load(f)
+
+    config.setdefault('max_workers', os.cpu_count())
+    config.setdefault('memory_per_worker_GB', None)
+    config.setdefault('retries', 1)
+    config.setdefault('output_dir', os.path.dirname(os.path.abspath(config_path)))
+
+    defaults = dict(download=False, collect=False, precision='float32', stages=[])
+    defaults.update(config.get('defaults', {}))
+    config['visits'] = [dict(defaults, **visit) for visit in config['visits']]
+    names = [visit['name'] for visit in config['visits']]
+    if len(set(names)) != len(names):
+        raise ValueError("Visit names in {} must be unique.".format(config_path))
+    return config
+
+
+def reduce_visit(visit, output_dir):
+    '''
+    Runs the stage_0 to stage_1 chain for a single visit and saves the cleaned obs.
+
+    :param visit: dict. One visit entry of the batch configuration.
+    :param output_dir: str. Directory the cleaned obs is saved to, as <name>_obs.nc.
+    :return: dict with the visit name, number of frames, output path, and stage timings.
+    '''
+    from exotic_uvis import stage_0, stage_1
+
+    timings = {}
+    start = time.time()
+
+    # Stage 0: download and sort the files, if asked for.
+    if visit['download']:
+        stage_0.get_files_from_mast(visit['programID'], visit['target_name'], visit['visit_number'],
+                                    visit['download_dir'], extensions=visit.get('extensions'))
+        timings['download'] = time.time() - start
+    if visit['collect']:
+        t = time.time()
+        stage_0.collect_and_move_files(visit['visit_number'], visit.get('download_dir', visit['data_dir']),
+                                       visit['data_dir'])
+        timings['collect'] = time.time() - t
+
+    # Stage 1: load and clean.
+    t = time.time()
+    obs = stage_1.read_data(visit['data_dir'], verbose=0, precision=visit['precision'])
+    timings['read_data'] = time.time() - t
+    for name, kwargs in visit['stages']:
+        t = time.time()
+        getattr(stage_1, name)(obs, **kwargs)
+        timings[name] = time.time() - t
+
+    output = os.path.join(output_dir, '{}_obs.nc'.format(visit['name']))
+    stage_1.save_obs(obs, output)
+    return dict(name=visit['name'], n_frames=int(obs.images.shape[0]), output=output,
+                seconds=time.time() - start, timings=timings)
+
+
+def _limit_worker_memory(memory_bytes):
+    '''
+    Caps the address space of a worker process so that a runaway visit raises MemoryError
+    instead of taking down the node.
+
+    :param memory_bytes: int or None. Memory budget of the worker in bytes.
+    :return: None.
+    '''
+    if memory_bytes is None:
+        return
+    try:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    except (ImportError, ValueError, OSError):
+        print("Could not set a memory limit on this platform, running without one.")
+
+
+def _run_visit(visit, output_dir):
+    '''
+    Worker entry point. Catches the errors of the visit so one failing visit never affects the others.
+    KeyboardInterrupt and SystemExit are left to stop the batch.
+
+    :param visit: dict. One visit entry of the batch configuration.
+    :param output_dir: str. Directory the cleaned obs is saved to.
+    :return: dict with the result, or the error and traceback if the visit failed.
+    '''
+    try:
+        return dict(reduce_visit(visit, output_dir), ok=True)
+    except Exception as e:
+        return dict(name=visit['name'], ok=False, error=repr(e), traceback=traceback.format_exc())
+
+
+def _run_round(names, visits, output_dir, max_workers, memory_bytes):
+    '''
+    Runs a group of visits on a fresh process pool. A worker killed from outside breaks the whole
+    pool, so a pool is never reused after a round.
+
+    :param names: lst of str. Names of the visits to run.
+    :param visits: dict. Visit entries of the batch configuration, keyed by name.
+    :param output_dir: str. Directory the cleaned obs are saved to.
+    :param max_workers: int. Largest number of worker processes.
+    :param memory_bytes: int or None. Memory budget of each worker in bytes.
+    :return: generator of (name, result) pairs as the visits finish. Visits lost to a broken pool have broken=True in their result.
+    '''
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(names)), initializer=_limit_worker_memory,
+                             initargs=(memory_bytes,)) as executor:
+        futures = {executor.submit(_run_visit, visits[name], output_dir): name for name in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                result = dict(name=name, ok=False, error=repr(e), traceback='', broken=True)
+            yield name, result
+
+
+def run_batch(config_path):
+    '''
+    Schedules every visit of a batch configuration across a local process pool, retrying failed
+    visits and reporting throughput.
+
+    :param config_path: str. Path to the JSON configuration file, see load_batch_config.
+    :return: dict summary with per-visit results, failures, and throughput.
+    '''
+    config = load_batch_config(config_path)
+    output_dir = config['output_dir']
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    memory_bytes = None
+    if config['memory_per_worker_GB']:
+        memory_bytes = int(config['memory_per_worker_GB']*1024**3)
+
+    visits = {visit['name']: visit for visit in config['visits']}
+    attempts = {name: 0 for name in visits}
+    results, failures = {}, {}
+    pending = list(visits)
+    start = time.time()
+    print("Scheduling {} visits on {} workers...".format(len(pending), config['max_workers']))
+
+    # Visits caught in a pool broken by another worker are rerun on their own, so that a crash is only
+    # counted against the visit that caused it.
+    suspects = []
+    while pending or suspects:
+        groups = ([pending] if pending else []) + [[name] for name in suspects]
+        pending, suspects = [], []
+        for group in groups:
+            for name, result in _run_round(group, visits, output_dir, config['max_workers'], memory_bytes):
+                broken = result.pop('broken', False)
+                if broken and len(group) > 1:
+                    print("Visit {} was interrupted by a crashed worker, rerunning it on its own...".format(name))
+                    suspects.append(name)
+                    continue
+
+                attempts[name] += 1
+                if result['ok']:
+                    results[name] = result
+                    failures.pop(name, None)
+                    print("Visit {} done: {} frames in {:.1f} s.".format(name, result['n_frames'], result['seconds']))
+                elif attempts[name] <= config['retries']:
+                    print("Visit {} failed ({}), retrying...".format(name, result['error']))
+                    (suspects if broken else pending).append(name)
+                else:
+                    failures[name] = result
+                    print("Visit {} failed after {} attempts: {}".format(name, attempts[name], result['error']))
+
+    wall = time.time() - start
+    n_frames = sum(r['n_frames'] for r in results.values())
+    summary = dict(
+        succeeded=sorted(results), failed=sorted(failures), attempts=attempts,
+        wall_seconds=wall, frames=n_frames, frames_per_second=n_frames/wall if wall > 0 else 0.,
+        visit_seconds=sum(r['seconds'] for r in results.values()),
+        results=results, failures=failures,
+    )
+    with open(os.path.join(output_dir, 'batch_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+
+    print("Batch complete: {} of {} visits succeeded in {:.1f} s.".format(len(results), len(visits), wall))
+    print("Throughput: {:.2f} frames/s, speedup over sequential {:.2f}x.".format(
+        summary['frames_per_second'], summary['visit_seconds']/wall if wall > 0 else 0.))
+    for name, failure in sorted(failures.items()):
+        print("  {} failed: {}".format(name, failure['error']))
+    return summary
+
+
+if __name__ == '__main__':
+    run_batch(sys.argv[1])
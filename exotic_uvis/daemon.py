@@ -0,0 +1,399 @@
+import io
+import os
+import sys
+import time
+import pickle
+import traceback
+import contextlib
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+import numpy as np
+
+# The daemon only listens on this machine. Requests are pickled, so anyone holding the key can run code
+# in the daemon: each serve makes a random key and keeps it in a file only its user can read.
+DEFAULT_ADDRESS = ('localhost', 6070)
+KEY_DIR = os.path.join(os.path.expanduser('~'), '.exotic_uvis')
+
+# The stage_1 functions clients may run. They change obs in memory and do not write files.
+DAEMON_STAGES = (
+    'dq_premask',
+    'apply_badpix_cache',
+    'laplacian_edge_detection',
+    'fixed_iteration_rejection',
+    'free_iteration_rejection',
+    'Pagul_bckg_subtraction',
+    'full_frame_bckg_subtraction',
+    'corner_bkg_subtraction',
+    'surface_bckg_subtraction',
+    'track0th',
+    'track_bkgstars',
+    'align_frames',
+    'set_precision',
+)
+
+# Shared memory blocks attached by this process, kept open while their arrays are in use.
+_attached = {}
+
+
+def key_path(address=DEFAULT_ADDRESS):
+    '''
+    Path of the file holding the key of the daemon listening on address.
+
+    :param address: tuple or str. (host, port) or socket path the daemon listens on.
+    :return: str path of the key file.
+    '''
+    if isinstance(address, str):
+        return address + '.key'
+    return os.path.join(KEY_DIR, 'daemon_{}_{}.key'.format(*address))
+
+
+def _write_key(path, authkey):
+    '''
+    Writes the key of the daemon to a file only the current user can read or write.
+
+    :param path: str. Path of the key file.
+    :param authkey: bytes. The key.
+    :return: str path of the key file.
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory, mode=0o700)
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        # An older file keeps its mode when reopened, so set it again.
+        os.fchmod(f.fileno(), 0o600)
+        f.write(authkey)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_key(address=DEFAULT_ADDRESS):
+    '''
+    Reads the key of the daemon listening on address, written by serve.
+
+    :param address: tuple or str. Address the daemon listens on.
+    :return: bytes key.
+    '''
+    with open(key_path(address), 'rb') as f:
+        return f.read()
+
+
+def _share(obs):
+    '''
+    Moves the images of obs into a new shared memory block, so that clients on the same machine can
+    read them without the frames being sent over the socket.
+
+    :param obs: xarray. Its images are replaced by a copy backed by the shared memory block.
+    :return: the shared memory block.
+    '''
+    images = obs.images.values
+    block = shared_memory.SharedMemory(create=True, size=max(images.nbytes, 1))
+    shared = np.ndarray(images.shape, dtype=images.dtype, buffer=block.buf)
+    shared[...] = images
+    obs['images'] = obs.images.copy(data=shared)
+    return block
+
+
+def _release(block):
+    '''
+    Frees a shared memory block of the daemon. Clients that still have it attached keep their copy
+    of the mapping until they let go of it.
+
+    :param block: SharedMemory. Block made by _share.
+    :return: None.
+    '''
+    try:
+        block.close()
+    except BufferError:
+        # An array still points into the block, the mapping goes with it.
+        pass
+    block.unlink()
+
+
+def _picklable(value):
+    '''
+    Makes a value returned by a stage safe to send back to the client.
+
+    :param value: anything.
+    :return: value if it can be pickled, otherwise its repr.
+    '''
+    try:
+        pickle.dumps(value)
+        return value
+    except Exception:
+        return repr(value)
+
+
+def _handle(message, checkpoints, blocks, output_dir):
+    '''
+    Carries out one request sent to the daemon.
+
+    :param message: dict. The request, with its 'command' and arguments, see the client functions below.
+    :param checkpoints: dict. obs Datasets held by the daemon, keyed by checkpoint name.
+    :param blocks: dict. Shared memory block of the images of each checkpoint.
+    :param output_dir: str. Real path of the directory checkpoints may be saved in.
+    :return: dict reply.
+    '''
+    from exotic_uvis import stage_1
+
+    command = message['command']
+    if command == 'checkpoints':
+        return dict(checkpoints={name: dict(shape=obs.images.shape, variables=list(obs.data_vars))
+                                 for name, obs in checkpoints.items()})
+
+    if command == 'run':
+        if message['stage'] not in DAEMON_STAGES:
+            raise ValueError("The daemon only runs the stages in DAEMON_STAGES, not {}.".format(message['stage']))
+        # Stages change obs in place, so each run starts from a copy of its checkpoint.
+        obs = checkpoints[message['from_checkpoint']].copy(deep=True)
+        save_as = message['save_as'] or message['stage']
+        log = io.StringIO()
+        t = time.time()
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(io.StringIO()):
+            returned = getattr(stage_1, message['stage'])(obs, **message['kwargs'])
+        seconds = time.time() - t
+
+        if not isinstance(returned, tuple):
+            returned = (returned,)
+        if returned and type(returned[0]) is type(obs):
+            obs, returned = returned[0], returned[1:]
+        old = blocks.pop(save_as, None)
+        blocks[save_as] = _share(obs)
+        checkpoints[save_as] = obs
+        if old is not None:
+            _release(old)
+        return dict(checkpoint=save_as, seconds=seconds, log=log.getvalue(),
+                    returned=[_picklable(value) for value in returned])
+
+    if command == 'images':
+        images = checkpoints[message['checkpoint']].images
+        return dict(block=blocks[message['checkpoint']].name, shape=images.shape, dtype=images.dtype.str)
+
+    if command == 'variable':
+        values = checkpoints[message['checkpoint']][message['variable']].values
+        if message['frames'] is not None:
+            values = values[message['frames']]
+        return dict(values=np.array(values))
+
+    if command == 'save':
+        path = os.path.realpath(os.path.join(output_dir, message['path']))
+        if os.path.commonpath([path, output_dir]) != output_dir:
+            raise PermissionError("The daemon only saves inside {}, not to {}.".format(output_dir, message['path']))
+        stage_1.save_obs(checkpoints[message['checkpoint']], path)
+        return dict(path=path)
+
+    if command == 'drop':
+        if message['checkpoint'] == 'loaded':
+            raise ValueError("The loaded checkpoint cannot be dropped.")
+        del checkpoints[message['checkpoint']]
+        _release(blocks.pop(message['checkpoint']))
+        return dict()
+
+    raise ValueError("Unknown daemon command {}.".format(command))
+
+
+def serve(source, address=DEFAULT_ADDRESS, output_dir=None, precision='float32', diagnostics_dir=None):
+    '''
+    Loads a visit once and keeps it in memory, running stage_1 stages on it for clients until told to
+    shut down. Every stage run is kept as a named checkpoint, with its images in shared memory, so that
+    tuning the parameters of one stage only reruns that stage from the checkpoint before it.
+
+    :param source: str or xarray. Directory of the visit's FITS files, read with read_data, or the path to an obs saved by save_obs, or an obs Dataset.
+    :param address: tuple or str. (host, port) or socket path the daemon listens on. A new random key for it is written to key_path(address), readable only by the current user, and removed at shut down.
+    :param output_dir: str or None. Directory clients may save checkpoints in. If None, the current working directory.
+    :param precision: str. Working precision of read_data. Only used if source is a directory.
+    :param diagnostics_dir: str or None. Directory the plots of stages run with plot=True or check_all=True are written to, see plotting.start_diagnostics. If None, the diagnostics folder of output_dir.
+    :return: None.
+    '''
+    # The daemon has no display, and a stage showing a plot must not block it, so plots go to files.
+    import matplotlib
+    matplotlib.use('Agg')
+    from exotic_uvis import stage_1
+    from exotic_uvis.plotting import start_diagnostics, stop_diagnostics
+
+    if isinstance(source, str) and source.endswith('.nc'):
+        obs = stage_1.load_obs(source)
+    elif isinstance(source, str):
+        obs = stage_1.read_data(source, verbose=0, precision=precision)
+    else:
+        obs = source.copy(deep=True)
+
+    output_dir = os.path.realpath(output_dir or os.getcwd())
+    # Start the plot renderer before listening, so that it does not inherit the socket.
+    start_diagnostics(diagnostics_dir or os.path.join(output_dir, 'diagnostics'))
+    authkey = os.urandom(32)
+    key_file = _write_key(key_path(address), authkey)
+    checkpoints = dict(loaded=obs)
+    blocks = dict(loaded=_share(obs))
+    try:
+        with Listener(address, authkey=authkey) as listener:
+            print("Holding {} frames of {} x {} pixels, listening on {}.".format(*obs.images.shape, listener.address))
+            running = True
+            while running:
+                try:
+                    connection = listener.accept()
+                except (AuthenticationError, EOFError, ConnectionError):
+                    # A client without the key, or one that hung up during the handshake.
+                    continue
+                with connection:
+                    while True:
+                        try:
+                            message = connection.recv()
+                        except EOFError:
+                            break
+                        if message['command'] == 'shutdown':
+                            connection.send(dict(ok=True))
+                            running = False
+                            break
+                        try:
+                            reply = dict(_handle(message, checkpoints, blocks, output_dir), ok=True)
+                        except Exception as e:
+                            reply = dict(ok=False, error=repr(e), traceback=traceback.format_exc())
+                        connection.send(reply)
+    finally:
+        os.remove(key_file)
+        stop_diagnostics()
+        checkpoints.clear()
+        for block in blocks.values():
+            _release(block)
+    print("Daemon shut down.")
+
+
+def request(message, address=DEFAULT_ADDRESS, authkey=None, timeout=30):
+    '''
+    Sends one request to a running daemon and waits for its reply.
+
+    :param message: dict. The request, with its 'command' and arguments.
+    :param address: tuple or str. Address the daemon listens on.
+    :param authkey: bytes or None. Key of the daemon. If None, read it from key_path(address).
+    :param timeout: float. Seconds to keep trying to connect, e.g. while the daemon is still loading.
+    :return: dict reply.
+    '''
+    start = time.time()
+    while True:
+        try:
+            # Read the key on every try, as the daemon only writes it once it has loaded the visit.
+            connection = Client(address, authkey=authkey if authkey is not None else read_key(address))
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.time() - start > timeout:
+                raise
+            time.sleep(0.2)
+    with connection:
+        connection.send(message)
+        reply = connection.recv()
+    if not reply['ok']:
+        raise RuntimeError("The daemon failed on {}: {}\n{}".format(message['command'], reply['error'], reply['traceback']))
+    return reply
+
+
+def run_stage(stage, kwargs=None, from_checkpoint='loaded', save_as=None, address=DEFAULT_ADDRESS, authkey=None):
+    '''
+    Runs a stage_1 stage in the daemon, on a copy of one of its checkpoints.
+
+    :param stage: str. Name of the stage_1 function, as in the batch configuration. Only the stages in DAEMON_STAGES can be run.
+    :param kwargs: dict or None. Keyword arguments of the stage.
+    :param from_checkpoint: str. Checkpoint to start from. 'loaded' is the visit as loaded.
+    :param save_as: str or None. Checkpoint to keep the result as, replacing any earlier one. If None, the name of the stage.
+    :param address: tuple or str. Address the daemon listens on.
+    :param authkey: bytes or None. Key of the daemon. If None, read it from key_path(address).
+    :return: dict with the checkpoint name, the run time of the stage in seconds, what it printed, and the other values it returned.
+    '''
+    reply = request(dict(command='run', stage=stage, kwargs=kwargs or {}, from_checkpoint=from_checkpoint, save_as=save_as),
+                    address, authkey)
+    print("Ran {} in {:.2f} s, kept as checkpoint {}.".format(stage, reply['seconds'], reply['checkpoint']))
+    return reply
+
+
+def get_images(checkpoint='loaded', address=DEFAULT_ADDRESS, authkey=None):
+    '''
+    Reads the images of a checkpoint straight from the daemon's shared memory, without copying them.
+    Only works on the machine the daemon runs on.
+
+    :param checkpoint: str. Name of the checkpoint.
+    :param address: tuple or str. Address the daemon listens on.
+    :param authkey: bytes or None. Key of the daemon. If None, read it from key_path(address).
+    :return: read-only 3D array of the images. Copy it to keep it after the checkpoint is replaced.
+    '''
+    reply = request(dict(command='images', checkpoint=checkpoint), address, authkey)
+    if reply['block'] not in _attached:
+        try:
+            block = shared_memory.SharedMemory(name=reply['block'], track=False)
+        except TypeError:
+            # Before Python 3.13 attaching also registers the block to be removed when this process
+            # exits, which would pull it from under the daemon.
+            block = shared_memory.SharedMemory(name=reply['block'])
+            resource_tracker.unregister(block._name, 'shared_memory')
+        _attached[reply['block']] = block
+    images = np.ndarray(reply['shape'], dtype=np.dtype(reply['dtype']), buffer=_attached[reply['block']].buf)
+    images.flags.writeable = False
+    return images
+
+
+def get_variable(variable, checkpoint='loaded', frames=None, address=DEFAULT_ADDRESS, authkey=None):
+    '''
+    Fetches a data variable of a checkpoint, e.g. data_quality or bkg_vals, or some frames of it.
+
+    :param variable: str. Name of the data variable.
+    :param checkpoint: str. Name of the checkpoint.
+    :param frames: int, slice, or None. Frames to fetch. If None, fetch all of them.
+    :param address: tuple or str. Address the daemon listens on.
+    :param authkey: bytes or None. Key of the daemon. If None, read it from key_path(address).
+    :return: array of the variable.
+    '''
+    return request(dict(command='variable', variable=variable, checkpoint=checkpoint, frames=frames), address, authkey)['values']
+
+
+def list_checkpoints(address=DEFAULT_ADDRESS, authkey=None):
+    '''
+    Lists the checkpoints held by the daemon.
+
+    :param address: tuple or str. Address the daemon listens on.
+    :param authkey: bytes or None. Key of the daemon. If None, read it from key_path(address).
+    :return: dict of the image shape and data variables of each checkpoint.
+    '''
+    return request(dict(command='checkpoints'), address, authkey)['checkpoints']
+
+
+def save_checkpoint(path, checkpoint='loaded', address=DEFAULT_ADDRESS, authkey=None):
+    '''
+    Has the daemon save a checkpoint with save_obs, e.g. once its stages are tuned.
+
+    :param path: str. Path of the netCDF file, inside the output directory of the daemon. Relative paths are taken from that directory.
+    :param checkpoint: str. Name of the checkpoint.
+    :param address: tuple or str. Address the daemon listens on.
+    :param authkey: bytes or None. Key of the daemon. If None, read it from key_path(address).
+    :return: str full path of the file.
+    '''
+    return request(dict(command='save', checkpoint=checkpoint, path=path), address, authkey)['path']
+
+
+def drop_checkpoint(checkpoint, address=DEFAULT_ADDRESS, authkey=None):
+    '''
+    Frees a checkpoint the daemon no longer needs to hold.
+
+    :param checkpoint: str. Name of the checkpoint.
+    :param address: tuple or str. Address the daemon listens on.
+    :param authkey: bytes or None. Key of the daemon. If None, read it from key_path(address).
+    :return: None.
+    '''
+    request(dict(command='drop', checkpoint=checkpoint), address, authkey)
+
+
+def shutdown(address=DEFAULT_ADDRESS, authkey=None):
+    '''
+    Stops the daemon and frees its memory.
+
+    :param address: tuple or str. Address the daemon listens on.
+    :param authkey: bytes or None. Key of the daemon. If None, read it from key_path(address).
+    :return: None.
+    '''
+    request(dict(command='shutdown'), address, authkey)
+
+
+if __name__ == '__main__':
+    # python -m exotic_uvis.daemon source [port [output_dir]]
+    serve(sys.argv[1], address=('localhost', int(sys.argv[2])) if len(sys.argv) > 2 else DEFAULT_ADDRESS,
+          output_dir=sys.argv[3] if len(sys.argv) > 3 else None)
@@ -1,7 +1,27 @@
 __all__ = [
     "plot_exposure",
-    "plot_corners"
+    "plot_corners",
+    "render_frames",
+    "save_frames",
+    "plot_lines",
+    "plot_histogram",
+    "start_diagnostics",
+    "stop_diagnostics",
+    "collect_diagnostics"
 ]
 
+from exotic_uvis.utils.lazy_import import lazy_package
 
-from exotic_uvis.plotting.plot_exposures import plot_exposure, plot_corners
+# Each public name and the module defining it. A module, and its dependencies, is only imported
+# when one of its names is first used.
+lazy_package(__name__, {
+    "plot_exposure": "exotic_uvis.plotting.plot_exposures",
+    "plot_corners": "exotic_uvis.plotting.plot_exposures",
+    "render_frames": "exotic_uvis.plotting.render_animation",
+    "save_frames": "exotic_uvis.plotting.render_animation",
+    "plot_lines": "exotic_uvis.plotting.plot_exposures",
+    "plot_histogram": "exotic_uvis.plotting.plot_exposures",
+    "start_diagnostics": "exotic_uvis.plotting.diagnostics",
+    "stop_diagnostics": "exotic_uvis.plotting.diagnostics",
+    "collect_diagnostics": "exotic_uvis.plotting.diagnostics"
+})
@@ -0,0 +1,159 @@
+import os
+import re
+import queue
+import contextlib
+import multiprocessing
+
+import numpy as np
+
+
+# State of the running diagnostics sink, if any. Plots are only routed to it from the process that started it.
+_sink = dict(process=None, queue=None, pid=None, output_dir=None, max_pixels=None, submitted=0, dropped=0)
+
+
+def start_diagnostics(output_dir, max_pixels=250000, queue_size=64, dpi=100):
+    '''
+    Starts a background process that renders diagnostic plots with Agg and writes them to files.
+    While it runs, plot_exposure, plot_corners, plot_lines, and plot_histogram queue their plots to it
+    instead of drawing them inline, so plot=True and check_all=True never stall a reduction.
+
+    :param output_dir: str. Directory the plots are written to. Created if it does not exist.
+    :param max_pixels: int or None. Images with more pixels are block-averaged down to at most this many before they are queued. If None, never downsample.
+    :param queue_size: int. Maximum number of plots waiting to be rendered. When the queue is full, new plots are dropped rather than blocking.
+    :param dpi: int. Resolution of the written plots.
+    :return: None.
+    '''
+    if diagnostics_active():
+        stop_diagnostics()
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    plot_queue = multiprocessing.Queue(maxsize=queue_size)
+    process = multiprocessing.Process(target=_render_loop, args=(plot_queue, output_dir, dpi), daemon=True)
+    process.start()
+    _sink.update(process=process, queue=plot_queue, pid=os.getpid(), output_dir=output_dir,
+                 max_pixels=max_pixels, submitted=0, dropped=0)
+
+
+def stop_diagnostics(timeout=None):
+    '''
+    Waits for the queued plots to be rendered and stops the diagnostics process.
+
+    :param timeout: float or None. Seconds to wait for the renderer to finish. If None, wait until it has.
+    :return: dict with the number of plots submitted and dropped.
+    '''
+    stats = dict(submitted=_sink['submitted'], dropped=_sink['dropped'])
+    if not diagnostics_active():
+        return stats
+
+    _sink['queue'].put(None)
+    _sink['process'].join(timeout)
+    if _sink['process'].is_alive():
+        _sink['process'].terminate()
+    _sink.update(process=None, queue=None, pid=None)
+    print("Diagnostics: %.0f plots written to %s, %.0f dropped." % (stats['submitted'] - stats['dropped'],
+                                                                    _sink['output_dir'], stats['dropped']))
+    return stats
+
+
+@contextlib.contextmanager
+def collect_diagnostics(output_dir, **kwargs):
+    '''
+    Runs the enclosed block with the diagnostics sink on, e.g. "with collect_diagnostics('plots/'): ...".
+
+    :param output_dir: str. Directory the plots are written to.
+    :param kwargs: passed on to start_diagnostics.
+    :return: context manager.
+    '''
+    start_diagnostics(output_dir, **kwargs)
+    try:
+        yield
+    finally:
+        stop_diagnostics()
+
+
+def diagnostics_active():
+    '''
+    Returns whether plots are currently routed to the diagnostics sink.
+
+    :return: bool.
+    '''
+    return _sink['process'] is not None and _sink['pid'] == os.getpid()
+
+
+def downsample_image(image, max_pixels):
+    '''
+    Block-averages an image by the smallest integer factor that brings it to at most max_pixels.
+
+    :param image: 2D array. Image to downsample.
+    :param max_pixels: int. Maximum number of pixels of the result.
+    :return: the downsampled image and the extent (left, right, bottom, top) it covers in the original pixel coordinates.
+    '''
+    n_rows, n_cols = image.shape
+    factor = int(np.ceil(np.sqrt(image.size/max_pixels)))
+    if factor <= 1:
+        return image, None
+    rows, cols = n_rows//factor, n_cols//factor
+    small = image[:rows*factor, :cols*factor].reshape(rows, factor, cols, factor).mean(axis=(1, 3))
+    return small, (-0.5, cols*factor - 0.5, -0.5, rows*factor - 0.5)
+
+
+def submit_plot(kind, figsize, filename=None, **kwargs):
+    '''
+    Queues a plot to the diagnostics sink without waiting. Images are downsampled first.
+
+    :param kind: str. Plot kind, one of the keys of plotting.plot_exposures.DRAWERS.
+    :param figsize: tuple of float. Figure size in inches.
+    :param filename: str or None. Output file, relative to the sink directory unless absolute. If None, a numbered name is made from the kind and title.
+    :param kwargs: passed on to the drawing function of the kind.
+    :return: bool, whether the plot was queued.
+    '''
+    image = kwargs.get('image')
+    if image is not None and _sink['max_pixels'] and np.size(image) > _sink['max_pixels']:
+        small, extent = downsample_image(np.asarray(image), _sink['max_pixels'])
+        kwargs['image'] = small
+        # Keep the original pixel coordinates so that scatter and line overlays still line up.
+        kwargs['extent'] = kwargs.get('extent') or extent
+
+    _sink['submitted'] += 1
+    if filename is None:
+        tag = re.sub(r'[^A-Za-z0-9]+', '_', kwargs.get('title') or '').strip('_')
+        filename = '{:05d}_{}{}.png'.format(_sink['submitted'], kind, '_' + tag if tag else '')
+    filename = os.path.join(_sink['output_dir'], filename)
+
+    try:
+        _sink['queue'].put_nowait((kind, figsize, filename, kwargs))
+        return True
+    except queue.Full:
+        _sink['dropped'] += 1
+        return False
+
+
+def _render_loop(plot_queue, output_dir, dpi):
+    '''
+    Background process: renders queued plots with Agg until it receives None.
+
+    :param plot_queue: multiprocessing.Queue. Queue of (kind, figsize, filename, kwargs) plots.
+    :param output_dir: str. Directory the plots are written to.
+    :param dpi: int. Resolution of the written plots.
+    :return: None.
+    '''
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from exotic_uvis.plotting.plot_exposures import DRAWERS, PLOT_STYLE
+
+    matplotlib.rcParams.update(PLOT_STYLE)
+    while True:
+        item = plot_queue.get()
+        if item is None:
+            break
+        kind, figsize, filename, kwargs = item
+        try:
+            fig = Figure(figsize=figsize)
+            FigureCanvasAgg(fig)
+            DRAWERS[kind](fig, **kwargs)
+            fig.savefig(filename, dpi=dpi, bbox_inches='tight')
+        except Exception as e:
+            # A bad plot must not take the renderer down with it.
+            print("Diagnostics: could not render {}: {!r}".format(filename, e))
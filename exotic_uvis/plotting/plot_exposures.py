@@ -1,73 +1,178 @@
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib
 import matplotlib.patches as patches
 import xarray as xr
+from exotic_uvis.plotting.diagnostics import diagnostics_active, submit_plot
 
-#define plotting parameters
-plt.rc('font', family='serif')
-plt.rc('xtick', labelsize=14)
-plt.rc('ytick', labelsize=14)
-plt.rc('axes', labelsize=14)
-plt.rc('legend',**{'fontsize':11})
+#define plotting parameters, applied when the package first plots rather than when it is imported
+PLOT_STYLE = {'font.family': 'serif', 'xtick.labelsize': 14, 'ytick.labelsize': 14,
+              'axes.labelsize': 14, 'legend.fontsize': 11}
 
 
-def plot_exposure(images, line_data = None, scatter_data = None, filename = None, extent = None,
-                title = None, min = -3, max = 4, mark_size = 30, show = True):
+def apply_plot_style():
+
+    """
+    Function to set the package plotting parameters in matplotlib
+
+    """
+
+    matplotlib.rcParams.update(PLOT_STYLE)
+
+
+def draw_exposure(fig, image, line_data = None, scatter_data = None, extent = None, title = None,
+                  min = -3, max = 4, mark_size = 30, corners = None):
+
+    """
+    Function to draw an image given certain parameters on a figure
+
+    """
+
+    image = image.copy()
+    image[image <= 0] = 1e-10
+
+    ax = fig.add_subplot(111)
+    im = ax.imshow(np.log10(image), origin = 'lower', vmin = min, vmax = max, cmap = 'gist_gray', extent = extent)
+    ax.set_xlabel('Detector x-pixel')
+    ax.set_ylabel('Detector y-pixel')
+    fig.colorbar(im, ax = ax)
+
+    if line_data:
+        for j, line in enumerate(line_data):
+            ax.plot(line[0], line[1])
+
+    if scatter_data:
+        ax.scatter(scatter_data[0], scatter_data[1], s = mark_size, color = 'r', marker = '+')
+
+    if title:
+        ax.set_title(title)
+
+    # draw rectangles to indicate the corners used for background subtraction
+    for corner in corners or []:
+        rect = patches.Rectangle((corner[2], corner[0]), corner[3] - corner[2],
+                                 corner[1] - corner[0], linewidth=1, edgecolor='r', facecolor='none')
+        ax.add_patch(rect)
+
+
+def draw_lines(fig, x, y, others = None, xlabel = None, ylabel = None, title = None):
 
     """
-    Function to plot an image given certain parameters 
-    
+    Function to draw a quantity against x on a figure, with optional fainter companion curves
+
     """
 
-    for i, data in enumerate(images): 
+    ax = fig.add_subplot(111)
+    ax.plot(x, y, '-o')
+    if others is not None:
+        ax.plot(x, np.transpose(others), '-o', alpha = 0.5)
+    if xlabel:
+        ax.set_xlabel(xlabel)
+    if ylabel:
+        ax.set_ylabel(ylabel)
+    if title:
+        ax.set_title(title)
+
+
+def draw_histogram(fig, bin_edges, hist, markers = None, model = None, xlabel = 'Pixel Value', ylabel = 'Counts'):
+
+    """
+    Function to draw a histogram on a figure, with vertical markers (value, color) and an optional model curve (x, y)
+
+    """
+
+    ax = fig.add_subplot(111)
+    ax.stairs(hist, bin_edges, fill = True, color = 'indianred', alpha = 0.7)
+    if model is not None:
+        ax.plot(model[0], model[1])
+    for value, color in markers or []:
+        ax.axvline(value, linestyle = '--', color = color)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+
+
+# drawing functions by plot kind, shared by the inline plots and the background diagnostics renderer
+DRAWERS = {'exposure': draw_exposure, 'lines': draw_lines, 'histogram': draw_histogram}
+
+
+def render_plot(kind, figsize, filename = None, show = True, **kwargs):
 
-        image = data.copy()
-        image[image <= 0] = 1e-10
+    """
+    Function to draw one plot kind, either queued to the background diagnostics sink if it is
+    running, or inline with pyplot otherwise
 
-        plt.figure(figsize = (20, 4))
-        plt.imshow(np.log10(image), origin = 'lower', vmin = min, vmax = max, cmap = 'gist_gray', extent = extent)
-        plt.xlabel('Detector x-pixel')
-        plt.ylabel('Detector y-pixel')
-        plt.colorbar()
+    """
 
-        if line_data:
-            for j, line in enumerate(line_data):
-                plt.plot(line[0], line[1])
+    if diagnostics_active():
+        submit_plot(kind, figsize, filename = filename, **kwargs)
+        return
 
-        if scatter_data: 
-            plt.scatter(scatter_data[0], scatter_data[1], s = mark_size, color = 'r', marker = '+')
+    import matplotlib.pyplot as plt
+    apply_plot_style()
+    fig = plt.figure(figsize = figsize)
+    DRAWERS[kind](fig, **kwargs)
 
-        if title:
-            plt.title(title)
+    if filename:
+        plt.savefig(filename, bbox_inches = 'tight')
 
-        if filename: 
-            plt.savefig(filename[i], bbox_inches = 'tight')
-        
     if show:
         plt.show()
-    
+
+
+def plot_exposure(images, line_data = None, scatter_data = None, filename = None, extent = None,
+                title = None, min = -3, max = 4, mark_size = 30, show = True, corners = None):
+
+    """
+    Function to plot an image given certain parameters
+
+    """
+
+    for i, data in enumerate(images):
+        render_plot('exposure', (20, 4), filename = filename[i] if filename else None, show = False,
+                    image = data, line_data = line_data, scatter_data = scatter_data, extent = extent,
+                    title = title, min = min, max = max, mark_size = mark_size, corners = corners)
+
+    if show and not diagnostics_active():
+        import matplotlib.pyplot as plt
+        plt.show()
+
     return
 
 
 def plot_corners(images, corners):
 
     """
-    
+
     Function to plot exposure with rectangles to indicate the corners used for background subtraction
-    
+
     """
 
-    plot_exposure(images, show = False)
-    ax = plt.gca()
+    plot_exposure(images, corners = corners)
 
-    for corner in corners:
+    return
 
-        rect = patches.Rectangle((corner[2], corner[0]), corner[3] - corner[2], 
-                                 corner[1] - corner[0], linewidth=1, edgecolor='r', facecolor='none')
 
-        ax.add_patch(rect)
-    
-    plt.show()
+def plot_lines(x, y, others = None, xlabel = None, ylabel = None, title = None, filename = None, show = True):
+
+    """
+
+    Function to plot a quantity against x (e.g. exposure time), with optional fainter companion curves
+
+    """
+
+    render_plot('lines', (10, 7), filename = filename, show = show, x = x, y = y, others = others,
+                xlabel = xlabel, ylabel = ylabel, title = title)
+
+    return
 
-    return 
 
+def plot_histogram(bin_edges, hist, markers = None, model = None, filename = None, show = True):
+
+    """
+
+    Function to plot a histogram of pixel values with vertical markers (value, color) and an optional model curve (x, y)
+
+    """
+
+    render_plot('histogram', (10, 7), filename = filename, show = show, bin_edges = bin_edges, hist = hist,
+                markers = markers, model = model)
+
+    return
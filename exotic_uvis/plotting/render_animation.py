@@ -0,0 +1,182 @@
+import os
+import shutil
+import subprocess
+from multiprocessing import Pool
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import matplotlib.patches as patches
+
+
+def build_quicklook_figure(fig, image, exp_times, total_flux, partial_flux, section, animated = False):
+
+    """
+
+    Function to draw the quicklook layout (exposure, total flux, box flux) on a figure
+
+    """
+
+    gs = fig.add_gridspec(2, 2)
+
+    # initialize exposure subplot
+    ax1 = fig.add_subplot(gs[0, :])
+    im = ax1.imshow(image, cmap = 'gist_gray', origin = 'lower', vmin = -1, vmax = 3.5, animated = animated)
+    rect = patches.Rectangle((section[2], section[0]), section[3] - section[2], section[1] - section[0], linewidth=1, edgecolor='r', facecolor='none')
+    ax1.add_patch(rect)
+    ax1.set_xlabel('Detector x pixel')
+    ax1.set_ylabel('Detector y pixel')
+
+    # initialize flux sum subplot, with the axis limits fixed by the full series
+    ax2 = fig.add_subplot(gs[1, 0])
+    ax2.set_title('Total Image Flux', size = 10)
+    sum_flux_line, = ax2.plot(exp_times, total_flux, '.', color = 'indianred', animated = animated)
+    ax2.set_xlabel('Time of Exposure (MJD UTC)')
+    ax2.set_ylabel('Counts (e-)')
+
+    # initialize box flux subplot
+    ax3 = fig.add_subplot(gs[1, 1])
+    ax3.set_title('Box image Flux', size = 10)
+    transit_line, = ax3.plot(exp_times, partial_flux, '.', color = 'indianred', animated = animated)
+    ax3.set_xlabel('Time of Exposure (MJD UTC)')
+    ax3.set_ylabel('Counts (e-)')
+
+    fig.tight_layout()
+
+    return im, sum_flux_line, transit_line
+
+
+def log_images(images):
+
+    """
+
+    Function to return the log10 of the images, avoiding zero and negative values
+
+    """
+
+    images = np.array(images, dtype = np.float32)
+    images[images <= 0] = 1e-7
+
+    return np.log10(images)
+
+
+# per-worker figure state, built once by the pool initializer
+_worker_state = {}
+
+
+def _init_worker(shape, exp_times, total_flux, partial_flux, section, figsize, dpi):
+
+    """
+
+    Function to build an Agg figure once per worker and cache its blitting background
+
+    """
+
+    fig = Figure(figsize = figsize, dpi = dpi)
+    canvas = FigureCanvasAgg(fig)
+    artists = build_quicklook_figure(fig, np.zeros(shape), exp_times, total_flux, partial_flux,
+                                     section, animated = True)
+
+    # draw the static parts of the figure once and keep them for blitting
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    _worker_state.update(fig = fig, canvas = canvas, artists = artists, background = background,
+                         exp_times = exp_times, total_flux = total_flux, partial_flux = partial_flux)
+
+
+def _render_chunk(task):
+
+    """
+
+    Function to render a chunk of frames on the worker figure and return them as RGB arrays
+
+    """
+
+    start, log_frames = task
+    state = _worker_state
+    canvas = state['canvas']
+    im, sum_flux_line, transit_line = state['artists']
+
+    frames = []
+    for n, log_frame in enumerate(log_frames):
+        i = start + n
+
+        # restore the static background and redraw only the animated artists
+        canvas.restore_region(state['background'])
+        im.set_data(log_frame)
+        sum_flux_line.set_data(state['exp_times'][:i + 1], state['total_flux'][:i + 1])
+        transit_line.set_data(state['exp_times'][:i + 1], state['partial_flux'][:i + 1])
+        for artist in (im, sum_flux_line, transit_line):
+            artist.axes.draw_artist(artist)
+
+        frames.append(np.asarray(canvas.buffer_rgba())[:, :, :3].copy())
+
+    return frames
+
+
+def render_frames(exp_times, images, total_flux, partial_flux, section, n_workers = None,
+                  chunk_size = 8, figsize = (10, 7), dpi = 100):
+
+    """
+
+    Function to render every quicklook frame headlessly with Agg across a pool of workers
+
+    """
+
+    log_frames = log_images(images)
+    exp_times, total_flux, partial_flux = np.asarray(exp_times), np.asarray(total_flux), np.asarray(partial_flux)
+
+    # split the frames into ordered chunks, one task per chunk
+    tasks = [(start, log_frames[start:start + chunk_size]) for start in range(0, len(log_frames), chunk_size)]
+    initargs = (log_frames.shape[1:], exp_times, total_flux, partial_flux, section, figsize, dpi)
+
+    if n_workers == 1:
+        _init_worker(*initargs)
+        chunks = [_render_chunk(task) for task in tasks]
+    else:
+        with Pool(n_workers, initializer = _init_worker, initargs = initargs) as pool:
+            chunks = pool.map(_render_chunk, tasks)
+
+    return [frame for chunk in chunks for frame in chunk]
+
+
+def save_frames(frames, filename, fps = 10):
+
+    """
+
+    Function to assemble rendered RGB frames into a GIF (Pillow) or MP4 (ffmpeg) file
+
+    """
+
+    extension = os.path.splitext(filename)[1].lower()
+
+    if extension == '.gif':
+        from PIL import Image
+
+        pil_frames = [Image.fromarray(frame) for frame in frames]
+        pil_frames[0].save(filename, save_all = True, append_images = pil_frames[1:],
+                           duration = int(1000/fps), loop = 0)
+
+    elif extension == '.mp4':
+        ffmpeg = shutil.which('ffmpeg')
+        if ffmpeg is None:
+            raise RuntimeError('ffmpeg was not found on the PATH, cannot write {}.'.format(filename))
+
+        # pipe raw RGB frames straight into ffmpeg, padding to even dimensions for yuv420p
+        height, width = frames[0].shape[:2]
+        command = [ffmpeg, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(width, height), '-r', str(fps),
+                   '-i', '-', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                   '-pix_fmt', 'yuv420p', '-vcodec', 'libx264', filename]
+        with subprocess.Popen(command, stdin = subprocess.PIPE) as process:
+            for frame in frames:
+                process.stdin.write(np.ascontiguousarray(frame).tobytes())
+            process.stdin.close()
+            if process.wait() != 0:
+                raise RuntimeError('ffmpeg failed to write {}.'.format(filename))
+
+    else:
+        raise ValueError("Unrecognised animation format '{}', use '.gif' or '.mp4'.".format(extension))
+
+    return filename
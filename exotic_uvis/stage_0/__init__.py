@@ -5,7 +5,13 @@ __all__ = [
     "locate_target"
 ]
 
-from exotic_uvis.stage_0.quicklookup import quicklookup
-from exotic_uvis.stage_0.get_files_from_mast import get_files_from_mast
-from exotic_uvis.stage_0.collect_and_move_files import collect_and_move_files
-from exotic_uvis.stage_0.locate_target import locate_target
+from exotic_uvis.utils.lazy_import import lazy_package
+
+# Each public name and the module defining it. A module, and its dependencies, is only imported
+# when one of its names is first used.
+lazy_package(__name__, {
+    "quicklookup": "exotic_uvis.stage_0.quicklookup",
+    "get_files_from_mast": "exotic_uvis.stage_0.get_files_from_mast",
+    "collect_and_move_files": "exotic_uvis.stage_0.collect_and_move_files",
+    "locate_target": "exotic_uvis.stage_0.locate_target"
+})
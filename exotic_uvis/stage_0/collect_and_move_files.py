@@ -4,6 +4,8 @@ import glob
 
 from astropy.io import fits
 
+from exotic_uvis.utils.fits_prefetch import prefetch_fits
+
 def collect_and_move_files(visit_number, fromdir, outdir):
     '''
     Collects, renames, and moves the spec, direct, visit-related, and misc files to the right directories.
@@ -151,12 +153,23 @@ def identify_orbits(spec_flt, spec_spt, direct_flt, direct_spt, misc_files):
     
     print("Renamed all files to follow or##fm### (for spec frames) or or##dr### (for direct frames) convention.")
 
-def collect_files(search_dir, visit_number):
+def read_primary_header(path):
+    '''
+    Reads the primary header of a FITS file.
+
+    :param path: str. Path to the FITS file.
+    :return: the primary header.
+    '''
+    with fits.open(path) as fits_file:
+        return fits_file[0].header.copy()
+
+def collect_files(search_dir, visit_number, prefetch=8):
     '''
     Searches the search_dir for files of the right visit_number.
 
     :param visit_number: str. The visit number that we want to look at.
     :param search_dir: str. The directory that you want to locate files in.
+    :param prefetch: int. Number of headers read ahead on background threads, which hides the latency of slow or network filesystems.
     :return: lists of filepaths inside of the directory sorted by direct/spec/misc.
     '''
     # Start the routine
@@ -180,52 +193,54 @@ def collect_files(search_dir, visit_number):
     # Glob files
     files = sorted(glob.glob(os.path.join(search_dir, "*")))
     
+    # Only files that pass the name checks need their headers read, which happens in the background
+    def wanted(f):
+        return not any(txt in f for txt in reject) and not any(txt not in f for txt in require)
+    headers = prefetch_fits([f for f in files if wanted(f)], read_primary_header, depth=prefetch)
+
     # Sort files into direct, spec, and misc
     for f in files:
-        if any(txt in f for txt in reject):
-            # It's a file we do not want.
-            misc_files.append(f)
-            continue
-        if any(txt not in f for txt in require):
+        if not wanted(f):
             # It's a file we do not want.
             misc_files.append(f)
             continue
         # Otherwise, we can look at it a little closer.
-        with fits.open(f) as fits_file:
-            try:
-                if fits_file[0].header["DETECTOR"] != "UVIS":
-                    # Wrong detector so put it in misc
-                    misc_files.append(f)
-                    continue
-            except KeyError:
-                # It has no detector at all so put it in misc
+        header = next(headers)[1]
+        try:
+            if header["DETECTOR"] != "UVIS":
+                # Wrong detector so put it in misc
                 misc_files.append(f)
                 continue
-            if "spt.fits" in f:
-                filter_type = fits_file[0].header["SS_FILT"]
-                if filter_type == "G280":
-                    # Spec type
-                    spec_spt.append(f)
-                elif "F" in filter_type:
-                    # Direct type
-                    direct_spt.append(f)
-                else:
-                    # Unrecognized filter
-                    misc_files.append(f)
-            elif "flt.fits" in f:
-                filter_type = fits_file[0].header["FILTER"]
-                if filter_type == "G280":
-                    # Spec type
-                    spec_flt.append(f)
-                elif "F" in filter_type:
-                    # Direct type
-                    direct_flt.append(f)
-                else:
-                    # Unrecognized filter
-                    misc_files.append(f)
+        except KeyError:
+            # It has no detector at all so put it in misc
+            misc_files.append(f)
+            continue
+        if "spt.fits" in f:
+            filter_type = header["SS_FILT"]
+            if filter_type == "G280":
+                # Spec type
+                spec_spt.append(f)
+            elif "F" in filter_type:
+                # Direct type
+                direct_spt.append(f)
             else:
-                # Unrecognizd file type
+                # Unrecognized filter
                 misc_files.append(f)
+        elif "flt.fits" in f:
+            filter_type = header["FILTER"]
+            if filter_type == "G280":
+                # Spec type
+                spec_flt.append(f)
+            elif "F" in filter_type:
+                # Direct type
+                direct_flt.append(f)
+            else:
+                # Unrecognized filter
+                misc_files.append(f)
+        else:
+            # Unrecognizd file type
+            misc_files.append(f)
+    headers.close()
 
     print("Collected spec, direct, and misc files.")
     return spec_flt, spec_spt, direct_flt, direct_spt, misc_files
\ No newline at end of file
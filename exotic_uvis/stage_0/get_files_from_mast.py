@@ -1,7 +1,5 @@
 import os
 
-from astroquery.mast import Observations as Obs
-
 def get_files_from_mast(programID, target_name, visit_number, outdir, extensions=None):
     '''
     Queries MAST database and downloads *flt and *spt fits files from specified program, target, and visit number.
@@ -25,6 +23,8 @@ def query_MAST(programID, target_name, extensions):
     :param extensions: lst of str or None. File extensions you want to download. If None, take all file extensions. Otherwise, take only the files specified.
     :return: list of str filenames to request to download from MAST.
     ''' 
+    from astroquery.mast import Observations as Obs
+
     # Query MAST and get list of relevant data products.
     print("Querying MAST for files under program ID {}, target {}...".format(programID, target_name))
     obs_table = Obs.query_criteria(proposal_id=programID, target_name=target_name)
@@ -52,6 +52,8 @@ def download_from_MAST(data_products, visit_number, outdir):
     print("Downloaded data will be stored in directory {}.".format(outdir))
     
     print("Examining {} queried data products for files in visit number {}...".format(len(data_products),visit_number))
+    from astroquery.mast import Observations as Obs
+
     # Download data only if the visit number is correct.
     k = 0
     for data_product in data_products:
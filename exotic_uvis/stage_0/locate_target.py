@@ -1,9 +1,7 @@
-from astropy.stats import sigma_clipped_stats
 from astropy.io import fits
-from photutils import DAOStarFinder
 
 import numpy as np
-import matplotlib.pyplot as plt
+from exotic_uvis.utils.robust_stats import sigma_clipped_stats
 
 def locate_target(direct_image):
     '''
@@ -12,6 +10,9 @@ def locate_target(direct_image):
     :param direct_image: str. Path to the direct image.
     :return: location of the direct image in x, y floats.
     '''    
+    import matplotlib.pyplot as plt
+    from photutils import DAOStarFinder
+
     # Define three parameters for finding the target.
     satisfied = False       # whether the user is happy with the location identified by DAOStarFinder
     search_radius = 100     # how far to search from the initial guess
@@ -1,161 +1,235 @@
 import os
 import numpy as np
+import xarray as xr
 from astropy.io import fits
-import matplotlib.pyplot as plt 
-from matplotlib.animation import FuncAnimation
-import matplotlib.patches as patches
-from matplotlib.pyplot import rc
-from scipy import optimize
 
 
 
-def get_images(data_dir, section):
+def read_image(path):
 
     """
-    
-    Function to retrieve images and exposure times from data files
-    
+
+    Function to read the image and exposure mid-time of one flt file into memory
+
     """
 
+    with fits.open(path) as hdul:
+        return np.array(hdul[1].data), (hdul[0].header['EXPSTART'] + hdul[0].header['EXPEND'])/2
+
+
+
+
+def get_images(data_dir, section, prefetch = 4, io_metrics = None):
+
+    """
+
+    Function to retrieve images and exposure times from data files. The next prefetch files are
+    read on background threads while the current one is stored; read-wait and compute times are
+    added to io_metrics if it is given (see utils.new_io_metrics)
+
+    """
+
+    from exotic_uvis.utils.fits_prefetch import prefetch_fits
+
     # initialize image and exposure time arrays
-    images, exp_times, total_flux, partial_flux = [], [], [], []
+    images, exp_times = [], []
 
     # get spectra directory
     specs_dir = os.path.join(data_dir, 'specimages/')
 
-    # iterate over all files in directory
-    for filename in np.sort(os.listdir(specs_dir)):
+    # open flt files but avoid f_flt files (embedded) if created
+    paths = [os.path.join(specs_dir, filename) for filename in np.sort(os.listdir(specs_dir))
+             if (filename[-9:] == '_flt.fits') and (filename[-10] != 'f')]
 
-        # open flt files but avoid f_flt files (embedded) if created
-        if (filename[-9:] == '_flt.fits') and (filename[-10] != 'f'):
-
-            # open fits and image data
-            hdul = fits.open(os.path.join(specs_dir, filename))
-            image = np.array(hdul[1].data)
-
-            # append image and exposure data
-            exp_times.append((hdul[0].header['EXPSTART'] + hdul[0].header['EXPEND'])/2)
-            images.append(image) 
-            total_flux.append(np.sum(image))
-            partial_flux.append(np.sum(image[section[0]:section[1],section[2]:section[3]]))
+    # append image and exposure data
+    for path, (image, exp_time) in prefetch_fits(paths, read_image, depth = prefetch, metrics = io_metrics):
+        exp_times.append(exp_time)
+        images.append(image)
 
     # convert to numpy arrays
     images = np.array(images)
     exp_times = np.array(exp_times)
-    total_flux = np.array(total_flux)
-    partial_flux = np.array(partial_flux)
+
+    # sum the full frames and the box section of all frames at once
+    total_flux = np.sum(images, axis = (1, 2), dtype = np.float64)
+    partial_flux = box_flux(images, section)
 
     return images, exp_times, total_flux, partial_flux
 
 
 
 
-def get_transit(exp_times, images):
+def box_flux(images, section):
 
     """
     
-    Function to get a raw transit 
+    Function to sum the flux inside a box section [y0, y1, x0, x1] (or a boolean aperture mask) of every image at once
     
     """
-    return 0
 
+    images = np.asarray(images)
 
+    # a boolean mask selects an arbitrary aperture, shared by all frames
+    if np.ndim(section) == 2:
+        return np.einsum('kij,ij->k', images, np.asarray(section, dtype = images.dtype), dtype = np.float64)
 
+    return np.sum(images[:, section[0]:section[1], section[2]:section[3]], axis = (1, 2), dtype = np.float64)
 
-def create_gif(exp_times, images, total_flux, partial_flux, section, output_dir, save_fig = False):
 
 
+
+def assign_orbits(exp_times, orbit_gap = 45/1440):
+
     """
     
-    Function to create an animation showing all the exposures
+    Function to label each exposure with its orbit, using jumps in exposure time larger than orbit_gap (in days)
     
     """
 
+    exp_times = np.asarray(exp_times)
+    order = np.argsort(exp_times)
 
-    # avoid zero and negative values for log plot
-    images[images <= 0] = 1e-7
+    # a new orbit starts wherever consecutive exposures are separated by more than the gap
+    jumps = np.diff(exp_times[order]) > orbit_gap
+    orbits = np.empty(len(exp_times), dtype = int)
+    orbits[order] = np.concatenate(([0], np.cumsum(jumps)))
 
-    # create animation
-    fig = plt.figure(figsize = (10, 7))
-    gs = fig.add_gridspec(2, 2)
-    #fig.subplots_adjust(left=0.1, bottom=0.1, right=0.95, top=0.95, wspace=None, hspace = None)
-
-  
-    # initialize exposure subplot
-    ax1 = fig.add_subplot(gs[0, :])
-    im = ax1.imshow(np.log10(images[0]), cmap = 'gist_gray', origin = 'lower', vmin = -1, vmax = 3.5)
-    rect = patches.Rectangle((section[2], section[0]), section[3] - section[2], section[1] - section[0], linewidth=1, edgecolor='r', facecolor='none')
-    ax1.add_patch(rect)
-    ax1.set_xlabel('Detector x pixel')
-    ax1.set_ylabel('Detector y pixel')
-
-    # initialize Flux sum subplot
-    ax2 = fig.add_subplot(gs[1, 0])
-    ax2.set_title('Total Image Flux', size = 10)
-    sum_flux_line, = ax2.plot(exp_times, total_flux, '.', color = 'indianred')
-    #sum_flux_line,  = ax2.plot([], [], '.', color = 'indianred')
-    ax2.set_xlabel('Time of Exposure (BJD TDB)')
-    ax2.set_ylabel('Counts (e-)')
-
-    # initialize transit subplot
-    ax3 = fig.add_subplot(gs[1, 1])
-    ax3.set_title('Box image Flux', size = 10)
-    transit_line, = ax3.plot(exp_times, partial_flux, '.', color = 'indianred')
-    ax3.set_xlabel('Time of Exposure (BJD TDB)')
-    ax3.set_ylabel('Counts (e-)')
+    return orbits
+
+
+
+
+def get_transit(exp_times, images, section, orbit_gap = 45/1440):
+
+    """
+    
+    Function to get a raw transit. The aperture flux of every frame is summed at once and each orbit
+    is normalised by its own median, which removes the orbit-to-orbit offsets.
+
+    :param exp_times: array. Exposure mid-times in days.
+    :param images: 3D array. Images stacked along the first axis.
+    :param section: lst of int [y0, y1, x0, x1] or 2D bool array. Aperture to sum over.
+    :param orbit_gap: float. Time jump in days that separates two orbits.
+    :return: xarray DataArray of the normalised white light curve keyed by exp_time, with orbit and raw flux coordinates.
     
+    """
+
+    # sum the aperture of every frame and label the orbits
+    flux = box_flux(images, section)
+    orbits = assign_orbits(exp_times, orbit_gap)
+
+    # normalise each orbit by its median
+    orbit_medians = np.array([np.median(flux[orbits == orbit]) for orbit in range(orbits.max() + 1)])
+    norm_flux = flux/orbit_medians[orbits]
+
+    white_light = xr.DataArray(
+        data = norm_flux,
+        dims = ['exp_time'],
+        coords = dict(
+            exp_time = np.asarray(exp_times),
+            orbit = (['exp_time'], orbits),
+            raw_flux = (['exp_time'], flux),
+        ),
+        name = 'white_light',
+    )
+
+    return white_light.sortby('exp_time')
+
+
+
+
+def create_gif(exp_times, images, total_flux, partial_flux, section, output_dir, save_fig = False,
+               interactive = False, filename = 'quicklookup.gif', fps = 10, n_workers = None):
+
+
+    """
+    
+    Function to create an animation showing all the exposures. By default the frames are rendered
+    headlessly with Agg across a pool of workers and written straight to a GIF/MP4 file, so it can
+    run on compute nodes, if save_fig is True. With interactive = True, a blitted animation is shown
+    on screen instead, and saved too if save_fig is True.
+    
+    """
+
+    # matplotlib is only needed here, so it is imported on demand
+    from exotic_uvis.plotting.render_animation import build_quicklook_figure, log_images, render_frames, save_frames
+
+    # headless mode: render frames in parallel and assemble the output directly
+    if not interactive:
+        if save_fig:
+            frames = render_frames(exp_times, images, total_flux, partial_flux, section, n_workers = n_workers)
+            save_frames(frames, os.path.join(output_dir, filename), fps = fps)
+
+        return 0
+
+    # interactive mode: only the animated artists are redrawn on each frame
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FuncAnimation
+
+    log_frames = log_images(images)
+    fig = plt.figure(figsize = (10, 7))
+    im, sum_flux_line, transit_line = build_quicklook_figure(fig, log_frames[0], exp_times, total_flux, 
+                                                             partial_flux, section, animated = True)
 
     # initialize 
     def init():
-        sum_flux_line.set_data(exp_times[0], total_flux[0])
-        transit_line.set_data(exp_times[0], partial_flux[0])
+        sum_flux_line.set_data(exp_times[:1], total_flux[:1])
+        transit_line.set_data(exp_times[:1], partial_flux[:1])
 
-        return sum_flux_line, transit_line
+        return im, sum_flux_line, transit_line
 
     # define animation function
     def animation_func(i):
 
         # update image data
-        im.set_data(np.log10(images[i]))
+        im.set_data(log_frames[i])
 
         # update line data
-        sum_flux_line.set_data(exp_times[:i], total_flux[:i])
+        sum_flux_line.set_data(exp_times[:i + 1], total_flux[:i + 1])
 
         # update line data 2
-        transit_line.set_data(exp_times[:i], partial_flux[:i])
+        transit_line.set_data(exp_times[:i + 1], partial_flux[:i + 1])
     
-        return sum_flux_line, transit_line, 
+        return im, sum_flux_line, transit_line
         
     # create and plot animation
-    animation = FuncAnimation(fig, animation_func, init_func = init, frames = np.shape(images)[0], interval = 20)
-    plt.tight_layout()
+    animation = FuncAnimation(fig, animation_func, init_func = init, frames = np.shape(images)[0], 
+                              interval = 20, blit = True)
     plt.show()
 
-
     # save animation
     if save_fig:
-        animation.save(os.path.join(output_dir, 'quicklookup.gif'), writer = 'ffmpeg', fps = 10)
+        animation.save(os.path.join(output_dir, filename), writer = 'pillow', fps = fps)
 
     return 0
 
 
 
-def quicklookup(data_dir, output_dir):
+def quicklookup(data_dir, output_dir, section = None, interactive = False, n_workers = None):
+
+    """
+
+    Function to run the quick look of a visit, rendering headlessly unless interactive is True.
+    Returns the orbit-normalised box flux light curve.
+
+    """
 
     # define partial section
-    section = [280, 350, 700, 950]
+    if section is None:
+        section = [280, 350, 700, 950]
 
     # get images and exposure times
     images, exp_times, total_flux, partial_flux = get_images(data_dir, section)
 
     # get transit
-    #get_transit(exp_times, images)
+    white_light = get_transit(exp_times, images, section)
 
     # create animation gif
-    create_gif(exp_times, images, total_flux, partial_flux, section, output_dir)
+    create_gif(exp_times, images, total_flux, partial_flux, section, output_dir, save_fig = True,
+               interactive = interactive, n_workers = n_workers)
 
 
-    return 0
+    return white_light
 
 
 
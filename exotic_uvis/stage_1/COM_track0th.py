@@ -1,5 +1,3 @@
-from photutils.centroids import centroid_com
-
 def track0th(obs, guess):
     '''
     Tracks the 0th order through all frames using centroiding.
@@ -8,6 +6,8 @@ def track0th(obs, guess):
     :param guess: lst of float. Initial x, y position guess for the 0th order's location.
     :return: location of the direct image in x, y floats.
     '''    
+    from photutils.centroids import centroid_com
+
     # Correct direct image guess to be appropriate for spec images.
     # FIX: hardcoded based on WASP-31 test. There must be a better way...
     guess[0] += 100
@@ -6,17 +6,70 @@ __all__ = [
     "Pagul_bckg_subtraction",
     "full_frame_bckg_subtraction",
     "corner_bkg_subtraction",
+    "surface_bckg_subtraction",
     "track_bkgstars",
+    "align_frames",
     "plot_exposure",
-    "free_iteration_rejection"
+    "free_iteration_rejection",
+    "get_badpix_mask",
+    "WFC3_DQ_FLAGS",
+    "set_precision",
+    "precision_report",
+    "equivalence_report",
+    "save_obs",
+    "load_obs",
+    "ingest_new_exposures",
+    "load_ingested",
+    "watch_directory",
+    "sweep_laplacian_edge_detection",
+    "sweep_free_iteration_rejection",
+    "create_zarr_store",
+    "write_zarr_frames",
+    "open_zarr_obs",
+    "load_zarr_obs",
+    "apply_badpix_cache",
+    "dq_premask",
+    "update_badpix_cache",
+    "add_bjd_tdb",
+    "mjd_to_bjd_tdb"
 ]
 
-from exotic_uvis.stage_1.load_data import read_data
-from exotic_uvis.stage_1.laplacian_edge_detection import laplacian_edge_detection
-from exotic_uvis.stage_1.COM_track0th import track0th
-from exotic_uvis.stage_1.bckg_subtract import Pagul_bckg_subtraction, full_frame_bckg_subtraction, corner_bkg_subtraction
-from exotic_uvis.stage_1.temporal_outlier_rejection import fixed_iteration_rejection, free_iteration_rejection
-from exotic_uvis.stage_1.compute_displacements import track_bkgstars
-from exotic_uvis.plotting.plot_exposures import plot_exposure
-
+from exotic_uvis.utils.lazy_import import lazy_package
 
+# Each public name and the module defining it. A module, and its dependencies, is only imported
+# when one of its names is first used.
+lazy_package(__name__, {
+    "read_data": "exotic_uvis.stage_1.load_data",
+    "save_obs": "exotic_uvis.stage_1.load_data",
+    "load_obs": "exotic_uvis.stage_1.load_data",
+    "create_zarr_store": "exotic_uvis.stage_1.zarr_store",
+    "write_zarr_frames": "exotic_uvis.stage_1.zarr_store",
+    "open_zarr_obs": "exotic_uvis.stage_1.zarr_store",
+    "load_zarr_obs": "exotic_uvis.stage_1.zarr_store",
+    "apply_badpix_cache": "exotic_uvis.stage_1.badpix_cache",
+    "dq_premask": "exotic_uvis.stage_1.dq_premask",
+    "update_badpix_cache": "exotic_uvis.stage_1.badpix_cache",
+    "add_bjd_tdb": "exotic_uvis.stage_1.time_systems",
+    "mjd_to_bjd_tdb": "exotic_uvis.stage_1.time_systems",
+    "laplacian_edge_detection": "exotic_uvis.stage_1.laplacian_edge_detection",
+    "sweep_laplacian_edge_detection": "exotic_uvis.stage_1.laplacian_edge_detection",
+    "track0th": "exotic_uvis.stage_1.COM_track0th",
+    "Pagul_bckg_subtraction": "exotic_uvis.stage_1.bckg_subtract",
+    "full_frame_bckg_subtraction": "exotic_uvis.stage_1.bckg_subtract",
+    "corner_bkg_subtraction": "exotic_uvis.stage_1.bckg_subtract",
+    "surface_bckg_subtraction": "exotic_uvis.stage_1.bckg_subtract",
+    "fixed_iteration_rejection": "exotic_uvis.stage_1.temporal_outlier_rejection",
+    "free_iteration_rejection": "exotic_uvis.stage_1.temporal_outlier_rejection",
+    "sweep_free_iteration_rejection": "exotic_uvis.stage_1.temporal_outlier_rejection",
+    "track_bkgstars": "exotic_uvis.stage_1.compute_displacements",
+    "align_frames": "exotic_uvis.stage_1.align_frames",
+    "plot_exposure": "exotic_uvis.plotting.plot_exposures",
+    "get_badpix_mask": "exotic_uvis.stage_1.data_quality",
+    "WFC3_DQ_FLAGS": "exotic_uvis.stage_1.data_quality",
+    "set_precision": "exotic_uvis.stage_1.precision",
+    "precision_report": "exotic_uvis.stage_1.precision",
+    "equivalence_report": "exotic_uvis.stage_1.equivalence",
+    "ingest_new_exposures": "exotic_uvis.stage_1.incremental_ingest",
+    "load_ingested": "exotic_uvis.stage_1.incremental_ingest",
+    "watch_directory": "exotic_uvis.stage_1.incremental_ingest"
+})
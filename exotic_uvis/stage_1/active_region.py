@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def find_active_region(has_data, subarr_coords=None):
+    '''
+    Finds the bounding box of the frame that actually holds data.
+
+    :param has_data: 2D bool array. True where any frame has a finite, non-zero value.
+    :param subarr_coords: array or None. Subarray corners [left, right, bottom, top] in 1-indexed full frame pixels. If the frames are larger than the subarray (e.g. embedded in a padded array), the box is also clipped to the subarray footprint.
+    :return: lst of int [row start, row stop, column start, column stop] of the active region.
+    '''
+    n_rows, n_cols = has_data.shape
+    rows = np.flatnonzero(has_data.any(axis=1))
+    cols = np.flatnonzero(has_data.any(axis=0))
+    if len(rows) == 0:
+        # Nothing holds data, so keep the whole frame rather than an empty box.
+        return [0, n_rows, 0, n_cols]
+    region = [rows[0], rows[-1] + 1, cols[0], cols[-1] + 1]
+
+    if subarr_coords is not None:
+        left, right, bottom, top = [int(c) for c in subarr_coords]
+        if n_cols > right - left + 1 and right <= n_cols:
+            region[2], region[3] = max(region[2], left - 1), min(region[3], right)
+        if n_rows > top - bottom + 1 and top <= n_rows:
+            region[0], region[1] = max(region[0], bottom - 1), min(region[1], top)
+
+    return [int(r) for r in region]
+
+
+def active_slices(obs):
+    '''
+    Returns the row and column slices of the active data region of obs.
+
+    :param obs: xarray. Its active_region attribute is set by read_data. If it is missing, the whole frame is active.
+    :return: tuple of (row slice, column slice).
+    '''
+    region = obs.attrs.get('active_region')
+    if region is None:
+        return slice(0, obs.images.shape[1]), slice(0, obs.images.shape[2])
+    return slice(int(region[0]), int(region[1])), slice(int(region[2]), int(region[3]))
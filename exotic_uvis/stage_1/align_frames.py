@@ -0,0 +1,185 @@
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from exotic_uvis.stage_1.active_region import active_slices
+from exotic_uvis.stage_1.data_quality import dq_bitmask, pack_mask, unpack_mask
+from exotic_uvis.utils.chunk_planner import parse_memory, plan_stage_chunks
+
+
+def align_frames(obs, displacements = None, method = 'fourier', order = 3, n_workers = None, chunk_size = None,
+                 memory_budget = None):
+
+    """
+
+    Function to register every frame to the first one by shifting it back by its measured
+    displacement, e.g. the obs.meanstar_disp computed by track_bkgstars. Images are resampled by
+    Fourier phase shifts (batched over each chunk of frames) or by spline interpolation. Errors are
+    propagated with the squared weights of linear interpolation, and the DQ flags and bad pixel mask
+    of every pixel an output pixel draws from are carried over. Pixels shifted in from outside the
+    active region are set to 0 and flagged as fill values. Chunks of frames are shifted across a
+    pool of n_workers processes.
+
+    :param obs: xarray. Its images, errors, data_quality, and badpix_mask are updated in place.
+    :param displacements: array of shape (exp_time, 2) or None. (x, y) displacement of each frame, in pixels. If None, use obs.meanstar_disp.
+    :param method: str. 'fourier' for sinc (Fourier phase) shifts, or 'spline' for spline interpolation.
+    :param order: int. Order of the spline, if method is 'spline'.
+    :param n_workers: int or None. Number of worker processes. If None, use the number of CPUs. 1 runs in this process.
+    :param chunk_size: int or None. Number of frames per task. If None, split the frames evenly over the workers, with at most 16 frames per task to bound the memory of the Fourier transforms.
+    :param memory_budget: int, str, or None. Memory allowed for the temporaries of all the tasks running at once, e.g. '2GB' or 'auto', see utils.parse_memory. If given and chunk_size is None, it sets the number of frames per task.
+    :return: obs with aligned frames.
+
+    """
+
+    if method not in ('fourier', 'spline'):
+        raise ValueError("method must be 'fourier' or 'spline', not {!r}.".format(method))
+
+    if displacements is None:
+        if 'meanstar_disp' not in obs:
+            raise KeyError("obs has no meanstar_disp, run track_bkgstars first or pass displacements.")
+        displacements = obs.meanstar_disp.values
+
+    # a star displaced by (x, y) is brought back by shifting the frame by (-y, -x) along (rows, columns)
+    shifts = -np.asarray(displacements, dtype = np.float64)[:, ::-1]
+
+    # only the active region is resampled, so the padding around it is never shifted in
+    rows, cols = active_slices(obs)
+    n_frames = obs.sizes['exp_time']
+    n_workers = n_workers or os.cpu_count() or 1
+    if chunk_size is None and memory_budget is not None:
+        # every worker holds the temporaries of one task
+        per_worker = parse_memory(memory_budget)//min(n_workers, n_frames)
+        frames = plan_stage_chunks('align_frames', obs.images.shape, obs.images.dtype, per_worker, (rows, cols))
+        chunk_size = min(frames[0].stop - frames[0].start, -(-n_frames//n_workers))
+    chunk_size = chunk_size or min(-(-n_frames//n_workers), 16)
+    size = obs.badpix_mask.attrs['unpacked_size']
+
+    tasks = [(obs.images.values[k:k + chunk_size, rows, cols], obs.errors.values[k:k + chunk_size, rows, cols],
+              obs.data_quality.values[k:k + chunk_size, rows, cols],
+              unpack_mask(obs.badpix_mask.values[k:k + chunk_size], size)[:, rows, cols],
+              shifts[k:k + chunk_size], method, order) for k in range(0, n_frames, chunk_size)]
+
+    if n_workers == 1 or len(tasks) == 1:
+        chunks = [_align_chunk(task) for task in tasks]
+    else:
+        with Pool(min(n_workers, len(tasks))) as pool:
+            chunks = pool.map(_align_chunk, tasks)
+
+    # write the aligned chunks back
+    for k, (images, errors, dq, good) in zip(range(0, n_frames, chunk_size), chunks):
+        frames = slice(k, k + chunk_size)
+        obs.images.values[frames, rows, cols] = images
+        obs.errors.values[frames, rows, cols] = errors
+        obs.data_quality.values[frames, rows, cols] = dq
+        full_good = unpack_mask(obs.badpix_mask.values[frames], size)
+        full_good[:, rows, cols] = good
+        obs.badpix_mask.values[frames] = pack_mask(full_good)
+
+    return obs
+
+
+def _align_chunk(task):
+
+    """
+
+    Function to shift a chunk of frames, run by each worker
+
+    """
+
+    images, errors, dq, good, shifts, method, order = task
+
+    # non-finite pixels cannot be resampled, so they are zeroed and marked bad in their footprint
+    good = good & np.isfinite(images)
+    finite_images = np.where(np.isfinite(images), images, 0).astype(np.float64)
+
+    if method == 'fourier':
+        shifted = fourier_shift_frames(finite_images, shifts)
+    else:
+        from scipy.ndimage import shift as spline_shift
+        shifted = np.array([spline_shift(image, shift, order = order, mode = 'constant', cval = 0.)
+                            for image, shift in zip(finite_images, shifts)])
+
+    variances = np.empty(errors.shape, dtype = np.float64)
+    dq_out, good_out = np.empty_like(dq), np.empty_like(good)
+    outside = np.empty(good.shape, dtype = bool)
+    fill = dq_bitmask('fill_value')
+    inside = np.zeros(good.shape[1:], dtype = bool)
+    for i, shift in enumerate(shifts):
+        variances[i] = linear_shift(errors[i].astype(np.float64)**2, shift, 'variance', 0.)
+        dq_out[i] = linear_shift(dq[i], shift, 'or', fill)
+        good_out[i] = linear_shift(good[i], shift, 'and', False)
+        # tracked on its own, as pixels already flagged as fill by calwf3 still hold data
+        outside[i] = linear_shift(inside, shift, 'or', True)
+
+    # pixels that drew from outside the frame hold no data, including what the Fourier shift wraps around
+    shifted[outside] = 0
+
+    return shifted.astype(images.dtype), np.sqrt(variances).astype(errors.dtype), dq_out, good_out
+
+
+def fourier_shift_frames(images, shifts):
+
+    """
+
+    Function to shift a stack of frames by sub-pixel amounts at once, by multiplying their Fourier
+    transforms by a phase ramp. shifts holds the (row, column) shift of each frame
+
+    """
+
+    from scipy import fft
+
+    n_rows, n_cols = images.shape[1:]
+    k_rows = fft.fftfreq(n_rows)[None, :, None]
+    k_cols = fft.rfftfreq(n_cols)[None, None, :]
+    phase = np.exp(-2j*np.pi*(k_rows*shifts[:, 0, None, None] + k_cols*shifts[:, 1, None, None]))
+
+    return fft.irfft2(fft.rfft2(images, axes = (1, 2))*phase, s = (n_rows, n_cols), axes = (1, 2))
+
+
+def linear_shift(frame, shift, combine, fill):
+
+    """
+
+    Function to shift a frame by (row, column) with the weights of linear interpolation. combine
+    sets what is interpolated: 'variance' uses the squared weights, 'or' combines DQ flags of the
+    contributing pixels, and 'and' requires all of them to be good. Pixels beyond the edges are fill
+
+    """
+
+    for axis, s in enumerate(shift):
+        n = int(np.floor(s))
+        f = s - n
+        near = integer_shift(frame, n, axis, fill)
+        if f < 1e-9:
+            frame = near
+            continue
+        far = integer_shift(frame, n + 1, axis, fill)
+        if combine == 'variance':
+            frame = (1 - f)**2*near + f**2*far
+        elif combine == 'or':
+            frame = near | far
+        else:
+            frame = near & far
+
+    return frame
+
+
+def integer_shift(frame, n, axis, fill):
+
+    """
+
+    Function to shift a frame by a whole number of pixels along an axis, filling the pixels
+    shifted in with fill
+
+    """
+
+    out = np.full_like(frame, fill)
+    size = frame.shape[axis]
+    if abs(n) < size:
+        src, dst = [slice(None)]*frame.ndim, [slice(None)]*frame.ndim
+        src[axis] = slice(max(-n, 0), size - max(n, 0))
+        dst[axis] = slice(max(n, 0), size - max(-n, 0))
+        out[tuple(dst)] = frame[tuple(src)]
+
+    return out
@@ -0,0 +1,224 @@
+import os
+import warnings
+import contextlib
+
+import numpy as np
+from exotic_uvis.stage_1.active_region import active_slices
+from exotic_uvis.stage_1.data_quality import get_badpix_mask, flag_badpix, set_dq_flags
+
+
+def detector_offsets(obs):
+    '''
+    Returns the offsets from frame pixels to detector (full frame) pixels, from the first subarr_coords.
+    As in find_active_region, frames larger than their subarray are taken to be embedded in the full frame.
+
+    :param obs: xarray. Its subarr_coords hold the subarray corners [left, right, bottom, top] in 1-indexed full frame pixels.
+    :return: tuple of int (row offset, column offset), added to frame pixels to get 0-indexed detector pixels.
+    '''
+    left, right, bottom, top = [int(c) for c in obs.subarr_coords[0].values]
+    n_rows, n_cols = obs.images.shape[1:]
+    row_offset = 0 if (n_rows > top - bottom + 1 and top <= n_rows) else bottom - 1
+    col_offset = 0 if (n_cols > right - left + 1 and right <= n_cols) else left - 1
+    return row_offset, col_offset
+
+
+def load_badpix_cache(cache_path):
+    '''
+    Loads a bad pixel cache written by update_badpix_cache.
+
+    :param cache_path: str. Path to the cache, a .npz file. It does not need to exist yet.
+    :return: dict with 'boxes', the detector region [row start, row stop, column start, column stop] of each visit, 'times', the mean exposure time of each visit, and 'flagged' and 'skipped', (visit, row, column) lists of the detector pixels each visit found bad or did not test.
+    '''
+    if not os.path.exists(cache_path):
+        return dict(boxes=np.empty((0, 4), dtype=np.int32), times=np.empty(0),
+                    flagged=np.empty((3, 0), dtype=np.int32), skipped=np.empty((3, 0), dtype=np.int32))
+    with np.load(cache_path) as saved:
+        return {name: saved[name] for name in ('boxes', 'times', 'flagged', 'skipped')}
+
+
+@contextlib.contextmanager
+def _locked(cache_path):
+    '''
+    Holds an exclusive lock on the cache while it is read and rewritten, so that visits reduced in
+    parallel (e.g. by batch.run_batch) do not lose each other's updates. Where file locks are not
+    available the cache is used without one.
+
+    :param cache_path: str. Path to the cache.
+    :return: context manager.
+    '''
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(cache_path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def neighbour_median(image, x, y, bad, size=5):
+    '''
+    Takes the median of the good pixels in the box around each of a set of pixels, to replace them with.
+
+    :param image: 2D array. Frame the pixels are in.
+    :param x: int array. Rows of the pixels.
+    :param y: int array. Columns of the pixels.
+    :param bad: 2D bool array. True at pixels to leave out of the medians. Non-finite pixels are left out too.
+    :param size: int. Width of the box around each pixel.
+    :return: array of the medians. A pixel with no good pixel around it keeps its value.
+    '''
+    # Gather the box around every pixel at once, clipped to the frame.
+    n_rows, n_cols = image.shape
+    dx, dy = [d.ravel() - size//2 for d in np.mgrid[:size, :size]]
+    bx, by = np.clip(x[:, None] + dx, 0, n_rows - 1), np.clip(y[:, None] + dy, 0, n_cols - 1)
+    boxes = np.where(bad[bx, by] | ~np.isfinite(image[bx, by]), np.nan, image[bx, by])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(boxes, axis=1)
+    return np.where(np.isfinite(median), median, image[x, y])
+
+
+def update_badpix_cache(obs, cache_path, min_fraction=0.5):
+    '''
+    Adds the persistent bad pixels of a reduced visit to a cache of bad pixels in detector coordinates,
+    to be used by apply_badpix_cache on later visits. Pixels marked bad in obs.badpix_mask in at least
+    min_fraction of the frames are recorded, which keeps hot pixels and bad columns and leaves out
+    cosmic rays. Run it after the outlier rejection stages. Updating the cache again with the same
+    visit replaces its earlier record.
+
+    :param obs: xarray. Reduced data, with its badpix_mask updated by the stages.
+    :param cache_path: str. Path to the cache, a .npz file. It is created if needed.
+    :param min_fraction: float. Fraction of frames a pixel must be bad in to be recorded.
+    :return: int number of bad pixels recorded for this visit.
+    '''
+    rows, cols = active_slices(obs)
+    row_offset, col_offset = detector_offsets(obs)
+
+    # Count the frames each pixel is bad in, one frame at a time to keep the mask packed.
+    n_frames = obs.images.shape[0]
+    counts = np.zeros((rows.stop - rows.start, cols.stop - cols.start), dtype=np.int32)
+    for k in range(n_frames):
+        counts += ~get_badpix_mask(obs, k)[rows, cols]
+    r, c = np.nonzero((counts > 0) & (counts >= min_fraction*n_frames))
+    r, c = r + rows.start + row_offset, c + cols.start + col_offset
+
+    # Pixels that were premasked from the cache were not tested again by this visit.
+    skipped = np.empty((2, 0), dtype=np.int32)
+    if 'cached_badpix' in obs:
+        skipped = obs.cached_badpix.values.T + np.array([[row_offset], [col_offset]])
+        tested = ~np.isin((r << 32) + c, (skipped[0].astype(np.int64) << 32) + skipped[1])
+        r, c = r[tested], c[tested]
+
+    box = np.array([rows.start + row_offset, rows.stop + row_offset, cols.start + col_offset, cols.stop + col_offset])
+    time = float(np.mean(obs.exp_time.values))
+    directory = os.path.dirname(os.path.abspath(cache_path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with _locked(cache_path):
+        cache = load_badpix_cache(cache_path)
+
+        # Drop an earlier record of the same visit, and renumber the visits after it.
+        same = np.flatnonzero((cache['times'] == time) & np.all(cache['boxes'] == box, axis=1))
+        for v in same[::-1]:
+            for name in ('flagged', 'skipped'):
+                keep = cache[name][0] != v
+                cache[name] = cache[name][:, keep]
+                cache[name][0] -= cache[name][0] > v
+            cache['boxes'] = np.delete(cache['boxes'], v, axis=0)
+            cache['times'] = np.delete(cache['times'], v)
+
+        visit = len(cache['times'])
+        cache['boxes'] = np.concatenate([cache['boxes'], box[None].astype(np.int32)])
+        cache['times'] = np.append(cache['times'], time)
+        cache['flagged'] = np.concatenate([cache['flagged'], np.array([np.full(len(r), visit), r, c], dtype=np.int32)], axis=1)
+        cache['skipped'] = np.concatenate([cache['skipped'], np.array([np.full(skipped.shape[1], visit), skipped[0], skipped[1]],
+                                                                      dtype=np.int32)], axis=1)
+
+        # Write next to the cache and swap it in, so a failed write never leaves a broken cache.
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, **cache)
+        os.replace(tmp_path, cache_path)
+
+    print("Recorded %.0f persistent bad pixels of this visit in the bad pixel cache, which now holds %.0f visits." % (len(r), visit + 1))
+    return len(r)
+
+
+def cached_badpix(obs, cache_path, min_visits=2, min_fraction=0.5, max_age=None):
+    '''
+    Looks up the cached bad pixels that fall in the active region of obs.
+
+    :param obs: xarray. Data to look up the bad pixels of.
+    :param cache_path: str. Path to the cache written by update_badpix_cache.
+    :param min_visits: int. Number of visits a pixel must have been found bad in.
+    :param min_fraction: float. Fraction of the visits that tested a pixel that must have found it bad.
+    :param max_age: float or None. Only use visits within this many days of obs. If None, use all of them.
+    :return: tuple of int arrays (x, y) of the bad pixels, in frame coordinates.
+    '''
+    cache = load_badpix_cache(cache_path)
+    rows, cols = active_slices(obs)
+    row_offset, col_offset = detector_offsets(obs)
+    box = np.array([rows.start + row_offset, rows.stop + row_offset, cols.start + col_offset, cols.stop + col_offset])
+
+    use = np.ones(len(cache['times']), dtype=bool)
+    if max_age is not None:
+        use = np.abs(cache['times'] - np.mean(obs.exp_time.values)) <= max_age
+    flagged = cache['flagged'][:, use[cache['flagged'][0]]]
+    skipped = cache['skipped'][:, use[cache['skipped'][0]]]
+
+    # Candidates are the flagged pixels inside this visit, with the number of visits that found them bad.
+    inside = (flagged[1] >= box[0]) & (flagged[1] < box[1]) & (flagged[2] >= box[2]) & (flagged[2] < box[3])
+    keys = (flagged[1, inside].astype(np.int64) << 32) + flagged[2, inside]
+    keys, n_flagged = np.unique(keys, return_counts=True)
+    r, c = keys >> 32, keys & 0xffffffff
+
+    # Visits that tested a pixel covered it without premasking it.
+    boxes = cache['boxes'][use]
+    n_covered = np.sum((r[:, None] >= boxes[:, 0]) & (r[:, None] < boxes[:, 1]) &
+                       (c[:, None] >= boxes[:, 2]) & (c[:, None] < boxes[:, 3]), axis=1)
+    skipped_keys, n_skipped = np.unique((skipped[1].astype(np.int64) << 32) + skipped[2], return_counts=True)
+    n_tested = n_covered.copy()
+    if len(skipped_keys):
+        where = np.minimum(np.searchsorted(skipped_keys, keys), len(skipped_keys) - 1)
+        n_tested -= np.where(skipped_keys[where] == keys, n_skipped[where], 0)
+
+    bad = (n_flagged >= min_visits) & (n_flagged >= min_fraction*n_tested)
+    return (r[bad] - row_offset).astype(np.intp), (c[bad] - col_offset).astype(np.intp)
+
+
+def apply_badpix_cache(obs, cache_path, min_visits=2, min_fraction=0.5, max_age=None, flag='bad_detector_pixel', size=5):
+    '''
+    Premasks the bad pixels that earlier visits recorded with update_badpix_cache, before
+    laplacian_edge_detection and the temporal rejection stages run. Every cached bad pixel is replaced
+    in all frames by the median of the good pixels around it, marked bad in obs.badpix_mask, and given
+    the DQ flag. The stages then do not need iterations to find these pixels again. The premasked
+    pixels are kept in obs.cached_badpix, so that update_badpix_cache does not count them as found again.
+
+    :param obs: xarray. Loaded data, e.g. from read_data. It is updated in place.
+    :param cache_path: str. Path to the cache written by update_badpix_cache.
+    :param min_visits: int. Number of visits a pixel must have been found bad in.
+    :param min_fraction: float. Fraction of the visits that tested a pixel that must have found it bad.
+    :param max_age: float or None. Only use visits within this many days of obs, e.g. to stay within an anneal cycle. If None, use all of them.
+    :param flag: str or int. DQ flag OR-ed in at the premasked pixels, see dq_bitmask.
+    :param size: int. Width of the box around each pixel the replacement median is taken from.
+    :return: obs with the cached bad pixels premasked.
+    '''
+    x, y = cached_badpix(obs, cache_path, min_visits, min_fraction, max_age)
+    obs['cached_badpix'] = (["cached_pixel", "xy"], np.stack([x, y], axis=1))
+    if len(x) == 0:
+        print("No cached bad pixels to premask.")
+        return obs
+
+    bad = np.zeros(obs.images.shape[1:], dtype=bool)
+    bad[x, y] = True
+    images = obs.images.values
+    for k in range(images.shape[0]):
+        images[k, x, y] = neighbour_median(images[k], x, y, bad, size)
+        set_dq_flags(obs.data_quality.values[k], (x, y), flag)
+        flag_badpix(obs, (x, y), k=k)
+
+    print("Premasked %.0f cached bad pixels in every frame." % len(x))
+    return obs
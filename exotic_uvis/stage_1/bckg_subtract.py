@@ -2,13 +2,13 @@ from tqdm import tqdm
 import xarray as xr
 from astropy.io import fits
 import numpy as np
-from scipy.optimize import least_squares
-from scipy.optimize import curve_fit
-import matplotlib.pyplot as plt
-from exotic_uvis.plotting import plot_exposure, plot_corners
+from exotic_uvis.stage_1.active_region import active_slices
+from exotic_uvis.stage_1.data_quality import get_badpix_mask
+from exotic_uvis.utils.robust_stats import nanmedian, nanstd, nanmad, nanhistogram, nanmode, sigma_clipped_stats
+from exotic_uvis.utils.chunk_planner import plan_stage_chunks
 
 
-def full_frame_bckg_subtraction(obs, bin_number=1e5, fit='coarse', value='mode'):
+def full_frame_bckg_subtraction(obs, bin_number=1e5, fit='coarse', value='mode', memory_budget=None):
     '''
     Extracts the mode or median from the full frame and subtracts this value from the image.
 
@@ -16,50 +16,49 @@ def full_frame_bckg_subtraction(obs, bin_number=1e5, fit='coarse', value='mode')
     :param bin_number: int. Number of bins used to construct the histogram.
     :param fit: str. Options are 'coarse' (use the raw histogram) or 'fine' (fit a Gaussian to the histogram). Only matters if taking the mode of the frame.
     :param value: str. Options are 'mode' (take the mode of the frame) or 'median' (take the median of the frame).
+    :param memory_budget: int, str, or None. Memory allowed for the temporaries of the background statistics, e.g. '2GB' or 'auto', see utils.parse_memory. They are then taken in chunks of frames. If None, all at once.
     :return: obs with sky-corrected images DataSet.
     '''
     # Track background values.
     bckgs = []
 
+    # Only the active region of the frame holds data.
+    rows, cols = active_slices(obs)
+
     # Ensure bin_number cannot break image.
-    d_test = obs.images[0].values
+    d_test = obs.images[0].values[rows, cols]
     N_vals = d_test.shape[0]*d_test.shape[1]
     if bin_number > N_vals:
         print("Bin number should not exceed number of pixels to bin, reducing bin number to number of available pixels...")
         bin_number = N_vals
     
-    # Iterate through frames.
-    for k in range(obs.images.shape[0]):
-        # Load the array and take only its finite (non-NaN) values.
-        d = obs.images[k].values
-        finite = d[np.isfinite(d)]
-
-        # If you want the median, take it here.
+    if value not in ('mode', 'median'):
+        raise ValueError("Background value must be 'mode' or 'median', not {}.".format(value))
+    if value == 'mode' and fit not in ('coarse', 'fine'):
+        raise ValueError("Background fit must be 'coarse' or 'fine', not {}.".format(fit))
+    if value == 'median':
+        print('did median')
+
+    # Take the background of every frame of each chunk at once from the active region, ignoring non-finite values.
+    for frames in plan_stage_chunks('full_frame_bckg_subtraction', obs.images.shape, obs.images.dtype, memory_budget, (rows, cols)):
+        images = obs.images.values[frames, rows, cols]
         if value == 'median':
-            print('did median')
-            bckg = np.median(finite)
-            bckgs.append(bckg)
-        
-        elif value == 'mode':
-            # Build the histogram of the frame out of its finite (non-NaN) values.
-            hist, bin_edges = np.histogram(finite, bins=int(bin_number))
-
-            # If you want a coarse mode, take it here.
-            if fit == 'coarse':
-                ind = np.argmax(hist)
-                bckg = (bin_edges[ind]+bin_edges[ind+1])/2
-                bckgs.append(bckg)
-
-            # Else, take the fit.
-            elif fit == 'fine':
-                # For Carlos!
-                bckgs.append(bckg)
-
-        # Build a frame to correct the data with.
-        d -= bckgs[k]*np.ones_like(d)
-
-        # Replace the obs.image with the corrected frame.
-        obs.images[k] = obs.images[k].where(obs.images[k].values == d, d)
+            chunk_bckgs = list(nanmedian(images, axis=(1, 2)))
+
+        # If you want a coarse mode, take it from the histogram of each frame here.
+        elif fit == 'coarse':
+            chunk_bckgs = list(nanmode(images, axis=(1, 2), bins=int(bin_number)))
+
+        # Else, fit a Gaussian to the histogram of each frame around its coarse mode.
+        else:
+            coarse = nanmode(images, axis=(1, 2), bins=int(bin_number))
+            spread = nanmad(images, axis=(1, 2), scale=1.4826)
+            chunk_bckgs = [calculate_mode(frame, mode - 5*width, mode + 5*width, 101, fit='Gaussian')
+                           for frame, mode, width in zip(images, coarse, spread)]
+
+        # Correct the data of every frame in place, in its own precision.
+        images -= np.array(chunk_bckgs, dtype=images.dtype)[:, None, None]
+        bckgs.extend(chunk_bckgs)
     print("All frames sky-subtracted by {} {} method.".format(fit, value))
     return obs, bckgs
 
@@ -74,6 +73,8 @@ def Pagul_bckg_subtraction(obs, Pagul_path, masking_parameter=0.001, median_on_c
     :param median_on_columns: bool. If True, take the median value of the Pagul+ 2023 sky image along columns. Approximately eliminates contamination from poorly-sampled parts of sky.
     :return: obs with sky-corrected images DataSet.
     '''
+    from scipy.optimize import least_squares
+
     # Open the Pagul+ 2023 sky image.
     with fits.open(Pagul_path) as fits_file:
         Pagul_bckg = fits_file[0].data
@@ -83,18 +84,20 @@ def Pagul_bckg_subtraction(obs, Pagul_path, masking_parameter=0.001, median_on_c
     # Track scaling parameters. Should be ~equal to the frame mode.
     scaling_parameters = []
     modes = []
+
+    # Only the active region of the frame holds data.
+    rows, cols = active_slices(obs)
+
     # Iterate through frames.
     for k in range(obs.images.shape[0]):
-        # Load the array.
-        d = obs.images[k].values
+        # Load the active region of the array (a view) and the matching part of the sky image.
+        d = obs.images[k].values[rows, cols]
         x1,x2,y1,y2 = obs.subarr_coords[k].values
+        sky = Pagul_bckg[y1:y2+1,x1:x2+1][rows, cols]
 
         # First, get the coarse frame mode and standard deviation using the frame's finite values.
-        finite = d[np.isfinite(d)]
-        hist, bin_edges = np.histogram(finite, bins=10**6)
-        ind = np.argmax(hist)
-        mode = (bin_edges[ind]+bin_edges[ind+1])/2
-        sig = np.nanstd(finite)
+        mode = nanmode(d, bins=10**6)
+        sig = nanstd(d[np.isfinite(d)])
 
         modes.append(mode)
 
@@ -104,15 +107,12 @@ def Pagul_bckg_subtraction(obs, Pagul_path, masking_parameter=0.001, median_on_c
         # Then fit the standard bckg to the masked frame.
         def residuals_(A,x,y):
             return np.ma.sum((y - (A*x))**2)
-        result = least_squares(residuals_, 1, args=(Pagul_bckg[y1:y2+1,x1:x2+1], masked_frame))
+        result = least_squares(residuals_, 1, args=(sky, masked_frame))
         A = result.x[0]
 
-        # Store the scaling parameter and subtract the sky.
+        # Store the scaling parameter and subtract the sky in place, in the frame precision.
         scaling_parameters.append(A)
-        d -= A*Pagul_bckg[y1:y2+1,x1:x2+1]
-
-        # Replace the obs.image with the corrected frame.
-        obs.images[k] = obs.images[k].where(obs.images[k].values == d, d)
+        d -= d.dtype.type(A)*sky.astype(d.dtype)
     print("All frames sky-subtracted by Pagul+ 2023 method.")
     return obs, scaling_parameters, modes
 
@@ -137,12 +137,13 @@ def calculate_mode(array, hist_min, hist_max, hist_bins, fit = None, check_all =
     """
 
     # create a histogram of counts 
-    hist, bin_edges = np.histogram(array, bins = np.linspace(hist_min, hist_max, hist_bins))
+    hist, bin_edges = nanhistogram(array, bins = np.linspace(hist_min, hist_max, hist_bins))
     bin_cents = (bin_edges[:-1] + bin_edges[1:])/2
 
     # if true, fit gaussian to histogram and find center
     if fit == 'Gaussian':
         # fit a Gaussian profile
+        from scipy.optimize import curve_fit
         popt, pcov = curve_fit(Gauss1D, 
                                 bin_cents, 
                                 hist, 
@@ -152,88 +153,193 @@ def calculate_mode(array, hist_min, hist_max, hist_bins, fit = None, check_all =
         bkg_val = popt[2]
 
     elif fit == 'Median':
-        bkg_val = np.median(array)
+        bkg_val = nanmedian(array)
 
     else:
         bkg_val = (bin_edges[np.argmax(hist)] + bin_edges[np.argmax(hist) + 1])/2
     
     # if true, plot histrogram and location of maximum
     if check_all:
-        plt.figure(figsize = (10, 7))
-        plt.hist(array, bins = np.linspace(hist_min, hist_max, hist_bins), color = 'indianred', alpha = 0.7, density=False)
-        plt.axvline(bkg_val, color = 'gray', linestyle = '--')
+        from exotic_uvis.plotting import plot_histogram
 
+        model = None
         if fit ==  'Gaussian':
-            plt.plot(bin_cents, Gauss1D(bin_cents, popt[0], popt[1], popt[2], popt[3]))
+            model = (bin_cents, Gauss1D(bin_cents, popt[0], popt[1], popt[2], popt[3]))
 
-        plt.axvline(np.median(array), linestyle = '--', color = 'black')
-        plt.axvline((bin_edges[np.argmax(hist)] + bin_edges[np.argmax(hist) + 1])/2, linestyle = '--', color = 'blue')
-        plt.xlabel('Pixel Value')
-        plt.ylabel('Counts')
-        #plt.savefig('PLOTS/bkg_KELT7b_3.png', bbox_inches = 'tight', dpi = 300)
-        plt.show()
+        markers = [(bkg_val, 'gray'), (nanmedian(array), 'black'),
+                   ((bin_edges[np.argmax(hist)] + bin_edges[np.argmax(hist) + 1])/2, 'blue')]
+        plot_histogram(bin_edges, hist, markers = markers, model = model)
 
     return bkg_val
 
 
 def corner_bkg_subtraction(obs, plot = False, check_all = False, fit = None, 
-                           bounds = None, hist_min = -60, hist_max = 60, hist_bins = 1000):
+                           bounds = None, hist_min = -60, hist_max = 60, hist_bins = 1000, memory_budget = None):
 
     """
 
-    Function to remove the background flux
+    Function to remove the background flux. With a memory_budget (e.g. '2GB' or 'auto', see
+    utils.parse_memory), the frames are copied and corrected in chunks that fit it
 
     """
 
-    # copy images
-    images = obs.images.data.copy() 
+    # keep the uncorrected example frame for the plot
+    if plot:
+        raw_example = obs.images.data[1].copy()
 
-    # initialize background values
+    # initialize background values and get the region of the frames holding data
     bkg_vals = []
+    rows, cols = active_slices(obs)
+    progress = tqdm(total = obs.images.shape[0], desc = 'Removing background... Progress:')
+
+    # iterate over all images, copying one chunk of frames at a time
+    for frames in plan_stage_chunks('corner_bkg_subtraction', obs.images.shape, obs.images.dtype, memory_budget):
+        images = obs.images.data[frames].copy()
+
+        for image in images:
+
+            # calculate image background from histogram
+            if bounds:
+                if len(bounds) == 1:
+                    bound = bounds[0]
+                    img_bkg = calculate_mode(image[bound[0]:bound[1], bound[2]:bound[3]].flatten(), 
+                                             hist_min, hist_max, hist_bins, fit = fit, check_all = check_all)
+                else:
+                    image_vals = np.concatenate([image[bound[0]:bound[1], bound[2]:bound[3]].flatten() for bound in bounds])
+
+                    img_bkg = calculate_mode(image_vals, hist_min, hist_max, hist_bins, fit = fit, check_all = check_all)
 
-    # iterate over all images
-    for i, image in enumerate(tqdm(images, desc = 'Removing background... Progress:')):
-        
-        # calculate image background from histogram
-        if bounds:
-            if len(bounds) == 1:
-                bound = bounds[0]
-                img_bkg = calculate_mode(image[bound[0]:bound[1], bound[2]:bound[3]].flatten(), 
-                                         hist_min, hist_max, hist_bins, fit = fit, check_all = check_all)
             else:
-                image_vals = []
+                img_bkg = calculate_mode(image[rows, cols].flatten(), hist_min, hist_max, hist_bins, fit = fit, check_all = check_all)
 
-                for bound in bounds:       
-                    image_vals = np.concatenate((image_vals, image[bound[0]:bound[1], bound[2]:bound[3]].flatten()))
+            # append background value
+            bkg_vals.append(img_bkg)
 
-                img_bkg = calculate_mode(image_vals, hist_min, hist_max, hist_bins, fit = fit, check_all = check_all)
-                
-        else:
-            img_bkg = calculate_mode(image.flatten(), hist_min, hist_max, hist_bins, fit = fit, check_all = check_all)
+            # substract background from the active region of the image
+            image[rows, cols] -= image.dtype.type(img_bkg)
+            progress.update()
 
-        # append background value
-        bkg_vals.append(img_bkg)
-        
-        # substract background from image
-        image -= img_bkg
+        # write the corrected chunk back
+        obs.images.data[frames] = images
+    progress.close()
 
     # save background values
     obs['bkg_vals'] = xr.DataArray(data = bkg_vals, dims = ['exp_time'])
 
     # if true, plot calculated background values
     if plot:
+        from exotic_uvis.plotting import plot_exposure, plot_corners, plot_lines
 
-        plot_corners([images[0]], bounds)
+        plot_corners([obs.images.data[0]], bounds)
 
-        plt.figure(figsize = (10, 7))
-        plt.plot(range(obs.dims['exp_time']), bkg_vals, '-o')
-        plt.xlabel('Exposure')
-        plt.ylabel('Background Counts')
-        plt.title('Image background per exposure')
-        plt.show()
+        plot_lines(range(obs.dims['exp_time']), bkg_vals, xlabel = 'Exposure', ylabel = 'Background Counts', 
+                   title = 'Image background per exposure')
 
-        plot_exposure([obs.images.data[1], images[1]], title = 'Background Removal Example')
-
-    obs.images.data = images
+        plot_exposure([raw_example, obs.images.data[1]], title = 'Background Removal Example')
 
     return 0
+
+
+def surface_basis(n, degree, basis='polynomial', n_knots=4):
+    '''
+    Builds the 1D basis functions of a background surface along one axis of the frame.
+
+    :param n: int. Number of pixels along the axis.
+    :param degree: int. Polynomial degree, or the degree of the spline pieces.
+    :param basis: str. 'polynomial' for Legendre polynomials, or 'spline' for B-splines.
+    :param n_knots: int. Number of equal spline pieces along the axis. Only used if basis is 'spline'.
+    :return: 2D array of shape (n, number of basis functions).
+    '''
+    u = np.linspace(-1, 1, n) if n > 1 else np.zeros(n)
+    if basis == 'polynomial':
+        return np.polynomial.legendre.legvander(u, degree)
+    elif basis == 'spline':
+        from scipy.interpolate import BSpline
+        inner = np.linspace(-1, 1, n_knots + 1)
+        knots = np.concatenate([np.full(degree, -1.), inner, np.full(degree, 1.)])
+        return BSpline.design_matrix(u, knots, degree).toarray()
+    raise ValueError("Background surface basis must be 'polynomial' or 'spline', not {}.".format(basis))
+
+
+def surface_bckg_subtraction(obs, degree=2, basis='polynomial', n_knots=4, mask=None, sigma=3,
+                             max_sky_pixels=200000, n_batch=16, memory_budget=None):
+    '''
+    Fits a smooth 2D surface, a low order polynomial or a tensor product spline, to the sky pixels of
+    every frame and subtracts it. The sky mask and so the design matrix are the same for every frame
+    of the visit, so the design matrix is QR-factorised once and all frames are solved together as one
+    least-squares problem with many right-hand sides, in batches of n_batch frames.
+
+    :param obs: xarray. Its obs.images DataSet contains the images.
+    :param degree: int. Total degree of the polynomial, or the degree of the spline pieces.
+    :param basis: str. 'polynomial' for Legendre polynomials in rows and columns with total degree up to degree, or 'spline' for a tensor product of B-splines.
+    :param n_knots: int. Number of equal spline pieces along each axis. Only used if basis is 'spline'.
+    :param mask: 2D bool array or None. True at the sky pixels of the active region to fit. If None, use the pixels that are good in every frame and lie within sigma standard deviations of a first surface fitted to the median frame.
+    :param sigma: float. Clipping threshold used to find the sky pixels if mask is None.
+    :param max_sky_pixels: int. If there are more sky pixels than this, fit an evenly spaced subset of them.
+    :param n_batch: int. Number of frames solved at once.
+    :param memory_budget: int, str, or None. Memory allowed for the sky pixels of a batch, e.g. '2GB' or 'auto', see utils.parse_memory. If given, it sets the number of frames solved at once instead of n_batch.
+    :return: obs with sky-corrected images DataSet and the mean background of each frame in bkg_vals, and the array of surface coefficients of shape (exp_time, number of terms).
+    '''
+    from scipy.linalg import solve_triangular
+
+    # Basis functions along the rows and the columns of the active region, and the terms of the surface.
+    rows, cols = active_slices(obs)
+    images = obs.images.values
+    n_frames, n_rows, n_cols = images.shape[0], rows.stop - rows.start, cols.stop - cols.start
+    row_basis = surface_basis(n_rows, degree, basis, n_knots)
+    col_basis = surface_basis(n_cols, degree, basis, n_knots)
+    terms = [(i, j) for i in range(row_basis.shape[1]) for j in range(col_basis.shape[1])
+             if basis == 'spline' or i + j <= degree]
+    term_i, term_j = np.array(terms).T
+
+    def design(r, c):
+        return row_basis[r][:, term_i]*col_basis[c][:, term_j]
+
+    if mask is None:
+        # Pixels that are finite and good in every frame, taken one frame at a time to keep the mask packed.
+        good = np.ones((n_rows, n_cols), dtype=bool)
+        for k in range(n_frames):
+            good &= get_badpix_mask(obs, k)[rows, cols] & np.isfinite(images[k, rows, cols])
+
+        # Clip the sources from the residuals of a first surface fitted to the median of a few frames.
+        median_frame = nanmedian(images[np.linspace(0, n_frames - 1, min(n_frames, 16)).astype(int)][:, rows, cols], axis=0)
+        _, centre, spread = sigma_clipped_stats(median_frame[good], sigma=sigma)
+        mask = good & (np.abs(median_frame - centre) < sigma*spread)
+        r, c = np.nonzero(mask)
+        fit = np.linalg.lstsq(design(r, c), median_frame[r, c].astype(np.float64), rcond=None)[0]
+        residuals = median_frame - row_basis[:, term_i] @ (fit[:, None]*col_basis[:, term_j].T)
+        _, centre, spread = sigma_clipped_stats(residuals[good], sigma=sigma)
+        mask = good & (np.abs(residuals - centre) < sigma*spread)
+
+    # Factorise the design matrix of the sky pixels once.
+    r, c = np.nonzero(mask)
+    if len(r) > max_sky_pixels:
+        keep = np.linspace(0, len(r) - 1, max_sky_pixels).astype(int)
+        r, c = r[keep], c[keep]
+    if len(r) < len(terms):
+        raise ValueError("Only {} sky pixels to fit a background surface of {} terms.".format(len(r), len(terms)))
+    Q, R = np.linalg.qr(design(r, c))
+
+    # Solve every batch of frames at once in float64, then subtract the surfaces frame by frame.
+    coefficients = np.empty((n_frames, len(terms)))
+    bckgs = np.empty(n_frames)
+    col_basis_T = np.ascontiguousarray(col_basis.T, dtype=images.dtype)
+    if memory_budget is None:
+        batches = [slice(start, min(start + n_batch, n_frames)) for start in range(0, n_frames, n_batch)]
+    else:
+        batches = plan_stage_chunks('surface_bckg_subtraction', (n_frames, len(r), 1), images.dtype, memory_budget)
+    for batch in tqdm(batches, desc='Fitting background surfaces... Progress:'):
+        sky = images[batch, rows.start + r, cols.start + c].astype(np.float64)
+        coefficients[batch] = solve_triangular(R, Q.T @ sky.T).T
+        # Scatter the coefficients into a row term x column term matrix per frame, so each surface is
+        # row_basis @ C[k] @ col_basis.T. Only one frame's surface is held at a time, in the working precision.
+        C = np.zeros((batch.stop - batch.start, row_basis.shape[1], col_basis.shape[1]))
+        C[:, term_i, term_j] = coefficients[batch]
+        for k, C_k in zip(range(batch.start, batch.stop), C):
+            surface = (row_basis @ C_k).astype(images.dtype) @ col_basis_T
+            bckgs[k] = surface.mean(dtype=np.float64)
+            images[k, rows, cols] -= surface
+
+    obs['bkg_vals'] = xr.DataArray(data=bckgs, dims=['exp_time'])
+    print("All frames sky-subtracted by fitting a {} {} surface to {:.0f} sky pixels.".format(basis, degree, len(r)))
+    return obs, coefficients
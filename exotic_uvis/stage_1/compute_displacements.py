@@ -1,10 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from astropy.io import fits
-from scipy.stats import norm
-from scipy import optimize
-from photutils.centroids import centroid_com, centroid_2dg, centroid_quadratic
-from exotic_uvis.plotting import plot_exposure
 
 
 def track_bkgstars(obs, bkg_stars, window = 15, plot = False, check_all = False):
@@ -15,6 +9,10 @@ def track_bkgstars(obs, bkg_stars, window = 15, plot = False, check_all = False)
     
     """
 
+    from photutils.centroids import centroid_com
+    if plot or check_all:
+        from exotic_uvis.plotting import plot_exposure, plot_lines
+
     # intialize and copy images
     stars_pos, abs_pos = [], []
     images = obs.images.data.copy()
@@ -62,18 +60,10 @@ def track_bkgstars(obs, bkg_stars, window = 15, plot = False, check_all = False)
 
         plot_exposure([image], scatter_data = mean_loc, title = 'Location of background stars')
       
-        plt.figure(figsize = (10, 7))
-        plt.plot(obs.exp_time.data, mean_pos[:, 0], '-o')
-        plt.plot(obs.exp_time.data, np.transpose(stars_pos[:, :, 0]), '-o', alpha = 0.5)
-        plt.xlabel('Exposure times')
-        plt.ylabel('X pixel displacement')
-
-        plt.figure(figsize = (10, 7))
-        plt.plot(obs.exp_time.data, mean_pos[:, 1], '-o')
-        plt.plot(obs.exp_time.data, np.transpose(stars_pos[:, :, 1]), '-o', alpha = 0.5)
-        plt.xlabel('Exposure times')
-        plt.ylabel('Y pixel displacement')
-        plt.show()
+        plot_lines(obs.exp_time.data, mean_pos[:, 0], others = stars_pos[:, :, 0], 
+                   xlabel = 'Exposure times', ylabel = 'X pixel displacement', show = False)
+        plot_lines(obs.exp_time.data, mean_pos[:, 1], others = stars_pos[:, :, 1], 
+                   xlabel = 'Exposure times', ylabel = 'Y pixel displacement')
 
     return pos
 
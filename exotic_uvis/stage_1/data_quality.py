@@ -0,0 +1,201 @@
+import numpy as np
+
+# WFC3/UVIS data quality flag bits, as written by calwf3 into the DQ extension of flt files.
+WFC3_DQ_FLAGS = {
+    'reed_solomon_error': 1,
+    'fill_value': 2,
+    'bad_detector_pixel': 4,
+    'unused': 8,
+    'hot_pixel': 16,
+    'cte_tail': 32,
+    'warm_pixel': 64,
+    'bad_bias_pixel': 128,
+    'full_well_saturation': 256,
+    'bad_flat': 512,
+    'charge_trap': 1024,
+    'ad_saturation': 2048,
+    'cosmic_ray_astrodrizzle': 4096,
+    'cosmic_ray_calwf3': 8192,
+    'crosstalk_ghost': 16384,
+}
+
+# Bit the outlier stages record their own detections with. calwf3 leaves it unused, so the
+# detections never clash with the flags of the calibration pipeline.
+OUTLIER_FLAG = WFC3_DQ_FLAGS['unused']
+
+# Flags of pixels calwf3 already found to be unusable, premasked by dq_premask by default.
+PREMASK_FLAGS = ['reed_solomon_error', 'bad_detector_pixel', 'hot_pixel', 'bad_bias_pixel', 'bad_flat', 'charge_trap']
+
+
+def dq_bitmask(flags):
+    '''
+    Combines WFC3 flag names and/or integer bit values into a single bitmask.
+
+    :param flags: str, int, or lst of str/int. Flag names from WFC3_DQ_FLAGS or integer bit values.
+    :return: int bitmask with all requested bits set.
+    '''
+    if isinstance(flags, (str, int, np.integer)):
+        flags = [flags]
+    bitmask = 0
+    for flag in flags:
+        bitmask |= WFC3_DQ_FLAGS[flag] if isinstance(flag, str) else int(flag)
+    return bitmask
+
+
+def has_dq_flags(dq, flags):
+    '''
+    Tests which pixels of a DQ array carry any of the requested flags.
+
+    :param dq: array of int. Data quality array of any shape.
+    :param flags: str, int, or lst of str/int. Flags to test for, see dq_bitmask.
+    :return: bool array with the shape of dq, True where any requested bit is set.
+    '''
+    return (np.asarray(dq) & dq_bitmask(flags)) != 0
+
+
+def set_dq_flags(dq, hits, flag, overwrite=False):
+    '''
+    Sets a flag at sparse pixel locations of a DQ array, in place.
+
+    :param dq: array of int. Data quality array to update.
+    :param hits: tuple of int arrays. COO coordinates into dq, e.g. from np.nonzero.
+    :param flag: str or int. Flag to set, see dq_bitmask.
+    :param overwrite: bool. If True, replace the DQ value with the flag instead of OR-ing the bit in.
+    :return: the updated dq array.
+    '''
+    hits = tuple(hits)
+    if overwrite:
+        dq[hits] = dq_bitmask(flag)
+    else:
+        np.bitwise_or.at(dq, hits, np.asarray(dq_bitmask(flag), dtype=dq.dtype))
+    return dq
+
+
+def hits_from_mask(mask):
+    '''
+    Converts a dense boolean mask into a compact COO hit list.
+
+    :param mask: bool array. Dense mask of flagged pixels.
+    :return: 2D int array of shape (mask.ndim, n_hits) holding the flagged coordinates.
+    '''
+    mask = np.asarray(mask)
+    dtype = np.min_scalar_type(max(mask.shape))
+    return np.array(np.nonzero(mask), dtype=dtype).reshape(mask.ndim, -1)
+
+
+def hits_to_mask(hits, shape):
+    '''
+    Converts a COO hit list back into a dense boolean mask.
+
+    :param hits: 2D int array of shape (ndim, n_hits). COO coordinates.
+    :param shape: tuple of int. Shape of the dense mask.
+    :return: bool array of the given shape, True at each hit.
+    '''
+    mask = np.zeros(shape, dtype=bool)
+    mask[tuple(hits)] = True
+    return mask
+
+
+def hits_union(shape, *hit_lists):
+    '''
+    Merges several COO hit lists into one sorted list without duplicates.
+
+    :param shape: tuple of int. Shape of the array the hits index into.
+    :param hit_lists: 2D int arrays of shape (ndim, n_hits). Hit lists to merge.
+    :return: 2D int array of shape (ndim, n_unique) of the merged hits in C order.
+    '''
+    flat = [np.ravel_multi_index(tuple(hits), shape) for hits in hit_lists if np.size(hits)]
+    if not flat:
+        return np.empty((len(shape), 0), dtype=np.min_scalar_type(max(shape)))
+    flat = np.unique(np.concatenate(flat))
+    return np.array(np.unravel_index(flat, shape), dtype=np.min_scalar_type(max(shape)))
+
+
+def hits_contain(hits, query, shape):
+    '''
+    Tests which query coordinates are present in a COO hit list.
+
+    :param hits: 2D int array of shape (ndim, n_hits). Hit list to look in.
+    :param query: 2D int array of shape (ndim, n_query). Coordinates to look up.
+    :param shape: tuple of int. Shape of the array the hits index into.
+    :return: bool array of length n_query.
+    '''
+    return np.isin(np.ravel_multi_index(tuple(query), shape), np.ravel_multi_index(tuple(hits), shape))
+
+
+def pack_mask(mask):
+    '''
+    Packs a boolean mask into bits along its last axis, eight pixels per byte.
+
+    :param mask: bool array. Mask to pack.
+    :return: uint8 array with the last axis shrunk to ceil(n/8).
+    '''
+    return np.packbits(np.asarray(mask, dtype=bool), axis=-1)
+
+
+def packed_ones(shape):
+    '''
+    Builds an all-True bit-packed mask without allocating the unpacked array.
+
+    :param shape: tuple of int. Shape of the unpacked mask.
+    :return: uint8 array with the last axis shrunk to ceil(n/8).
+    '''
+    return np.full(tuple(shape[:-1]) + (-(-shape[-1]//8),), 255, dtype=np.uint8)
+
+
+def unpack_mask(packed, size):
+    '''
+    Unpacks a bit-packed mask made by pack_mask.
+
+    :param packed: uint8 array. Bit-packed mask.
+    :param size: int. Length of the unpacked last axis.
+    :return: bool array with the last axis restored to size.
+    '''
+    return np.unpackbits(np.asarray(packed), axis=-1, count=size).astype(bool)
+
+
+def set_packed_bits(packed, hits, value):
+    '''
+    Sets or clears individual pixels of a bit-packed mask in place, without unpacking it.
+
+    :param packed: uint8 array. Bit-packed mask, packed along its last axis.
+    :param hits: tuple of int arrays. COO coordinates in unpacked pixel units.
+    :param value: bool. True to set the bits, False to clear them.
+    :return: the updated packed array.
+    '''
+    hits = tuple(np.asarray(h, dtype=np.intp) for h in hits)
+    index = hits[:-1] + (hits[-1] >> 3,)
+    bits = (np.uint8(128) >> (hits[-1] & 7).astype(np.uint8)).astype(np.uint8)
+    if value:
+        np.bitwise_or.at(packed, index, bits)
+    else:
+        np.bitwise_and.at(packed, index, ~bits)
+    return packed
+
+
+def get_badpix_mask(obs, k=None):
+    '''
+    Unpacks the bit-packed obs.badpix_mask, where True marks a good pixel.
+
+    :param obs: xarray. Its obs.badpix_mask DataSet holds the packed mask.
+    :param k: int or None. If an int, unpack only that frame.
+    :return: bool array of shape (exp_time, x, y), or (x, y) if k is given.
+    '''
+    packed = obs.badpix_mask.values if k is None else obs.badpix_mask[k].values
+    return unpack_mask(packed, obs.badpix_mask.attrs['unpacked_size'])
+
+
+def flag_badpix(obs, hits, k=None):
+    '''
+    Marks pixels as bad in the bit-packed obs.badpix_mask, in place.
+
+    :param obs: xarray. Its obs.badpix_mask DataSet holds the packed mask.
+    :param hits: tuple of int arrays. COO coordinates (exp_time, x, y), or (x, y) if k is given.
+    :param k: int or None. Frame the 2D hits belong to.
+    :return: obs with badpix_mask updated.
+    '''
+    hits = tuple(hits)
+    if k is not None:
+        hits = (np.full(len(hits[0]), k, dtype=np.intp),) + hits
+    set_packed_bits(obs.badpix_mask.values, hits, False)
+    return obs
@@ -0,0 +1,49 @@
+import numpy as np
+from exotic_uvis.stage_1.active_region import active_slices
+from exotic_uvis.stage_1.badpix_cache import neighbour_median
+from exotic_uvis.stage_1.data_quality import WFC3_DQ_FLAGS, PREMASK_FLAGS, dq_bitmask, get_badpix_mask, flag_badpix
+
+
+def dq_premask(obs, flags=PREMASK_FLAGS, size=5, replace=True):
+    '''
+    Premasks the pixels that calwf3 already flagged in the DQ array, before laplacian_edge_detection
+    and the temporal rejection stages run. Flagged pixels are marked bad in obs.badpix_mask and, if
+    replace is True, replaced by the median of the good pixels around them, so the outlier stages do
+    not spend iterations finding them again. Their DQ flags are left as they are, and the outlier stages
+    record their own detections under OUTLIER_FLAG.
+
+    :param obs: xarray. Loaded data, e.g. from read_data. It is updated in place.
+    :param flags: str, int, or lst of str/int. DQ flags to premask, see dq_bitmask. Defaults to the flags of defective detector pixels in PREMASK_FLAGS.
+    :param size: int. Width of the box around each pixel the replacement median is taken from.
+    :param replace: bool. If False, only mark the pixels bad, and leave their values.
+    :return: obs with the flagged pixels premasked.
+    '''
+    rows, cols = active_slices(obs)
+    bitmask = dq_bitmask(flags)
+    bits = {name: bit for name, bit in WFC3_DQ_FLAGS.items() if bit & bitmask}
+    counts = dict.fromkeys(bits, 0)
+    images = obs.images.values
+
+    n_premasked = 0
+    for k in range(images.shape[0]):
+        # Decode all the flags of the frame at once.
+        dq = obs.data_quality.values[k, rows, cols]
+        x, y = np.nonzero(dq & bitmask)
+        for name, bit in bits.items():
+            counts[name] += np.count_nonzero(dq & bit)
+        if len(x) == 0:
+            continue
+
+        if replace:
+            # Leave out every premasked pixel, and pixels already marked bad, from the medians.
+            bad = (dq & bitmask != 0) | ~get_badpix_mask(obs, k)[rows, cols]
+            image = images[k, rows, cols]
+            image[x, y] = neighbour_median(image, x, y, bad, size)
+        flag_badpix(obs, (x + rows.start, y + cols.start), k=k)
+        n_premasked += len(x)
+
+    print("Premasked %.0f DQ-flagged pixels over all frames." % n_premasked)
+    for name, count in counts.items():
+        if count:
+            print("  %s: %.0f" % (name, count))
+    return obs
@@ -0,0 +1,205 @@
+import io
+import copy
+import time
+import contextlib
+
+import numpy as np
+import xarray as xr
+
+from exotic_uvis.stage_1.reference_kernels import REFERENCE_KERNELS
+from exotic_uvis.stage_1.data_quality import packed_ones
+from exotic_uvis.stage_1.active_region import active_slices
+
+# Kernels checked by equivalence_report when none are given, those that need no extra arguments.
+DEFAULT_KERNELS = [
+    ('laplacian_edge_detection', dict()),
+    ('free_iteration_rejection', dict()),
+    ('full_frame_bckg_subtraction', dict()),
+    ('corner_bkg_subtraction', dict()),
+]
+
+# Intended differences between the stages and the references, which equivalence_report leaves out:
+#   'active_region': the stages only work inside the active region, so the padding around it is not compared.
+#   'dq_bit': the references overwrite DQ with 1 where they flag a pixel, the stages OR in OUTLIER_FLAG
+#             and keep the calwf3 flags, so only which pixels had their DQ changed is compared.
+#   'badpix_mask': the references predate obs.badpix_mask and never update it, so it is not compared.
+COMPARISON_EXEMPTIONS = ('active_region', 'dq_bit', 'badpix_mask')
+
+
+def synthetic_obs(n_frames=10, shape=(120, 400), n_cosmic_rays=200, seed=0):
+    '''
+    Builds a small synthetic visit to test stages on: a sky background, a spectral trace with a 0th
+    order in the middle of the frame, two background stars, jitter, read and photon noise, and cosmic rays.
+
+    :param n_frames: int. Number of exposures.
+    :param shape: tuple of int. Rows and columns of each frame.
+    :param n_cosmic_rays: int. Number of cosmic ray hits spread over the visit.
+    :param seed: int. Seed of the random numbers.
+    :return: xarray obs with images, errors, data_quality, badpix_mask, and subarr_coords, as from read_data. The background stars are at x, y = (40, 30) and (340, 90).
+    '''
+    rng = np.random.default_rng(seed)
+    n_rows, n_cols = shape
+    y, x = np.mgrid[:n_rows, :n_cols]
+    jitter = rng.normal(0, 0.3, (n_frames, 2))
+
+    images = []
+    for dx, dy in jitter:
+        frame = np.full(shape, 20.)
+        frame += 300*np.exp(-((y - n_rows/2 - dy)/2.)**2/2)*np.exp(-((x - n_cols/2 - dx)/(n_cols/4))**2)
+        frame += 3000*np.exp(-((x - n_cols/2 - dx)**2 + (y - n_rows/2 - dy)**2)/8)
+        for sx, sy in ((40, 30), (340, 90)):
+            frame += 800*np.exp(-((x - sx - dx)**2 + (y - sy - dy)**2)/4)
+        images.append(frame)
+    images = np.array(images)
+    errors = np.sqrt(images + 5**2)
+    images = images + errors*rng.standard_normal(images.shape)
+    hits = (rng.integers(0, n_frames, n_cosmic_rays), rng.integers(0, n_rows, n_cosmic_rays), rng.integers(0, n_cols, n_cosmic_rays))
+    images[hits] += rng.uniform(300, 3000, n_cosmic_rays)
+
+    images, errors = images.astype(np.float32), errors.astype(np.float32)
+    return xr.Dataset(
+        data_vars=dict(
+            images=(["exp_time", "x", "y"], images),
+            errors=(["exp_time", "x", "y"], errors),
+            data_quality=(["exp_time", "x", "y"], np.zeros(images.shape, dtype=np.int16)),
+            badpix_mask=(["exp_time", "x", "packed_y"], packed_ones(images.shape), dict(unpacked_size=n_cols)),
+            subarr_coords=(["exp_time", "index"], np.tile([1, n_cols, 1, n_rows], (n_frames, 1))),
+        ),
+        coords=dict(exp_time=60000 + np.arange(n_frames)*2/1440),
+        attrs=dict(precision='float32'),
+    )
+
+
+def _numeric_outputs(obs, returned):
+    '''
+    Collects the arrays a stage produced, from the data variables of obs and from what it returned.
+
+    :param obs: xarray. obs after the stage.
+    :param returned: anything. Whatever the stage returned. Datasets and scalars other than arrays and lists are skipped.
+    :return: dict of arrays keyed by data variable name, or by 'returned_N' for the Nth returned value.
+    '''
+    outputs = {name: obs[name].values for name in obs.data_vars}
+    if not isinstance(returned, tuple):
+        returned = (returned,)
+    for i, value in enumerate(returned):
+        if isinstance(value, (list, np.ndarray)):
+            outputs['returned_{}'.format(i)] = np.asarray(value, dtype=np.float64)
+    return outputs
+
+
+def _run(stage, obs, kwargs, repeats):
+    '''
+    Runs a stage on fresh copies of obs and times it.
+
+    :param stage: function. Called as stage(obs, **kwargs).
+    :param obs: xarray. Input, which is not modified.
+    :param kwargs: dict. Keyword arguments of the stage. They are copied for every run, as some stages change them.
+    :param repeats: int. Number of runs. The fastest one is kept.
+    :return: the outputs of the last run, see _numeric_outputs, and the fastest run time in seconds.
+    '''
+    best = np.inf
+    for _ in range(repeats):
+        run, run_kwargs = obs.copy(deep=True), copy.deepcopy(kwargs)
+        # The stages report their own progress, which is not useful here.
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            t = time.perf_counter()
+            returned = stage(run, **run_kwargs)
+            best = min(best, time.perf_counter() - t)
+    return _numeric_outputs(run, returned), best
+
+
+def _exempt(obs, var, ref, out, exemptions):
+    '''
+    Applies the comparison exemptions to one output of a stage and its reference.
+
+    :param obs: xarray. Input the stage and reference ran on.
+    :param var: str. Name of the output.
+    :param ref: array. Output of the reference.
+    :param out: array. Output of the stage.
+    :param exemptions: tuple of str. Exemptions to apply, see COMPARISON_EXEMPTIONS.
+    :return: the reference and stage arrays to compare, or None, None if the output is not compared.
+    '''
+    if var == 'badpix_mask' and 'badpix_mask' in exemptions:
+        return None, None
+    if var == 'data_quality' and 'dq_bit' in exemptions:
+        ref, out = ref != obs.data_quality.values, out != obs.data_quality.values
+    if 'active_region' in exemptions and var in obs and obs[var].dims[-2:] == ('x', 'y'):
+        rows, cols = active_slices(obs)
+        ref, out = ref[..., rows, cols], out[..., rows, cols]
+    return ref, out
+
+
+def equivalence_report(obs=None, kernels=None, rtol=1e-5, atol=1e-3, repeats=1, verbose=True, exemptions=COMPARISON_EXEMPTIONS):
+    '''
+    Runs stages side by side with the frozen reference kernels of stage_1.reference_kernels, and reports
+    how far apart their results are and how much faster the stage is. Use it to check that an
+    optimisation of a stage does not change the science.
+
+    :param obs: xarray, str, or None. Data to run on, e.g. from read_data, or the path to an obs saved by save_obs. It is not modified. If None, use synthetic_obs().
+    :param kernels: lst of (str, dict) pairs or None. Stage names from REFERENCE_KERNELS and their keyword arguments. If None, use DEFAULT_KERNELS.
+    :param rtol: float. Relative tolerance of floating point results.
+    :param atol: float. Absolute tolerance of floating point results.
+    :param repeats: int. Number of timed runs of each kernel. The fastest is used for the speedup.
+    :param verbose: bool. If True, print the report.
+    :param exemptions: tuple of str. Intended differences to leave out of the comparison, from COMPARISON_EXEMPTIONS. Give () to compare everything.
+    :return: dict keyed by stage name (with ' #2' etc. for repeated stages) of dicts with the largest absolute difference of the floating point results, the number of values outside tolerance, the number of mismatched data quality flags and bad pixel mask bytes, whether all are within tolerance, the reference and stage run times in seconds, the speedup, and the outputs left out by the exemptions.
+    '''
+    import exotic_uvis.stage_1 as stage_1
+    from exotic_uvis.stage_1.load_data import load_obs
+
+    if obs is None:
+        obs = synthetic_obs()
+    elif isinstance(obs, str):
+        obs = load_obs(obs)
+    if kernels is None:
+        kernels = DEFAULT_KERNELS
+
+    report = {}
+    for name, kwargs in kernels:
+        reference, reference_time = _run(REFERENCE_KERNELS[name], obs, kwargs, repeats)
+        test, test_time = _run(getattr(stage_1, name), obs, kwargs, repeats)
+
+        max_abs_diff, n_outside, flag_mismatch, missing, exempt = 0., 0, 0, [], []
+        for var, ref in reference.items():
+            if var not in test or np.shape(test[var]) != np.shape(ref):
+                missing.append(var)
+                continue
+            ref, out = _exempt(obs, var, ref, test[var], exemptions)
+            if ref is None:
+                exempt.append(var)
+                continue
+            if ref.dtype.kind == 'f':
+                ref64, test64 = ref.astype(np.float64), out.astype(np.float64)
+                both = np.isfinite(ref64) & np.isfinite(test64)
+                if both.any():
+                    max_abs_diff = max(max_abs_diff, float(np.max(np.abs(test64 - ref64)[both])))
+                n_outside += int(np.count_nonzero(~np.isclose(test64, ref64, rtol=rtol, atol=atol, equal_nan=True)))
+            else:
+                flag_mismatch += int(np.count_nonzero(out != ref))
+
+        # The same stage may be checked with several settings.
+        repeat = sum(key.split(' #')[0] == name for key in report)
+        label = name if repeat == 0 else '{} #{}'.format(name, repeat + 1)
+        report[label] = dict(
+            max_abs_diff=max_abs_diff,
+            n_outside_tolerance=n_outside,
+            flag_mismatch=flag_mismatch,
+            missing=missing,
+            within_tolerance=(n_outside == 0 and flag_mismatch == 0 and not missing),
+            reference_s=reference_time,
+            stage_s=test_time,
+            speedup=reference_time/max(test_time, 1e-12),
+            exempt=exempt,
+        )
+
+    if verbose:
+        print("Equivalence report: %.0f frames of %.0f x %.0f pixels, rtol=%.0e, atol=%.0e, exempt: %s" % (
+            obs.images.shape + (rtol, atol, ', '.join(exemptions) or 'none')))
+        for name, r in report.items():
+            print("  %-28s %s  max |diff| %.3e, %.0f values outside tolerance, %.0f flags differ, speedup %.2fx (%.3f s -> %.3f s)" % (
+                name, 'OK  ' if r['within_tolerance'] else 'FAIL', r['max_abs_diff'], r['n_outside_tolerance'],
+                r['flag_mismatch'], r['speedup'], r['reference_s'], r['stage_s']))
+            if r['missing']:
+                print("    Outputs missing from the stage: %s" % ', '.join(r['missing']))
+
+    return report
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import numpy as np
+import xarray as xr
+from exotic_uvis.stage_1.load_data import read_data, save_obs, load_obs
+from exotic_uvis.stage_1.active_region import active_slices
+from exotic_uvis.stage_1.data_quality import set_dq_flags, flag_badpix, OUTLIER_FLAG
+from exotic_uvis.utils.robust_stats import nanmedian, nanstd
+
+
+def ingest_new_exposures(data_dir, store_dir, stages=None, sigma=10, min_frames=5, precision='float32', verbose=2):
+    '''
+    Appends the exposures in data_dir/specimages that are not yet in the store, so that adding an orbit
+    costs time proportional to that orbit rather than to the whole visit.
+
+    :param data_dir: str. Directory with the specimages and directimages folders, as for read_data.
+    :param store_dir: str. Directory of the persisted obs store. Created if it does not exist.
+    :param stages: lst of (function, dict) pairs or None. Per-frame stage_1 functions applied only to the new frames, called as function(obs, **kwargs), in order.
+    :param sigma: float or None. Threshold for the temporal outlier rejection of the new frames against the running per-pixel statistics. If None, skip it.
+    :param min_frames: int. Number of stored frames a pixel needs before its running statistics are trusted. Until then, it is compared to the median and std of the new batch.
+    :param precision: str. Working precision, see read_data.
+    :param verbose: int. Verbosity passed to read_data.
+    :return: obs of the new frames only, or None if there were no new frames.
+    '''
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    manifest = read_manifest(store_dir)
+
+    # Find the flt files that have not been ingested yet.
+    specs_dir = os.path.join(data_dir, 'specimages/')
+    new_files = sorted(f for f in os.listdir(specs_dir) if f[-9:] == '_flt.fits' and f not in manifest['files'])
+    if not new_files:
+        print("No new exposures in {}.".format(specs_dir))
+        return None
+    print("Ingesting {} new exposures into {}...".format(len(new_files), store_dir))
+
+    # Load and clean only the new frames.
+    obs = read_data(data_dir, verbose=verbose, precision=precision, files=new_files)
+    for stage, kwargs in (stages or []):
+        stage(obs, **kwargs)
+    stats = None
+    if sigma is not None:
+        obs, stats = incremental_temporal_rejection(obs, store_dir, sigma=sigma, min_frames=min_frames)
+
+    # Write the new part and statistics under new names, then swap in the manifest that points to them.
+    # Until the manifest is replaced the store is unchanged, so an interrupted ingest is simply redone.
+    n_parts = len(manifest['parts'])
+    part = 'obs_part_{:04d}.nc'.format(n_parts)
+    _write_atomic(os.path.join(store_dir, part), lambda path: save_obs(obs, path))
+    old_stats = manifest.get('stats')
+    if stats is not None:
+        manifest['stats'] = 'temporal_stats_{:04d}.npz'.format(n_parts)
+        _write_atomic(os.path.join(store_dir, manifest['stats']),
+                      lambda path: np.savez(path, count=stats[0], mean=stats[1], m2=stats[2]))
+    manifest['parts'].append(part)
+    manifest['files'].extend(new_files)
+    _write_atomic(os.path.join(store_dir, 'manifest.json'), lambda path: _dump_manifest(manifest, path))
+    if old_stats is not None and old_stats != manifest['stats']:
+        os.remove(os.path.join(store_dir, old_stats))
+    print("Store now holds {} exposures in {} parts.".format(len(manifest['files']), len(manifest['parts'])))
+    return obs
+
+
+def _write_atomic(path, write):
+    '''
+    Writes a file next to its destination and swaps it in, so a failed write never leaves a broken file.
+
+    :param path: str. Destination of the file.
+    :param write: function. Called as write(tmp_path) to write the file.
+    :return: str path of the file.
+    '''
+    root, extension = os.path.splitext(path)
+    tmp_path = root + '.tmp' + extension
+    write(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _dump_manifest(manifest, path):
+    '''
+    Writes the manifest of the store.
+
+    :param manifest: dict. The manifest, see read_manifest.
+    :param path: str. Path of the JSON file.
+    :return: None.
+    '''
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def incremental_temporal_rejection(obs, store_dir, sigma=10, min_frames=5):
+    '''
+    Rejects temporal outliers in new frames using running per-pixel statistics, then folds the
+    cleaned frames into a copy of those statistics. The store is not changed, ingest_new_exposures
+    saves the statistics together with the frames.
+
+    :param obs: xarray. The new frames. Its obs.images and obs.data_quality DataSets are updated in place.
+    :param store_dir: str. Directory of the obs store holding the running statistics.
+    :param sigma: float. Pixels deviating from the running mean by more than sigma running stds are replaced by the mean.
+    :param min_frames: int. Number of frames the statistics of a pixel must hold before they are used as its reference.
+    :return: obs with outliers replaced and flagged, and the updated per-pixel frame count, mean, and sum of squared deviations.
+    '''
+    rows, cols = active_slices(obs)
+    d_all = obs.images.values[:, rows, cols]
+    stats = load_running_stats(store_dir, obs.images.shape[1:])
+    count, mean, m2 = [stat[rows, cols] for stat in stats]
+
+    # Compare each pixel to its running statistics once enough frames back them, otherwise to the batch itself.
+    trusted = count >= min_frames
+    ref = mean.astype(d_all.dtype)
+    std = np.sqrt(m2/np.maximum(count - 1, 1)).astype(d_all.dtype)
+    if not np.all(trusted):
+        ref = np.where(trusted, ref, nanmedian(d_all, axis=0))
+        std = np.where(trusted, std, nanstd(d_all, axis=0).astype(d_all.dtype))
+
+    bad_pix = 0
+    for k in range(d_all.shape[0]):
+        d = d_all[k]
+        hits = np.nonzero(np.abs(d - ref) > sigma*std)
+        set_dq_flags(obs.data_quality.values[k, rows, cols], hits, OUTLIER_FLAG)
+        flag_badpix(obs, (hits[0] + rows.start, hits[1] + cols.start), k=k)
+        d[hits] = ref[hits]
+        bad_pix += len(hits[0])
+    print("Temporal outliers replaced in new frames: %.0f" % bad_pix)
+
+    # Merge the cleaned batch into the running statistics (Chan et al. parallel variance update).
+    batch = np.isfinite(d_all)
+    n_b = np.sum(batch, axis=0)
+    mean_b = np.nansum(d_all, axis=0, dtype=np.float64)/np.maximum(n_b, 1)
+    m2_b = np.nansum((d_all - mean_b)**2, axis=0, dtype=np.float64)
+    n = count + n_b
+    delta = mean_b - mean
+    m2 += m2_b + delta**2*count*n_b/np.maximum(n, 1)
+    mean += delta*n_b/np.maximum(n, 1)
+    count += n_b
+
+    # The slices are views, so the full frame statistics are already updated.
+    return obs, stats
+
+
+def load_running_stats(store_dir, shape):
+    '''
+    Loads the running per-pixel statistics of the store, or empty statistics if there are none yet.
+
+    :param store_dir: str. Directory of the obs store.
+    :param shape: tuple of int. Frame shape, used for empty statistics.
+    :return: per-pixel frame count, mean, and sum of squared deviations.
+    '''
+    path = os.path.join(store_dir, read_manifest(store_dir).get('stats') or 'temporal_stats.npz')
+    if not os.path.exists(path):
+        return np.zeros(shape, dtype=np.int64), np.zeros(shape), np.zeros(shape)
+    with np.load(path) as stats:
+        return stats['count'], stats['mean'], stats['m2']
+
+
+def read_manifest(store_dir):
+    '''
+    Reads the list of ingested files and stored parts.
+
+    :param store_dir: str. Directory of the obs store.
+    :return: dict with 'files' and 'parts' lists, and the name of the running statistics file under 'stats' once there is one.
+    '''
+    path = os.path.join(store_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return dict(files=[], parts=[])
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_ingested(store_dir):
+    '''
+    Loads every part of the store into a single obs, sorted by exposure time.
+
+    :param store_dir: str. Directory of the obs store.
+    :return: obs xarray with all ingested frames.
+    '''
+    parts = [load_obs(os.path.join(store_dir, part)) for part in read_manifest(store_dir)['parts']]
+    obs = xr.concat(parts, dim='exp_time', data_vars='minimal', coords='minimal', compat='override',
+                    combine_attrs='override')
+
+    # The active region of the visit covers the active regions of all parts.
+    regions = np.array([part.attrs['active_region'] for part in parts])
+    obs.attrs['active_region'] = [int(regions[:, 0].min()), int(regions[:, 1].max()),
+                                  int(regions[:, 2].min()), int(regions[:, 3].max())]
+    return obs.sortby('exp_time')
+
+
+def watch_directory(data_dir, store_dir, poll_interval=60, max_polls=None, **kwargs):
+    '''
+    Polls data_dir/specimages and ingests new exposures as they arrive.
+
+    :param data_dir: str. Directory with the specimages and directimages folders.
+    :param store_dir: str. Directory of the persisted obs store.
+    :param poll_interval: float. Seconds to wait between polls.
+    :param max_polls: int or None. Stop after this many polls. If None, poll until interrupted.
+    :param kwargs: passed on to ingest_new_exposures.
+    :return: number of polls that ingested new frames.
+    '''
+    n_polls, n_ingests = 0, 0
+    try:
+        while max_polls is None or n_polls < max_polls:
+            if ingest_new_exposures(data_dir, store_dir, **kwargs) is not None:
+                n_ingests += 1
+            n_polls += 1
+            if max_polls is None or n_polls < max_polls:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Stopped watching {}.".format(data_dir))
+    return n_ingests
@@ -1,7 +1,13 @@
 import numpy as np
+import xarray as xr
 from scipy.ndimage import median_filter
+from exotic_uvis.stage_1.data_quality import set_dq_flags, flag_badpix, OUTLIER_FLAG
+from exotic_uvis.stage_1.active_region import active_slices
 
-def laplacian_edge_detection(obs, sigma=10, factor=2, n=2, build_fine_structure=False, contrast_factor=5):
+# Side of the square tiles that incremental LED recomputes its median filtered images in.
+LED_TILE = 32
+
+def laplacian_edge_detection(obs, sigma=10, factor=2, n=2, build_fine_structure=False, contrast_factor=5, incremental=False):
     '''
     Convolves a Laplacian kernel with the obs.images to replace spatial outliers with
     the median of the surrounding 3x3 kernel.
@@ -12,18 +18,20 @@ def laplacian_edge_detection(obs, sigma=10, factor=2, n=2, build_fine_structure=
     :param n: int. Times to iterate over the data. If None, iterate until no new outliers are flagged.
     :param build_fine_structure: bool. If True, builds a fine structure model which protects data that varies on small lengthscales from being attacked by LED.
     :param contrast_factor: float. If build_fine_structure is True, this is the threshold of deviation we need to exceed in L+/F to flag outliers.
+    :param incremental: bool. If True, after the first iteration of each frame only the neighbourhoods of the pixels replaced by the last iteration are recomputed (see update_led_state), so later iterations cost time in proportion to the number of outliers rather than the frame size. The results are the same, except that non-positive noise and fine structure values keep the mean of the first iteration's images rather than that of the current ones.
     :return: obs xarray with outliers removed and data quality flags updated.
     '''
-    # Define the Laplacian kernel.
-    l = 0.25*np.array([[0,-1,0],[-1,4,-1],[0,-1,0]])
+    # Only the active region of each frame is cleaned.
+    rows, cols = active_slices(obs)
+    mask_rows, mask_cols = zeroth_order_slices(obs, rows, cols)
 
     # Iterate over each frame one at a time until the iteration stop condition is met by each frame.
     print("Cleaning threshold=%.1f outliers with Laplacian edge detection..." % sigma)
     for k in range(obs.images.shape[0]):
-        # Get the frame, errors, and dq array as np.array objects so we can operate on them.
-        data_frame = obs.images[k].values
-        errs = obs.errors[k].values
-        dq = obs.data_quality[k].values
+        # Get the frame, errors, and dq array of the active region as np.array objects so we can operate on them.
+        data_frame = obs.images[k].values[rows, cols].copy()
+        errs = obs.errors[k].values[rows, cols]
+        dq = obs.data_quality[k].values[rows, cols]
 
         # Track outliers flagged in this frame and iterations performed.
         bad_pix_removed = 0
@@ -31,65 +39,43 @@ def laplacian_edge_detection(obs, sigma=10, factor=2, n=2, build_fine_structure=
 
         # Then start iterating over this frame and keep going until the iteration stop condition is met.
         stop_iterating = False
+        state = None
         while not stop_iterating:
-            # Estimate readnoise value.
-            var2 = errs**2 - data_frame
-            var2[var2 < 0] = 0 # enforce positivity.
-            rn = np.sqrt(var2) # estimate readnoise array
-
-            # Build the noise model.
-            noise_model = build_noise_model(data_frame, rn)
-            if build_fine_structure:
-                F = build_fine_structure_model(data_frame)
-
-            # Subsample the array.
-            subsample, original_shape = subsample_frame(data_frame, factor=factor)
-            
-            # Convolve subsample with laplacian.
-            lap_img = np.convolve(l.flatten(),subsample.flatten(),mode='same').reshape(subsample.shape)
-            lap_img[lap_img < 0] = 0 # force positivity
-            
-            # Resample laplacian-convolved subsampled image to original size.
-            resample = resample_frame(lap_img, original_shape)
-
-            # Divide by the noise model scaled by the resampling factor.
-            S = resample/(factor*noise_model)
-            
-            # Remove sampling flux to protect data from being targeted by LED.
-            S = S - median_filter(S, size=5)
-
-            # Spot outliers.
-            S[np.abs(S) < sigma] = 0 # any not zero after this are rays.
-            S[S!=0] = 1 # for visualization and comparison to fine structure model.
-
-            # If we have a fine structure model, we also need to check the contrast.
-            if build_fine_structure:
-                contrast_image = resample/F
-                contrast_image[contrast_image < contrast_factor] = 0 # any not zero after this are rays.
-                contrast_image[contrast_image!=0] = 1 # for visualization and comparison to sampling flux model.
-                
-                # Then we need to merge the results of S = Laplacian_image/factor*noise_model - sampling_flux
-                # and contrast_image = Laplacian_image/Fine_structure_model so that we only take where both are 1.
-                S = np.where(S == contrast_image, S, 0)
+            # Build the threshold-independent images, then spot outliers.
+            if not incremental:
+                S, resample, F = led_intermediates(data_frame, errs, factor=factor, build_fine_structure=build_fine_structure)
+            else:
+                # Build every image once, then only update them around the pixels replaced since.
+                if state is None:
+                    state = led_state(data_frame, errs, factor=factor, build_fine_structure=build_fine_structure)
+                else:
+                    update_led_state(state, data_frame, errs, hits)
+                S, resample, F = state['S'], state['resample'], state['F']
+            S = led_outliers(S, resample, F, sigma, contrast_factor)
 
             # Ignore the 0th order, it's a dead end of endless masking.
-            xmid = int(S.shape[1]/2)
-            S[0:-1,xmid-70:xmid+70] = 0 # FIX: currently hardcoded to assume the source / 0th order is near the middle of the frame.
+            S[mask_rows,mask_cols] = 0 # FIX: currently hardcoded to assume the source / 0th order is near the middle of the frame.
 
             # Report where data quality flags should be added and count pixels to be replaced.
-            dq = np.where(S != 0, 1, dq)
+            hits = np.nonzero(S)
+            set_dq_flags(dq, hits, OUTLIER_FLAG)
+            flag_badpix(obs, (hits[0] + rows.start, hits[1] + cols.start), k=k)
             bad_pix_last_frame = -100
             if iteration_N != 1:
                 bad_pix_last_frame = bad_pix_this_frame
-            bad_pix_this_frame = np.count_nonzero(S)
+            bad_pix_this_frame = len(hits[0])
             bad_pix_removed += bad_pix_this_frame
 
             # Report progress.
             print("Bad pixels removed on iteration %.0f: %.0f" % (iteration_N, bad_pix_this_frame))
 
             # Correct frames.
-            med_filter_image = median_filter(data_frame,size=5)
-            data_frame = np.where(S != 0, med_filter_image, data_frame)
+            if not incremental:
+                med_filter_image = median_filter(data_frame,size=5)
+            else:
+                med_filter_image = np.empty_like(data_frame)
+                median_filter_patches(data_frame, med_filter_image, 5, hits)
+            data_frame[hits] = med_filter_image[hits]
 
             # Increment iteration number and check if condition to stop iterating is hit.
             iteration_N += 1
@@ -100,12 +86,130 @@ def laplacian_edge_detection(obs, sigma=10, factor=2, n=2, build_fine_structure=
             
         print("Finished cleaning frame %.0f in %.0f iterations." % (k, iteration_N-1))
         print("Total pixels corrected: %.0f out of %.0f" % (bad_pix_removed, S.shape[0]*S.shape[1]))
-        # Now replace the xarray datasets with the corrected frame and updated dq array.
-        obs.images[k] = obs.images[k].where(obs.images[k].values == data_frame,data_frame)
-        obs.data_quality[k] = obs.data_quality[k].where(obs.data_quality[k].values == dq,dq)
+        # Now replace the xarray dataset with the corrected frame. The dq array was updated in place.
+        obs.images.values[k, rows, cols] = data_frame
     print("All frames cleaned of spatial outliers by LED.")
     return obs
 
+def sweep_laplacian_edge_detection(obs, sigmas=[5,10,15], factors=[2], contrast_factors=[5], build_fine_structure=False):
+    '''
+    Evaluates many LED settings in one pass over the data. The expensive images (noise model, median
+    filtered images, fine structure model) are built once per frame and factor, and every sigma and
+    contrast_factor is tested against them. Counts are for the first LED iteration, and obs is not modified.
+
+    :param obs: xarray. Its obs.images and obs.errors DataSets are used, as in laplacian_edge_detection.
+    :param sigmas: lst of float. Outlier thresholds to test.
+    :param factors: lst of int. Resampling factors to test.
+    :param contrast_factors: lst of float. Contrast thresholds to test, if build_fine_structure is True.
+    :param build_fine_structure: bool. If True, also require the fine structure contrast to be exceeded.
+    :return: xarray DataArray of flagged pixel counts with dims (sigma, factor, contrast_factor, exp_time), and dict of (t, y, x) hit lists in frame coordinates keyed by (sigma, factor, contrast_factor).
+    '''
+    rows, cols = active_slices(obs)
+    mask_rows, mask_cols = zeroth_order_slices(obs, rows, cols)
+    if not build_fine_structure:
+        contrast_factors = [None]
+
+    counts = np.zeros((len(sigmas), len(factors), len(contrast_factors), obs.images.shape[0]), dtype=int)
+    hit_lists = {}
+    print("Sweeping %.0f LED settings..." % counts[..., 0].size)
+    for k in range(obs.images.shape[0]):
+        data_frame = obs.images[k].values[rows, cols]
+        errs = obs.errors[k].values[rows, cols]
+        for b, factor in enumerate(factors):
+            # Build the threshold-independent images once for this frame and factor.
+            S, resample, F = led_intermediates(data_frame, errs, factor=factor, build_fine_structure=build_fine_structure)
+            for a, sigma in enumerate(sigmas):
+                for c, contrast_factor in enumerate(contrast_factors):
+                    outliers = led_outliers(S, resample, F, sigma, contrast_factor)
+                    outliers[mask_rows,mask_cols] = False
+                    y, x = np.nonzero(outliers)
+                    counts[a, b, c, k] = len(y)
+                    hit_lists.setdefault((sigma, factor, contrast_factor), []).append(
+                        np.array([np.full(len(y), k), y + rows.start, x + cols.start]))
+
+    hit_lists = {setting: np.concatenate(hits, axis=1) for setting, hits in hit_lists.items()}
+    counts = xr.DataArray(counts, dims=['sigma', 'factor', 'contrast_factor', 'exp_time'],
+                          coords=dict(sigma=sigmas, factor=factors, contrast_factor=[np.nan if c is None else c for c in contrast_factors],
+                                      exp_time=obs.exp_time.values),
+                          name='flagged_pixels')
+    return counts, hit_lists
+
+def zeroth_order_slices(obs, rows, cols):
+    '''
+    Returns the region LED leaves alone around the 0th order, in coordinates of the active region.
+
+    :param obs: xarray. Its obs.images DataSet sets the full frame size.
+    :param rows: slice. Rows of the active region.
+    :param cols: slice. Columns of the active region.
+    :return: tuple of (row slice, column slice) to leave unflagged.
+    '''
+    # FIX: currently hardcoded to assume the source / 0th order is near the middle of the frame.
+    xmid = int(obs.images.shape[2]/2) - cols.start
+    mask_rows = slice(0, min(obs.images.shape[1] - 1, rows.stop) - rows.start)
+    mask_cols = slice(max(xmid-70, 0), max(xmid+70, 0))
+    return mask_rows, mask_cols
+
+def led_intermediates(data_frame, errs, factor=2, build_fine_structure=False):
+    '''
+    Builds the LED images that do not depend on the outlier thresholds.
+
+    :param data_frame: 2D array. Frame from the images DataSet.
+    :param errs: 2D array. Matching frame from the errors DataSet, used to estimate readnoise.
+    :param factor: int. Factor by which to resample the array. Must be at least 2.
+    :param build_fine_structure: bool. If True, also build the fine structure model.
+    :return: noise-normalised Laplacian image with the sampling flux removed, the resampled Laplacian image, and the fine structure model (None if not built).
+    '''
+    # Define the Laplacian kernel.
+    l = 0.25*np.array([[0,-1,0],[-1,4,-1],[0,-1,0]])
+
+    # Estimate readnoise value.
+    var2 = errs**2 - data_frame
+    var2[var2 < 0] = 0 # enforce positivity.
+    rn = np.sqrt(var2) # estimate readnoise array, in the frame precision
+
+    # Build the noise model.
+    noise_model = build_noise_model(data_frame, rn)
+    F = None
+    if build_fine_structure:
+        F = build_fine_structure_model(data_frame)
+
+    # Subsample the array.
+    subsample, original_shape = subsample_frame(data_frame, factor=factor)
+    
+    # Convolve subsample with laplacian.
+    lap_img = np.convolve(l.flatten().astype(subsample.dtype),subsample.flatten(),mode='same').reshape(subsample.shape)
+    lap_img[lap_img < 0] = 0 # force positivity
+    
+    # Resample laplacian-convolved subsampled image to original size.
+    resample = resample_frame(lap_img, original_shape)
+
+    # Divide by the noise model scaled by the resampling factor.
+    S = resample/(factor*noise_model)
+    
+    # Remove sampling flux to protect data from being targeted by LED.
+    S = S - median_filter(S, size=5)
+    return S, resample, F
+
+def led_outliers(S, resample, F, sigma, contrast_factor=5):
+    '''
+    Spots outliers in the LED images made by led_intermediates.
+
+    :param S: 2D array. Noise-normalised Laplacian image with the sampling flux removed.
+    :param resample: 2D array. Resampled Laplacian image.
+    :param F: 2D array or None. Fine structure model. If None, the contrast is not checked.
+    :param sigma: float. Threshold of deviation in S above which a pixel is an outlier.
+    :param contrast_factor: float. If F is given, threshold of deviation in resample/F that must also be exceeded.
+    :return: 2D bool array, True where outliers are found.
+    '''
+    # Spot outliers. Anything not below the threshold is a ray (including nans, as before).
+    outliers = ~(np.abs(S) < sigma) & (S != 0)
+
+    # If we have a fine structure model, we also need to check the contrast, so that we only take where both flag.
+    if F is not None:
+        contrast_image = resample/F
+        outliers &= ~(contrast_image < contrast_factor) & (contrast_image != 0)
+    return outliers
+
 def build_noise_model(data_frame, readnoise):
     '''
     Builds a noise model for the given data frame, following van Dokkum 2001 methods.
@@ -115,7 +219,7 @@ def build_noise_model(data_frame, readnoise):
     :return: 2D array same size as the data frame, a noise model describing noise in the frame.
     '''
     noise_model = np.sqrt(median_filter(np.abs(data_frame),size=5)+readnoise**2)
-    noise_model[noise_model <= 0] = np.mean(noise_model) # really want to avoid nans
+    noise_model[noise_model <= 0] = np.mean(noise_model, dtype=np.float64) # really want to avoid nans
     return noise_model
 
 def subsample_frame(data_frame, factor=2):
@@ -133,15 +237,13 @@ def subsample_frame(data_frame, factor=2):
     
     original_shape = np.shape(data_frame)
     ss_shape = (original_shape[0]*factor,original_shape[1]*factor)
-    subsample = np.empty(ss_shape)
-    
-    # Subsample the array.
-    for i in range(ss_shape[0]):
-        for j in range(ss_shape[1]):
-            try:
-                subsample[i,j] = data_frame[int((i+1)/2),int((j+1)/2)]
-            except IndexError:
-                subsample[i,j] = 0
+
+    # Subsample the array: pixel (i, j) takes data (int((i+1)/2), int((j+1)/2)), or 0 past the edge.
+    ii = (np.arange(ss_shape[0]) + 1)//2
+    jj = (np.arange(ss_shape[1]) + 1)//2
+    valid_i, valid_j = ii < original_shape[0], jj < original_shape[1]
+    subsample = np.zeros(ss_shape, dtype=data_frame.dtype)
+    subsample[np.ix_(valid_i, valid_j)] = data_frame[np.ix_(ii[valid_i], jj[valid_j])]
     return subsample, original_shape
 
 def resample_frame(data_frame, original_shape):
@@ -152,13 +254,13 @@ def resample_frame(data_frame, original_shape):
     :param original_shape: tuple of int. Original shape of the subsampled array.
     :return: 2D array with original shape resampled from the data frame.
     '''
-    resample = np.empty(original_shape)
-    for i in range(original_shape[0]):
-        for j in range(original_shape[1]):
-            resample[i,j] = 0.25*(data_frame[2*i-1,2*j-1] +
-                                  data_frame[2*i-1,2*j]   +
-                                  data_frame[2*i,2*j-1]   +
-                                  data_frame[2*i,2*j])
+    # Average each 2x2 block starting at (2i-1, 2j-1). Index -1 wraps to the last row/column, as before.
+    i = 2*np.arange(original_shape[0])
+    j = 2*np.arange(original_shape[1])
+    resample = 0.25*(data_frame[np.ix_(i-1, j-1)] +
+                     data_frame[np.ix_(i-1, j)]   +
+                     data_frame[np.ix_(i, j-1)]   +
+                     data_frame[np.ix_(i, j)])
     return resample
 
 def build_fine_structure_model(data_frame):
@@ -169,5 +271,196 @@ def build_fine_structure_model(data_frame):
     :return: 2D array of fine structure model.
     '''
     F = median_filter(data_frame, size=3) - median_filter(median_filter(data_frame, size=3), size=7)
-    F[F <= 0] = np.mean(F) # really want to avoid nans
-    return F
\ No newline at end of file
+    F[F <= 0] = np.mean(F, dtype=np.float64) # really want to avoid nans
+    return F
+
+def led_state(data_frame, errs, factor=2, build_fine_structure=False):
+    '''
+    Builds the LED images of led_intermediates, keeping the intermediate images that update_led_state
+    needs to update them in place.
+
+    :param data_frame: 2D array. Frame from the images DataSet.
+    :param errs: 2D array. Matching frame from the errors DataSet, used to estimate readnoise.
+    :param factor: int. Factor by which to resample the array. Must be at least 2.
+    :param build_fine_structure: bool. If True, also build the fine structure model.
+    :return: dict of the images. 'S', 'resample', and 'F' are those returned by led_intermediates.
+    '''
+    state = dict(factor=factor, build_fine_structure=build_fine_structure,
+                 kernel=(0.25*np.array([[0,-1,0],[-1,4,-1],[0,-1,0]])).flatten())
+
+    # Noise model, keeping the median filtered frame and the readnoise.
+    var2 = errs**2 - data_frame
+    var2[var2 < 0] = 0
+    state['rn2'] = np.sqrt(var2)**2
+    state['abs_median'] = median_filter(np.abs(data_frame), size=5)
+    state['noise_raw'] = np.sqrt(state['abs_median'] + state['rn2'])
+    state['noise_fill'] = np.mean(state['noise_raw'], dtype=np.float64)
+    state['noise'] = state['noise_raw'].copy()
+    state['noise'][state['noise'] <= 0] = state['noise_fill']
+
+    # Fine structure model, keeping both median filtered frames.
+    state['F'] = None
+    if build_fine_structure:
+        state['median3'] = median_filter(data_frame, size=3)
+        state['median3_7'] = median_filter(state['median3'], size=7)
+        state['F_raw'] = state['median3'] - state['median3_7']
+        state['F_fill'] = np.mean(state['F_raw'], dtype=np.float64)
+        state['F'] = state['F_raw'].copy()
+        state['F'][state['F'] <= 0] = state['F_fill']
+
+    # Laplacian of the subsampled frame, resampled.
+    state['subsample'], original_shape = subsample_frame(data_frame, factor=factor)
+    lap_img = np.convolve(state['kernel'].astype(state['subsample'].dtype), state['subsample'].flatten(), mode='same')
+    lap_img[lap_img < 0] = 0
+    state['lap_img'] = lap_img.reshape(state['subsample'].shape)
+    state['resample'] = resample_frame(state['lap_img'], original_shape)
+
+    # Noise-normalised Laplacian with the sampling flux removed.
+    state['S_raw'] = state['resample']/(factor*state['noise'])
+    state['S_median'] = median_filter(state['S_raw'], size=5)
+    state['S'] = state['S_raw'] - state['S_median']
+    return state
+
+def update_led_state(state, data_frame, errs, changed):
+    '''
+    Updates the LED images of led_state in place after some pixels of the frame changed. Each image is
+    only recomputed where it depends on the changed pixels: the median filters in the tiles around
+    them, the Laplacian in short runs of the subsampled frame, and the rest pixel by pixel. Non-positive
+    noise and fine structure values are replaced by the means led_state took over the whole frame,
+    which are not updated, so that the changes stay local.
+
+    :param state: dict. LED images from led_state, updated in place.
+    :param data_frame: 2D array. Frame after the change.
+    :param errs: 2D array. Matching frame from the errors DataSet.
+    :param changed: tuple of int arrays. Rows and columns of the pixels that changed, e.g. the hits of the last LED iteration.
+    :return: state.
+    '''
+    rows, cols = [np.asarray(c, dtype=np.intp) for c in changed]
+    if len(rows) == 0:
+        return state
+    shape, factor = data_frame.shape, state['factor']
+
+    # Noise model, within 2 pixels of the changes.
+    var2 = errs[rows, cols]**2 - data_frame[rows, cols]
+    var2[var2 < 0] = 0
+    state['rn2'][rows, cols] = np.sqrt(var2)**2
+    near = dilate_pixels((rows, cols), 2, shape)
+    median_filter_patches(data_frame, state['abs_median'], 5, near, func=np.abs)
+    noise_raw = np.sqrt(state['abs_median'][near] + state['rn2'][near])
+    state['noise_raw'][near] = noise_raw
+    state['noise'][near] = np.where(noise_raw <= 0, state['noise_fill'], noise_raw)
+
+    # Fine structure model, within 1 and then 4 pixels of the changes.
+    if state['build_fine_structure']:
+        near3 = dilate_pixels((rows, cols), 1, shape)
+        median_filter_patches(data_frame, state['median3'], 3, near3)
+        near7 = dilate_pixels(near3, 3, shape)
+        median_filter_patches(state['median3'], state['median3_7'], 7, near7)
+        F_raw = state['median3'][near7] - state['median3_7'][near7]
+        state['F_raw'][near7] = F_raw
+        state['F'][near7] = np.where(F_raw <= 0, state['F_fill'], F_raw)
+
+    # Subsampled pixels (i, j) take data ((i+1)//2, (j+1)//2), so each changed pixel fills a 2x2 block.
+    sub, lap_img = state['subsample'], state['lap_img']
+    sub_rows = (2*rows[:, None] + np.array([[-1, -1, 0, 0]])).ravel()
+    sub_cols = (2*cols[:, None] + np.array([[-1, 0, -1, 0]])).ravel()
+    valid = (sub_rows >= 0) & (sub_cols >= 0)
+    sub_rows, sub_cols = sub_rows[valid], sub_cols[valid]
+    sub[sub_rows, sub_cols] = data_frame[(sub_rows + 1)//2, (sub_cols + 1)//2]
+
+    # The flattened Laplacian kernel reaches 3 pixels either way along the flattened subsample.
+    flat = np.unique(np.ravel_multi_index((sub_rows, sub_cols), sub.shape)[:, None] + np.arange(-3, 4))
+    flat = flat[(flat >= 0) & (flat < sub.size)]
+    convolve_patches(state['kernel'].astype(sub.dtype), sub.reshape(-1), lap_img.reshape(-1), flat)
+    lap_rows, lap_cols = np.unravel_index(flat, sub.shape)
+
+    # Resampled pixel (i, j) averages rows 2i-1, 2i and columns 2j-1, 2j, where -1 wraps to the last one.
+    res_rows, res_cols = (lap_rows + 1)//2, (lap_cols + 1)//2
+    row_options = (res_rows, np.where(lap_rows == sub.shape[0] - 1, 0, res_rows))
+    col_options = (res_cols, np.where(lap_cols == sub.shape[1] - 1, 0, res_cols))
+    res_rows = np.concatenate([r for r in row_options for c in col_options])
+    res_cols = np.concatenate([c for r in row_options for c in col_options])
+    valid = (res_rows < shape[0]) & (res_cols < shape[1])
+    res_rows, res_cols = dilate_pixels((res_rows[valid], res_cols[valid]), 0, shape)
+    i, j = 2*res_rows, 2*res_cols
+    state['resample'][res_rows, res_cols] = 0.25*(lap_img[i-1, j-1] +
+                                                  lap_img[i-1, j]   +
+                                                  lap_img[i, j-1]   +
+                                                  lap_img[i, j])
+
+    # Noise-normalised Laplacian where the resampled image or the noise changed, and its median within 2 pixels.
+    near_S = dilate_pixels((np.concatenate([res_rows, near[0]]), np.concatenate([res_cols, near[1]])), 0, shape)
+    state['S_raw'][near_S] = state['resample'][near_S]/(factor*state['noise'][near_S])
+    near_S = dilate_pixels(near_S, 2, shape)
+    median_filter_patches(state['S_raw'], state['S_median'], 5, near_S)
+    state['S'][near_S] = state['S_raw'][near_S] - state['S_median'][near_S]
+    return state
+
+def dilate_pixels(pixels, radius, shape):
+    '''
+    Returns every pixel within a square of the given radius of some pixels, without duplicates.
+
+    :param pixels: tuple of int arrays. Rows and columns of the pixels.
+    :param radius: int. Half width of the square. 0 only removes duplicates.
+    :param shape: tuple of int. Shape of the frame, which the result is clipped to.
+    :return: tuple of int arrays of rows and columns.
+    '''
+    offsets = np.arange(-radius, radius + 1)
+    rows = (pixels[0][:, None, None] + offsets[None, :, None] + 0*offsets[None, None, :]).ravel()
+    cols = (pixels[1][:, None, None] + 0*offsets[None, :, None] + offsets[None, None, :]).ravel()
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    flat = np.unique(np.ravel_multi_index((rows[inside], cols[inside]), shape))
+    return np.unravel_index(flat, shape)
+
+def median_filter_patches(source, out, size, pixels, tile=None, func=None):
+    '''
+    Recomputes median_filter(source, size) into out, only in the tiles that hold some pixels. Each
+    tile is filtered with a margin of size//2 pixels of source around it, so its values are the same
+    as those of the whole filtered image.
+
+    :param source: 2D array. Image to filter.
+    :param out: 2D array. Filtered image to update in place.
+    :param size: int. Size of the median filter.
+    :param pixels: tuple of int arrays. Rows and columns of the pixels that need updating.
+    :param tile: int or None. Side of the tiles. If None, use LED_TILE.
+    :param func: function or None. If given, filter func(source) instead, e.g. np.abs, applied to each tile only.
+    :return: out.
+    '''
+    tile = LED_TILE if tile is None else tile
+    margin = size//2
+    n_rows, n_cols = source.shape
+    tiles = np.unique(np.ravel_multi_index((np.asarray(pixels[0])//tile, np.asarray(pixels[1])//tile),
+                                           (-(-n_rows//tile), -(-n_cols//tile))))
+    for ti, tj in zip(*np.unravel_index(tiles, (-(-n_rows//tile), -(-n_cols//tile)))):
+        r0, r1 = ti*tile, min((ti + 1)*tile, n_rows)
+        c0, c1 = tj*tile, min((tj + 1)*tile, n_cols)
+        w0, w1 = max(r0 - margin, 0), min(r1 + margin, n_rows)
+        v0, v1 = max(c0 - margin, 0), min(c1 + margin, n_cols)
+        window = source[w0:w1, v0:v1] if func is None else func(source[w0:w1, v0:v1])
+        out[r0:r1, c0:c1] = median_filter(window, size=size)[r0-w0:r1-w0, c0-v0:c1-v0]
+    return out
+
+def convolve_patches(kernel, flat_source, flat_out, positions):
+    '''
+    Recomputes the clipped np.convolve(kernel, flat_source, mode='same') of led_intermediates into
+    flat_out, only at some positions. Nearby positions are grouped into runs, and each run is convolved
+    with a margin of the kernel half width, so every value is the same as that of the whole convolution.
+
+    :param kernel: 1D array. Kernel, of odd length.
+    :param flat_source: 1D array. Flattened subsampled frame.
+    :param flat_out: 1D array. Flattened Laplacian image to update in place, with negative values set to 0.
+    :param positions: 1D int array. Sorted positions that need updating.
+    :return: flat_out.
+    '''
+    half = len(kernel)//2
+    # Start a new run wherever the gap to the previous position is wider than the kernel.
+    breaks = np.flatnonzero(np.diff(positions) > len(kernel)) + 1
+    for run in np.split(positions, breaks):
+        p0, p1 = run[0], run[-1] + 1
+        s0, s1 = max(p0 - half, 0), min(p1 + half, len(flat_source))
+        # np.convolve swaps its inputs if the kernel is the longer one, so keep the run at least as long.
+        s0, s1 = max(min(s0, s1 - len(kernel)), 0), min(max(s1, s0 + len(kernel)), len(flat_source))
+        values = np.convolve(kernel, flat_source[s0:s1], mode='same')[p0-s0:p1-s0]
+        values[values < 0] = 0
+        flat_out[p0:p1] = values
+    return flat_out
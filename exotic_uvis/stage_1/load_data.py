@@ -1,52 +1,83 @@
 import numpy as np
 from astropy.io import fits
-from wfc3tools import sub2full
-import matplotlib.pyplot as plt
 import xarray as xr
 from tqdm import tqdm
 import os
+from exotic_uvis.stage_1.data_quality import packed_ones
+from exotic_uvis.stage_1.active_region import find_active_region
 
 
-def read_data(data_dir, verbose = 2):
+def read_spec_frame(path):
+
+    """
+
+    Function to read everything read_data needs from one specimages flt file into memory, so it
+    can run on a background thread
+
+    """
+
+    # run file through sub2full (imported here, as wfc3tools is slow to import)
+    from wfc3tools import sub2full
+
+    with fits.open(path) as hdul:
+        frame = dict(image = np.array(hdul[1].data), error = np.array(hdul[2].data),
+                     data_quality = np.array(hdul[3].data),
+                     exp_time = (hdul[0].header['EXPSTART'] + hdul[0].header['EXPEND'])/2,
+                     exp_time_UT = hdul[0].header['TIME-OBS'], exp_duration = hdul[0].header["EXPTIME"],
+                     ra_targ = hdul[0].header.get('RA_TARG', np.nan), dec_targ = hdul[0].header.get('DEC_TARG', np.nan))
+
+    frame['subarr_coords'] = np.array(sub2full(path, fullExtent=True)[0])
+
+    return frame
+
+
+def read_data(data_dir, verbose = 2, precision = 'float32', files = None, prefetch = 4, io_metrics = None):
 
     """
     
-    Function to load the data into a numpy array
+    Function to load the data into a numpy array. Images and errors are kept in the working
+    precision (float32 by default, the native precision of flt files; 'float64' is also accepted)
+    through every stage_1 function. If files is given, only those specimages files are loaded.
+    The next prefetch files are read on background threads while the current one is processed;
+    read-wait and compute times are added to io_metrics if it is given (see utils.new_io_metrics)
+    and printed if verbose = 2.
 
     """
 
+    from exotic_uvis.utils.fits_prefetch import prefetch_fits, new_io_metrics, print_io_metrics
+
     # initialize data structures
     images, errors, data_quality, subarr_coords = [], [], [], []
-    exp_time, exp_time_UT, exp_duration, read_noise = [], [], [], []
+    exp_time, exp_time_UT, exp_duration = [], [], []
+    has_data = None
+    if io_metrics is None:
+        io_metrics = new_io_metrics()
     
-    # iterate over all files in specs directory
+    # only open flt files in specs directory
     specs_dir = os.path.join(data_dir, 'specimages/')
-    files = np.sort(os.listdir(specs_dir))
-    
-    for filename in tqdm(files, 'Loading data... Progress:', disable = verbose == 0):
-   
-        # only open flt files 
-        if filename[-9:] == '_flt.fits':
+    files = np.sort(os.listdir(specs_dir) if files is None else files)
+    paths = [os.path.join(specs_dir, filename) for filename in files if filename[-9:] == '_flt.fits']
 
-            # open file and save image and error
-            with fits.open(os.path.join(specs_dir, filename)) as hdul:
-                image = np.array(hdul[1].data)
-                error = np.array(hdul[2].data)
+    frames = prefetch_fits(paths, read_spec_frame, depth = prefetch, metrics = io_metrics)
+    for path, frame in tqdm(frames, 'Loading data... Progress:', total = len(paths), disable = verbose == 0):
 
-                #print(repr(hdul[0].header))
-                exp_time.append((hdul[0].header['EXPSTART'] + hdul[0].header['EXPEND'])/2)
-                exp_time_UT.append((hdul[0].header['TIME-OBS']))
-                data_quality.append(hdul[3].data)
-                exp_duration.append(hdul[0].header["EXPTIME"])
+        # append data
+        image = frame['image']
+        images.append(image)
+        errors.append(frame['error'])
+        data_quality.append(frame['data_quality'])
+        subarr_coords.append(frame['subarr_coords'])
+        exp_time.append(frame['exp_time'])
+        exp_time_UT.append(frame['exp_time_UT'])
+        exp_duration.append(frame['exp_duration'])
+        target_coords = (frame['ra_targ'], frame['dec_targ'])
 
-                #run file through sub2full
-                y1,y2,x1,x2 = sub2full(os.path.join(specs_dir, filename), fullExtent=True)[0]
-                
-                # append data
-                images.append(image) 
-                errors.append(error) 
-                read_noise.append(np.median(np.sqrt(error**2 - image))) 
-                subarr_coords.append(np.array([y1,y2,x1,x2]))
+        # track which pixels hold data in any frame
+        frame_has_data = (image != 0) & np.isfinite(image)
+        has_data = frame_has_data if has_data is None else has_data | frame_has_data
+
+    if verbose == 2:
+        print_io_metrics(io_metrics, 'Loaded')
 
 
 
@@ -65,14 +96,25 @@ def read_data(data_dir, verbose = 2):
                 target_posy = (direct_image.shape[0])/2 - hdul[0].header['POSTARG2']
 
 
-    # Create x-array
+    # stack the frames in the working precision
+    images = np.asarray(images, dtype = precision)
+    errors = np.asarray(errors, dtype = precision)
+    direct_image = np.asarray(direct_image, dtype = precision)
+
+    # find the region of the frame that holds data once, so the stages can skip the padding
+    active_region = find_active_region(has_data, subarr_coords[0])
+    rows, cols = slice(*active_region[:2]), slice(*active_region[2:])
+    read_noise = np.median(np.sqrt(errors[:, rows, cols]**2 - images[:, rows, cols]), axis = (1, 2))
+
+    # Create x-array, with the (all good) bad pixel mask stored bit-packed along y
     obs = xr.Dataset(
         data_vars=dict(
             images=(["exp_time", "x", "y"], images),
             errors=(["exp_time", "x", "y"], errors),
             subarr_coords=(["exp_time", "index"],subarr_coords),
             direct_image = (["x", "y"], direct_image),
-            badpix_mask = (["exp_time", "x", "y"], np.ones_like(images, dtype = 'bool')),
+            badpix_mask = (["exp_time", "x", "packed_y"], packed_ones(np.shape(images)),
+                           dict(unpacked_size = np.shape(images)[2])),
             data_quality = (["exp_time", "x", "y"], data_quality),
             read_noise = (['exp_time'], read_noise)
         ),
@@ -84,7 +126,42 @@ def read_data(data_dir, verbose = 2):
         attrs = dict(
             target_posx = target_posx,
             target_posy = target_posy,
+            ra_targ = target_coords[0],
+            dec_targ = target_coords[1],
+            precision = np.dtype(precision).name,
+            active_region = active_region,
         )
     )
 
     return obs
+
+
+def save_obs(obs, path):
+
+    """
+    
+    Function to save the obs Dataset to a netCDF file
+
+    """
+
+    # netCDF3 has no unsigned bytes, so the bit-packed mask is stored as signed bytes
+    obs = obs.copy()
+    obs['badpix_mask'] = obs.badpix_mask.copy(data = obs.badpix_mask.values.view(np.int8))
+    obs.to_netcdf(path)
+
+    return path
+
+
+def load_obs(path):
+
+    """
+    
+    Function to load an obs Dataset saved by save_obs into memory
+
+    """
+
+    with xr.open_dataset(path) as saved:
+        obs = saved.load()
+    obs['badpix_mask'] = obs.badpix_mask.copy(data = obs.badpix_mask.values.view(np.uint8))
+
+    return obs
@@ -0,0 +1,68 @@
+import io
+import contextlib
+import numpy as np
+
+
+def set_precision(obs, precision='float32'):
+    '''
+    Returns a copy of obs with its images, errors, and direct image cast to the working precision.
+
+    :param obs: xarray. Its obs.images and obs.errors DataSets are cast.
+    :param precision: str or dtype. Working precision, e.g. 'float32' or 'float64'.
+    :return: new obs in the requested precision.
+    '''
+    obs = obs.copy(deep=True)
+    for var in ('images', 'errors', 'direct_image'):
+        if var in obs:
+            obs[var] = obs[var].astype(precision)
+    obs.attrs['precision'] = np.dtype(precision).name
+    return obs
+
+
+def precision_report(obs, stages, precision='float32', reference='float64', verbose=True):
+    '''
+    Runs the same sequence of stage_1 functions at two working precisions and reports the science impact.
+
+    :param obs: xarray. Loaded data, e.g. from read_data. It is not modified.
+    :param stages: lst of (function, dict) pairs. Each function is called as function(obs, **kwargs), in order.
+    :param precision: str or dtype. Working precision to validate.
+    :param reference: str or dtype. Precision to compare against.
+    :param verbose: bool. If True, print the report.
+    :return: dict of metrics comparing the final images, flags, and white light fluxes.
+    '''
+    results = {}
+    for dtype in (reference, precision):
+        run = set_precision(obs, dtype)
+        # The stages report their own progress, which is not useful twice over.
+        with contextlib.redirect_stdout(io.StringIO()):
+            for stage, kwargs in stages:
+                stage(run, **kwargs)
+        results[dtype] = run
+
+    ref, test = results[reference], results[precision]
+    ref_images = ref.images.values.astype(np.float64)
+    test_images = test.images.values.astype(np.float64)
+    diff = np.abs(test_images - ref_images)
+
+    # The white light flux of each frame, accumulated in float64 for both runs.
+    ref_flux = np.nansum(ref_images, axis=(1, 2))
+    test_flux = np.nansum(test_images, axis=(1, 2))
+
+    report = dict(
+        max_abs_diff=float(np.nanmax(diff)),
+        rms_diff_over_noise=float(np.sqrt(np.nanmean(diff**2))/np.nanmedian(ref.errors.values)),
+        white_light_ppm=float(np.nanmax(np.abs(test_flux/ref_flux - 1))*1e6),
+        flag_mismatch=int(np.count_nonzero(ref.data_quality.values != test.data_quality.values)),
+        memory_MB={dtype: (run.images.nbytes + run.errors.nbytes)/1e6 for dtype, run in results.items()},
+    )
+
+    if verbose:
+        print("Precision report: %s against %s reference" % (np.dtype(precision).name, np.dtype(reference).name))
+        print("  Max absolute pixel difference: %.3e" % report['max_abs_diff'])
+        print("  RMS difference / median error: %.3e" % report['rms_diff_over_noise'])
+        print("  Max white light flux difference: %.3f ppm" % report['white_light_ppm'])
+        print("  Pixels with different data quality flags: %.0f" % report['flag_mismatch'])
+        for dtype, mb in report['memory_MB'].items():
+            print("  Images + errors in %s: %.1f MB" % (np.dtype(dtype).name, mb))
+
+    return report
@@ -0,0 +1,680 @@
+import numpy as np
+import xarray as xr
+import matplotlib.pyplot as plt
+from tqdm import tqdm
+from astropy.io import fits
+from scipy.ndimage import median_filter
+from scipy.optimize import least_squares
+from scipy.optimize import curve_fit
+from photutils.centroids import centroid_com
+from exotic_uvis.plotting import plot_exposure, plot_corners
+
+# Frozen reference implementations of the stage_1 kernels, used by equivalence_report to check that
+# optimised stages still give the same science. Each function below is copied verbatim from the
+# stage_1 modules as they were before any optimisation (the per-pixel loops, whole-frame filters, and
+# DQ values included), and must not be changed when a stage is changed. The intended differences of
+# the stages are listed in equivalence.COMPARISON_EXEMPTIONS instead.
+
+
+# Copied from stage_1/laplacian_edge_detection.py
+
+def laplacian_edge_detection(obs, sigma=10, factor=2, n=2, build_fine_structure=False, contrast_factor=5):
+    '''
+    Convolves a Laplacian kernel with the obs.images to replace spatial outliers with
+    the median of the surrounding 3x3 kernel.
+    
+    :param obs: xarray. Its obs.images DataSet contains the images, and its obs.errors DataSet is used to estimate readnoise. The obs.data_quality DataSet will be updated where outliers are detected.
+    :param sigma: float. Threshold of deviation from median of Laplacian image, above which a pixel will be flagged as an outlier and masked.
+    :param factor: int. Factor by which to resample the array. Must be at least 2.
+    :param n: int. Times to iterate over the data. If None, iterate until no new outliers are flagged.
+    :param build_fine_structure: bool. If True, builds a fine structure model which protects data that varies on small lengthscales from being attacked by LED.
+    :param contrast_factor: float. If build_fine_structure is True, this is the threshold of deviation we need to exceed in L+/F to flag outliers.
+    :return: obs xarray with outliers removed and data quality flags updated.
+    '''
+    # Define the Laplacian kernel.
+    l = 0.25*np.array([[0,-1,0],[-1,4,-1],[0,-1,0]])
+
+    # Iterate over each frame one at a time until the iteration stop condition is met by each frame.
+    print("Cleaning threshold=%.1f outliers with Laplacian edge detection..." % sigma)
+    for k in range(obs.images.shape[0]):
+        # Get the frame, errors, and dq array as np.array objects so we can operate on them.
+        data_frame = obs.images[k].values
+        errs = obs.errors[k].values
+        dq = obs.data_quality[k].values
+
+        # Track outliers flagged in this frame and iterations performed.
+        bad_pix_removed = 0
+        iteration_N = 1
+
+        # Then start iterating over this frame and keep going until the iteration stop condition is met.
+        stop_iterating = False
+        while not stop_iterating:
+            # Estimate readnoise value.
+            var2 = errs**2 - data_frame
+            var2[var2 < 0] = 0 # enforce positivity.
+            rn = np.sqrt(var2) # estimate readnoise array
+
+            # Build the noise model.
+            noise_model = build_noise_model(data_frame, rn)
+            if build_fine_structure:
+                F = build_fine_structure_model(data_frame)
+
+            # Subsample the array.
+            subsample, original_shape = subsample_frame(data_frame, factor=factor)
+            
+            # Convolve subsample with laplacian.
+            lap_img = np.convolve(l.flatten(),subsample.flatten(),mode='same').reshape(subsample.shape)
+            lap_img[lap_img < 0] = 0 # force positivity
+            
+            # Resample laplacian-convolved subsampled image to original size.
+            resample = resample_frame(lap_img, original_shape)
+
+            # Divide by the noise model scaled by the resampling factor.
+            S = resample/(factor*noise_model)
+            
+            # Remove sampling flux to protect data from being targeted by LED.
+            S = S - median_filter(S, size=5)
+
+            # Spot outliers.
+            S[np.abs(S) < sigma] = 0 # any not zero after this are rays.
+            S[S!=0] = 1 # for visualization and comparison to fine structure model.
+
+            # If we have a fine structure model, we also need to check the contrast.
+            if build_fine_structure:
+                contrast_image = resample/F
+                contrast_image[contrast_image < contrast_factor] = 0 # any not zero after this are rays.
+                contrast_image[contrast_image!=0] = 1 # for visualization and comparison to sampling flux model.
+                
+                # Then we need to merge the results of S = Laplacian_image/factor*noise_model - sampling_flux
+                # and contrast_image = Laplacian_image/Fine_structure_model so that we only take where both are 1.
+                S = np.where(S == contrast_image, S, 0)
+
+            # Ignore the 0th order, it's a dead end of endless masking.
+            xmid = int(S.shape[1]/2)
+            S[0:-1,xmid-70:xmid+70] = 0 # FIX: currently hardcoded to assume the source / 0th order is near the middle of the frame.
+
+            # Report where data quality flags should be added and count pixels to be replaced.
+            dq = np.where(S != 0, 1, dq)
+            bad_pix_last_frame = -100
+            if iteration_N != 1:
+                bad_pix_last_frame = bad_pix_this_frame
+            bad_pix_this_frame = np.count_nonzero(S)
+            bad_pix_removed += bad_pix_this_frame
+
+            # Report progress.
+            print("Bad pixels removed on iteration %.0f: %.0f" % (iteration_N, bad_pix_this_frame))
+
+            # Correct frames.
+            med_filter_image = median_filter(data_frame,size=5)
+            data_frame = np.where(S != 0, med_filter_image, data_frame)
+
+            # Increment iteration number and check if condition to stop iterating is hit.
+            iteration_N += 1
+            if (n != None and iteration_N > n): # if it has hit the iteration cap
+                stop_iterating = True
+            if (n == None and bad_pix_this_frame == bad_pix_last_frame): # if it has stalled out on finding new outliers
+                stop_iterating = True
+            
+        print("Finished cleaning frame %.0f in %.0f iterations." % (k, iteration_N-1))
+        print("Total pixels corrected: %.0f out of %.0f" % (bad_pix_removed, S.shape[0]*S.shape[1]))
+        # Now replace the xarray datasets with the corrected frame and updated dq array.
+        obs.images[k] = obs.images[k].where(obs.images[k].values == data_frame,data_frame)
+        obs.data_quality[k] = obs.data_quality[k].where(obs.data_quality[k].values == dq,dq)
+    print("All frames cleaned of spatial outliers by LED.")
+    return obs
+
+def build_noise_model(data_frame, readnoise):
+    '''
+    Builds a noise model for the given data frame, following van Dokkum 2001 methods.
+
+    :param data_frame: 2D array. Frame from the images DataSet, used to build the noise model.
+    :param readnoise: float. Readnoise estimated to be in the data frame.
+    :return: 2D array same size as the data frame, a noise model describing noise in the frame.
+    '''
+    noise_model = np.sqrt(median_filter(np.abs(data_frame),size=5)+readnoise**2)
+    noise_model[noise_model <= 0] = np.mean(noise_model) # really want to avoid nans
+    return noise_model
+
+def subsample_frame(data_frame, factor=2):
+    '''
+    Subsamples the input frame by the given subsampling factor.
+
+    :param data_frame: 2D array. Frame from the DN array.
+    :param factor: int >= 2. Factor by which to subsample the array.
+    :return: 2D array same shape as data frame, subsampled by factor.
+    '''
+    if factor < 2:
+        print("Subsampling factor must be at least 2, forcing factor to 2...")
+        factor = 2 # Force factor 2 or more
+    factor = int(factor) # Force integer
+    
+    original_shape = np.shape(data_frame)
+    ss_shape = (original_shape[0]*factor,original_shape[1]*factor)
+    subsample = np.empty(ss_shape)
+    
+    # Subsample the array.
+    for i in range(ss_shape[0]):
+        for j in range(ss_shape[1]):
+            try:
+                subsample[i,j] = data_frame[int((i+1)/2),int((j+1)/2)]
+            except IndexError:
+                subsample[i,j] = 0
+    return subsample, original_shape
+
+def resample_frame(data_frame, original_shape):
+    '''
+    Resamples a subsampled array back to the original shape.
+
+    :param data_frame: 2D array. Subsampled frame from the images DataSet.
+    :param original_shape: tuple of int. Original shape of the subsampled array.
+    :return: 2D array with original shape resampled from the data frame.
+    '''
+    resample = np.empty(original_shape)
+    for i in range(original_shape[0]):
+        for j in range(original_shape[1]):
+            resample[i,j] = 0.25*(data_frame[2*i-1,2*j-1] +
+                                  data_frame[2*i-1,2*j]   +
+                                  data_frame[2*i,2*j-1]   +
+                                  data_frame[2*i,2*j])
+    return resample
+
+def build_fine_structure_model(data_frame):
+    '''
+    Builds a fine structure model for the data frame.
+
+    :param data_frame: 2D array. Native resolution data.
+    :return: 2D array of fine structure model.
+    '''
+    F = median_filter(data_frame, size=3) - median_filter(median_filter(data_frame, size=3), size=7)
+    F[F <= 0] = np.mean(F) # really want to avoid nans
+    return F
+
+
+# Copied from stage_1/temporal_outlier_rejection.py
+
+def fixed_iteration_rejection(obs, sigmas=[10,10], replacement=None):
+    '''
+    Iterates a fixed number of times using a different sigma at each iteration to reject cosmic rays.
+
+    :param obs: xarray. Its obs.images DataSet contains the images.
+    :param sigmas: lst of int. Sigma to use for each iteration. len(sigmas) is the number of iterations that will be run.
+    :param_replacement: int or None. If None, replace outlier pixels with median in time. If int, replace with median of int values either side in time.
+    :return: obs with cosmic rays removed.
+    '''
+    # Track pixels corrected.
+    bad_pix_removed = 0
+    # Iterate over each sigma.
+    for j, sigma in enumerate(sigmas):
+        # Get the median time frame and std as a reference.
+        d_all = obs.images[:].values
+        med = np.median(d_all,axis=0)
+        std = np.std(d_all,axis=0)
+
+        # Track outliers flagged by this sigma.
+        bad_pix_this_sigma = 0
+
+        # Then check over frames and see where outliers are.
+        for k in tqdm(range(obs.images.shape[0]), desc = "Correcting for %.0fth sigma... Progress:" % j):
+            # Get the frame and dq array as np.array objects so we can operate on them.
+            d = obs.images[k].values
+            dq = obs.data_quality[k].values
+            S = np.where(np.abs(d - med) > sigma*std, 1, 0)
+            
+            # Report where data quality flags should be added and count pixels to be replaced.
+            dq = np.where(S != 0, 1, dq)
+            bad_pix_this_frame = np.count_nonzero(S)
+            bad_pix_this_sigma += bad_pix_this_frame
+
+            # If replacement is not None, custom replacement.
+            correction = med
+            if replacement:
+                # Take the median of the frames that are +/- replacement away from the current frame.
+                l = k - replacement
+                r = k + replacement
+                # Cut at edges.
+                if l < 0:
+                    l = 0
+                if r > obs.images.shape[0]:
+                    r = obs.images.shape[0]
+                correction = np.median(d_all[l:r,:,:],axis=0)
+            # Correct frame and replace obs.images frame with the new array.
+            d = np.where(S == 1, correction, d)
+            obs.images[k] = obs.images[k].where(obs.images[k].values == d,d)
+            obs.data_quality[k] = obs.data_quality[k].where(obs.data_quality[k].values == dq,dq)
+        
+        print("Bad pixels removed on iteration %.0f with sigma %.2f: %.0f" % (j, sigma, bad_pix_this_sigma))
+        bad_pix_removed += bad_pix_this_sigma
+    print("All iterations complete. Total pixels corrected: %.0f out of %.0f" % (bad_pix_removed, S.shape[0]*S.shape[1]))
+    return obs
+
+
+def array1D_clip(array, threshold = 3.5, mode = 'median'): 
+
+    """
+
+    Function to detect and replace outliers in a 1D array above or below a certain sigma threshold imposed
+
+    
+    """
+    
+    # define outlier flag and mask
+    found_outlier = 1
+    mask = np.ones_like(array).astype(bool)
+
+    # iterate while flag is true
+    while found_outlier:
+        
+        # compute median and std of masked array
+        n_hits = np.sum(mask)
+        median = np.median(array[mask])
+        sigma = np.std(array[mask])
+
+        # mask values below threshold
+        mask = np.abs(array - median) < threshold * sigma     
+        found_outlier = n_hits - np.sum(mask)
+    
+    # replace masked values with median
+    array[~mask] = median
+
+    return array, ~mask
+
+
+def free_iteration_rejection(obs, threshold = 3.5, plot = False, check_all = False):
+
+    """
+
+    Function to replace outliers in the temporal dimension
+    
+    """
+    
+    # copy images and define hit map
+    images = obs.images.data.copy()
+    hit_map = np.zeros_like(images)
+
+    # iterate over all rows
+    for i in tqdm(range(obs.dims['x']), desc = 'Removing cosmic rays and bad pixels... Progress:'):
+
+        #iterate over all columns
+        for j in range(obs.dims['y']):
+            
+            # check that sum of pixel along temporal dimension is non-zero (i.e., that the pixel is inside the subarray)
+            if np.sum(images[:, i, j]):
+                _, hit_map[:, i, j] = array1D_clip(images[:, i, j], threshold, mode = 'median')
+    
+    # if true, plot one exposure and draw location of all detected cosmic rays in all exposures
+    if plot:
+        thits, xhits, yhits = np.where(hit_map == 1)
+        plot_exposure([obs.images.data[0], images[0]], min = 0, title = 'Temporal Bad Pixel removal Example')
+        plot_exposure([obs.images.data[0]], scatter_data=[yhits, xhits], min = 0, title = 'Location of corrected pixels', mark_size = 1)
+
+    # if true, check each exposure separately
+    if check_all:
+        for i in range(len(images)):
+            xhits, yhits = np.where(hit_map[i] == 1)
+            plot_exposure([obs.images.data[i]], scatter_data=[yhits, xhits], min = 0)
+    
+    # modify original images
+    obs.images.data = images
+
+    return 0
+
+
+# Copied from stage_1/bckg_subtract.py
+
+def full_frame_bckg_subtraction(obs, bin_number=1e5, fit='coarse', value='mode'):
+    '''
+    Extracts the mode or median from the full frame and subtracts this value from the image.
+
+    :param obs: xarray. Its obs.images DataSet contains the images.
+    :param bin_number: int. Number of bins used to construct the histogram.
+    :param fit: str. Options are 'coarse' (use the raw histogram) or 'fine' (fit a Gaussian to the histogram). Only matters if taking the mode of the frame.
+    :param value: str. Options are 'mode' (take the mode of the frame) or 'median' (take the median of the frame).
+    :return: obs with sky-corrected images DataSet.
+    '''
+    # Track background values.
+    bckgs = []
+
+    # Ensure bin_number cannot break image.
+    d_test = obs.images[0].values
+    N_vals = d_test.shape[0]*d_test.shape[1]
+    if bin_number > N_vals:
+        print("Bin number should not exceed number of pixels to bin, reducing bin number to number of available pixels...")
+        bin_number = N_vals
+    
+    # Iterate through frames.
+    for k in range(obs.images.shape[0]):
+        # Load the array and take only its finite (non-NaN) values.
+        d = obs.images[k].values
+        finite = d[np.isfinite(d)]
+
+        # If you want the median, take it here.
+        if value == 'median':
+            print('did median')
+            bckg = np.median(finite)
+            bckgs.append(bckg)
+        
+        elif value == 'mode':
+            # Build the histogram of the frame out of its finite (non-NaN) values.
+            hist, bin_edges = np.histogram(finite, bins=int(bin_number))
+
+            # If you want a coarse mode, take it here.
+            if fit == 'coarse':
+                ind = np.argmax(hist)
+                bckg = (bin_edges[ind]+bin_edges[ind+1])/2
+                bckgs.append(bckg)
+
+            # Else, take the fit.
+            elif fit == 'fine':
+                # For Carlos!
+                bckgs.append(bckg)
+
+        # Build a frame to correct the data with.
+        d -= bckgs[k]*np.ones_like(d)
+
+        # Replace the obs.image with the corrected frame.
+        obs.images[k] = obs.images[k].where(obs.images[k].values == d, d)
+    print("All frames sky-subtracted by {} {} method.".format(fit, value))
+    return obs, bckgs
+
+
+def Pagul_bckg_subtraction(obs, Pagul_path, masking_parameter=0.001, median_on_columns=True):
+    '''
+    Scales the Pagul+ 2023 G280 sky image to each frame and subtracts the scaled image as background.
+
+    :param obs: xarray. Its obs.images DataSet contains the images.
+    :param Pagul_path: str. Path to the Pagul+ 2023 bckg image.
+    :param masking_parameter: float. How aggressively to mask the source. Values of 0.001 or less recommended. A good value should make the Pagul scaling parameters similar to the frame mode.
+    :param median_on_columns: bool. If True, take the median value of the Pagul+ 2023 sky image along columns. Approximately eliminates contamination from poorly-sampled parts of sky.
+    :return: obs with sky-corrected images DataSet.
+    '''
+    # Open the Pagul+ 2023 sky image.
+    with fits.open(Pagul_path) as fits_file:
+        Pagul_bckg = fits_file[0].data
+        if median_on_columns:
+            Pagul_bckg = np.array([np.median(Pagul_bckg,axis=0),]*np.shape(Pagul_bckg)[0])
+    
+    # Track scaling parameters. Should be ~equal to the frame mode.
+    scaling_parameters = []
+    modes = []
+    # Iterate through frames.
+    for k in range(obs.images.shape[0]):
+        # Load the array.
+        d = obs.images[k].values
+        x1,x2,y1,y2 = obs.subarr_coords[k].values
+
+        # First, get the coarse frame mode and standard deviation using the frame's finite values.
+        finite = d[np.isfinite(d)]
+        hist, bin_edges = np.histogram(finite, bins=10**6)
+        ind = np.argmax(hist)
+        mode = (bin_edges[ind]+bin_edges[ind+1])/2
+        sig = np.nanstd(finite)
+
+        modes.append(mode)
+
+        # Next, mask any sources in the frame using the frame mode and standard deviation.
+        masked_frame = np.ma.masked_where(np.abs(d - mode) > masking_parameter*sig, d)
+    
+        # Then fit the standard bckg to the masked frame.
+        def residuals_(A,x,y):
+            return np.ma.sum((y - (A*x))**2)
+        result = least_squares(residuals_, 1, args=(Pagul_bckg[y1:y2+1,x1:x2+1], masked_frame))
+        A = result.x[0]
+
+        # Store the scaling parameter and subtract the sky.
+        scaling_parameters.append(A)
+        d -= A*Pagul_bckg[y1:y2+1,x1:x2+1]
+
+        # Replace the obs.image with the corrected frame.
+        obs.images[k] = obs.images[k].where(obs.images[k].values == d, d)
+    print("All frames sky-subtracted by Pagul+ 2023 method.")
+    return obs, scaling_parameters, modes
+
+
+def Gauss1D(x, H, A, x0, sigma):
+
+    """
+
+    Function to return a 1D Gaussian profile 
+
+    """
+
+    return H + A * np.exp(-(x - x0) ** 2 / (2 * sigma ** 2))
+
+
+def calculate_mode(array, hist_min, hist_max, hist_bins, fit = None, check_all = False):
+
+    """
+    
+    Function to return the mode of an image
+    
+    """
+
+    # create a histogram of counts 
+    hist, bin_edges = np.histogram(array, bins = np.linspace(hist_min, hist_max, hist_bins))
+    bin_cents = (bin_edges[:-1] + bin_edges[1:])/2
+
+    # if true, fit gaussian to histogram and find center
+    if fit == 'Gaussian':
+        # fit a Gaussian profile
+        popt, pcov = curve_fit(Gauss1D, 
+                                bin_cents, 
+                                hist, 
+                                p0 = [0, np.amax(hist), bin_cents[np.argmax(hist)], (hist_max - hist_min)/4],
+                                maxfev = 2000)
+        
+        bkg_val = popt[2]
+
+    elif fit == 'Median':
+        bkg_val = np.median(array)
+
+    else:
+        bkg_val = (bin_edges[np.argmax(hist)] + bin_edges[np.argmax(hist) + 1])/2
+    
+    # if true, plot histrogram and location of maximum
+    if check_all:
+        plt.figure(figsize = (10, 7))
+        plt.hist(array, bins = np.linspace(hist_min, hist_max, hist_bins), color = 'indianred', alpha = 0.7, density=False)
+        plt.axvline(bkg_val, color = 'gray', linestyle = '--')
+
+        if fit ==  'Gaussian':
+            plt.plot(bin_cents, Gauss1D(bin_cents, popt[0], popt[1], popt[2], popt[3]))
+
+        plt.axvline(np.median(array), linestyle = '--', color = 'black')
+        plt.axvline((bin_edges[np.argmax(hist)] + bin_edges[np.argmax(hist) + 1])/2, linestyle = '--', color = 'blue')
+        plt.xlabel('Pixel Value')
+        plt.ylabel('Counts')
+        #plt.savefig('PLOTS/bkg_KELT7b_3.png', bbox_inches = 'tight', dpi = 300)
+        plt.show()
+
+    return bkg_val
+
+
+def corner_bkg_subtraction(obs, plot = False, check_all = False, fit = None, 
+                           bounds = None, hist_min = -60, hist_max = 60, hist_bins = 1000):
+
+    """
+
+    Function to remove the background flux
+
+    """
+
+    # copy images
+    images = obs.images.data.copy() 
+
+    # initialize background values
+    bkg_vals = []
+
+    # iterate over all images
+    for i, image in enumerate(tqdm(images, desc = 'Removing background... Progress:')):
+        
+        # calculate image background from histogram
+        if bounds:
+            if len(bounds) == 1:
+                bound = bounds[0]
+                img_bkg = calculate_mode(image[bound[0]:bound[1], bound[2]:bound[3]].flatten(), 
+                                         hist_min, hist_max, hist_bins, fit = fit, check_all = check_all)
+            else:
+                image_vals = []
+
+                for bound in bounds:       
+                    image_vals = np.concatenate((image_vals, image[bound[0]:bound[1], bound[2]:bound[3]].flatten()))
+
+                img_bkg = calculate_mode(image_vals, hist_min, hist_max, hist_bins, fit = fit, check_all = check_all)
+                
+        else:
+            img_bkg = calculate_mode(image.flatten(), hist_min, hist_max, hist_bins, fit = fit, check_all = check_all)
+
+        # append background value
+        bkg_vals.append(img_bkg)
+        
+        # substract background from image
+        image -= img_bkg
+
+    # save background values
+    obs['bkg_vals'] = xr.DataArray(data = bkg_vals, dims = ['exp_time'])
+
+    # if true, plot calculated background values
+    if plot:
+
+        plot_corners([images[0]], bounds)
+
+        plt.figure(figsize = (10, 7))
+        plt.plot(range(obs.dims['exp_time']), bkg_vals, '-o')
+        plt.xlabel('Exposure')
+        plt.ylabel('Background Counts')
+        plt.title('Image background per exposure')
+        plt.show()
+
+        plot_exposure([obs.images.data[1], images[1]], title = 'Background Removal Example')
+
+    obs.images.data = images
+
+    return 0
+
+
+# Copied from stage_1/COM_track0th.py
+
+def track0th(obs, guess):
+    '''
+    Tracks the 0th order through all frames using centroiding.
+    
+    :param obs: xarray. Its obs.images DataSet contains the images.
+    :param guess: lst of float. Initial x, y position guess for the 0th order's location.
+    :return: location of the direct image in x, y floats.
+    '''    
+    # Correct direct image guess to be appropriate for spec images.
+    # FIX: hardcoded based on WASP-31 test. There must be a better way...
+    guess[0] += 100
+    guess[1] += 150
+
+    # Open lists of position.
+    X, Y = [], []
+    for k in range(obs.images.shape[0]):
+        # Open the kth image.
+        d = obs.images[k].values
+
+        # Unpack guess and integerize it.
+        x0, y0 = [int(i) for i in guess]
+
+        # Clip a window near the guess.
+        window = d[y0-70:y0+70,x0-70:x0+70]
+
+        # Centroid the window.
+        xs, ys = centroid_com(window)
+        print(xs, ys)
+
+        # Return to native window.
+        xs += x0 - 70
+        ys += y0 - 70
+        
+        # Take the source.
+        X.append(xs)
+        Y.append(ys)
+    print("Tracked 0th order in %.0f frames." % obs.images.shape[0])
+    return X, Y
+
+
+# Copied from stage_1/compute_displacements.py
+
+def track_bkgstars(obs, bkg_stars, window = 15, plot = False, check_all = False):
+
+    """
+    
+    Function to compute the x & y displacement of a given background star
+    
+    """
+
+    # intialize and copy images
+    stars_pos, abs_pos = [], []
+    images = obs.images.data.copy()
+
+    # iterate over all listed background stars
+    for i, pos_init in enumerate(bkg_stars):
+        
+        # initialize position
+        pos = []
+
+        # get window limits
+        x0, xf = pos_init[0] - window, pos_init[0] + window
+        y0, yf = pos_init[1] - window, pos_init[1] + window
+
+        # iterate over all images
+        for image in images:
+
+            # define region around background star
+            sub_image = image[y0:yf, x0:xf]
+            
+            # compute centroid
+            x1, y1 = centroid_com(sub_image)
+
+            # append location
+            pos.append([x0 + x1, y0 + y1])
+        
+        rel_pos = np.array(pos) - pos[0]
+        
+        if check_all:
+            plot_exposure([images[0]], scatter_data = [x0 + x1, y0 + y1])
+
+        # save background star location as a function of time
+        obs["star{}_disp".format(i)] = (("exp_time", "xy"), rel_pos)
+        stars_pos.append(rel_pos)
+        abs_pos.append(pos)
+
+    stars_pos = np.array(stars_pos)
+    mean_pos = np.mean(stars_pos, axis = 0)
+
+    obs["meanstar_disp"] = (("exp_time", "xy"), mean_pos)
+    
+    # if true, plot the calculated displacements
+    if plot:
+        mean_loc = list(np.mean(abs_pos, axis = 1).transpose())
+
+        plot_exposure([image], scatter_data = mean_loc, title = 'Location of background stars')
+      
+        plt.figure(figsize = (10, 7))
+        plt.plot(obs.exp_time.data, mean_pos[:, 0], '-o')
+        plt.plot(obs.exp_time.data, np.transpose(stars_pos[:, :, 0]), '-o', alpha = 0.5)
+        plt.xlabel('Exposure times')
+        plt.ylabel('X pixel displacement')
+
+        plt.figure(figsize = (10, 7))
+        plt.plot(obs.exp_time.data, mean_pos[:, 1], '-o')
+        plt.plot(obs.exp_time.data, np.transpose(stars_pos[:, :, 1]), '-o', alpha = 0.5)
+        plt.xlabel('Exposure times')
+        plt.ylabel('Y pixel displacement')
+        plt.show()
+
+    return pos
+
+
+# Reference for each stage, by stage_1 name.
+REFERENCE_KERNELS = {
+    'laplacian_edge_detection': laplacian_edge_detection,
+    'fixed_iteration_rejection': fixed_iteration_rejection,
+    'free_iteration_rejection': free_iteration_rejection,
+    'full_frame_bckg_subtraction': full_frame_bckg_subtraction,
+    'corner_bkg_subtraction': corner_bkg_subtraction,
+    'Pagul_bckg_subtraction': Pagul_bckg_subtraction,
+    'track0th': track0th,
+    'track_bkgstars': track_bkgstars,
+}
@@ -1,24 +1,40 @@
 import numpy as np
+import xarray as xr
 from tqdm import tqdm
-from exotic_uvis.plotting import plot_exposure, plot_corners
+from exotic_uvis.stage_1.data_quality import set_dq_flags, flag_badpix, OUTLIER_FLAG
+from exotic_uvis.stage_1.active_region import active_slices
+from exotic_uvis.utils.robust_stats import nanmedian, nanstd, sigma_clip
+from exotic_uvis.utils.chunk_planner import plan_stage_chunks
 
-def fixed_iteration_rejection(obs, sigmas=[10,10], replacement=None):
+def fixed_iteration_rejection(obs, sigmas=[10,10], replacement=None, memory_budget=None):
     '''
     Iterates a fixed number of times using a different sigma at each iteration to reject cosmic rays.
 
     :param obs: xarray. Its obs.images DataSet contains the images.
     :param sigmas: lst of int. Sigma to use for each iteration. len(sigmas) is the number of iterations that will be run.
     :param_replacement: int or None. If None, replace outlier pixels with median in time. If int, replace with median of int values either side in time.
+    :param memory_budget: int, str, or None. Memory allowed for the temporaries of the median and std, e.g. '2GB' or 'auto', see utils.parse_memory. They are then computed in bands of rows. If None, all at once.
     :return: obs with cosmic rays removed.
     '''
     # Track pixels corrected.
     bad_pix_removed = 0
+    # Only the active region of the frames holds data.
+    rows, cols = active_slices(obs)
+    # The statistics are per pixel, so they can be computed in bands of rows that fit the budget.
+    bands = plan_stage_chunks('fixed_iteration_rejection', obs.images.shape, obs.images.dtype, memory_budget, (rows, cols))
     # Iterate over each sigma.
     for j, sigma in enumerate(sigmas):
-        # Get the median time frame and std as a reference.
-        d_all = obs.images[:].values
-        med = np.median(d_all,axis=0)
-        std = np.std(d_all,axis=0)
+        # Get the median time frame and std of the active region (a view) as a reference.
+        d_all = obs.images.values[:, rows, cols]
+        if len(bands) == 1:
+            med = nanmedian(d_all,axis=0)
+            std = nanstd(d_all,axis=0).astype(d_all.dtype) # accumulate in float64
+        else:
+            med, std = np.empty_like(d_all[0]), np.empty_like(d_all[0])
+            for band in bands:
+                band = slice(band.start - rows.start, band.stop - rows.start)
+                med[band] = nanmedian(d_all[:, band],axis=0)
+                std[band] = nanstd(d_all[:, band],axis=0)
 
         # Track outliers flagged by this sigma.
         bad_pix_this_sigma = 0
@@ -26,17 +42,18 @@ def fixed_iteration_rejection(obs, sigmas=[10,10], replacement=None):
         # Then check over frames and see where outliers are.
         for k in tqdm(range(obs.images.shape[0]), desc = "Correcting for %.0fth sigma... Progress:" % j):
             # Get the frame and dq array as np.array objects so we can operate on them.
-            d = obs.images[k].values
-            dq = obs.data_quality[k].values
-            S = np.where(np.abs(d - med) > sigma*std, 1, 0)
+            d = d_all[k]
+            dq = obs.data_quality.values[k, rows, cols]
+            hits = np.nonzero(np.abs(d - med) > sigma*std)
             
             # Report where data quality flags should be added and count pixels to be replaced.
-            dq = np.where(S != 0, 1, dq)
-            bad_pix_this_frame = np.count_nonzero(S)
+            set_dq_flags(dq, hits, OUTLIER_FLAG)
+            flag_badpix(obs, (hits[0] + rows.start, hits[1] + cols.start), k=k)
+            bad_pix_this_frame = len(hits[0])
             bad_pix_this_sigma += bad_pix_this_frame
 
             # If replacement is not None, custom replacement.
-            correction = med
+            correction = med[hits]
             if replacement:
                 # Take the median of the frames that are +/- replacement away from the current frame.
                 l = k - replacement
@@ -46,15 +63,14 @@ def fixed_iteration_rejection(obs, sigmas=[10,10], replacement=None):
                     l = 0
                 if r > obs.images.shape[0]:
                     r = obs.images.shape[0]
-                correction = np.median(d_all[l:r,:,:],axis=0)
-            # Correct frame and replace obs.images frame with the new array.
-            d = np.where(S == 1, correction, d)
-            obs.images[k] = obs.images[k].where(obs.images[k].values == d,d)
-            obs.data_quality[k] = obs.data_quality[k].where(obs.data_quality[k].values == dq,dq)
+                # Only the flagged pixels need the local median.
+                correction = nanmedian(d_all[l:r,hits[0],hits[1]],axis=0)
+            # Correct the flagged pixels of the frame in place.
+            d[hits] = correction
         
         print("Bad pixels removed on iteration %.0f with sigma %.2f: %.0f" % (j, sigma, bad_pix_this_sigma))
         bad_pix_removed += bad_pix_this_sigma
-    print("All iterations complete. Total pixels corrected: %.0f out of %.0f" % (bad_pix_removed, S.shape[0]*S.shape[1]))
+    print("All iterations complete. Total pixels corrected: %.0f out of %.0f" % (bad_pix_removed, d.shape[0]*d.shape[1]))
     return obs
 
 
@@ -67,21 +83,8 @@ def array1D_clip(array, threshold = 3.5, mode = 'median'):
     
     """
     
-    # define outlier flag and mask
-    found_outlier = 1
-    mask = np.ones_like(array).astype(bool)
-
-    # iterate while flag is true
-    while found_outlier:
-        
-        # compute median and std of masked array
-        n_hits = np.sum(mask)
-        median = np.median(array[mask])
-        sigma = np.std(array[mask])
-
-        # mask values below threshold
-        mask = np.abs(array - median) < threshold * sigma     
-        found_outlier = n_hits - np.sum(mask)
+    # clip iteratively around the median until no more values are rejected
+    mask, median, _ = sigma_clip(array, sigma = threshold, cumulative = False)
     
     # replace masked values with median
     array[~mask] = median
@@ -89,41 +92,94 @@ def array1D_clip(array, threshold = 3.5, mode = 'median'):
     return array, ~mask
 
 
-def free_iteration_rejection(obs, threshold = 3.5, plot = False, check_all = False):
+def free_iteration_rejection(obs, threshold = 3.5, plot = False, check_all = False, memory_budget = None):
 
     """
 
-    Function to replace outliers in the temporal dimension
+    Function to replace outliers in the temporal dimension. With a memory_budget (e.g. '2GB' or 'auto',
+    see utils.parse_memory), the pixels are clipped in bands of rows that fit it, and the images are
+    cleaned in place rather than on a full copy
     
     """
     
-    # copy images and define hit map
-    images = obs.images.data.copy()
-    hit_map = np.zeros_like(images)
-
-    # iterate over all rows
-    for i in tqdm(range(obs.dims['x']), desc = 'Removing cosmic rays and bad pixels... Progress:'):
-
-        #iterate over all columns
-        for j in range(obs.dims['y']):
-            
-            # check that sum of pixel along temporal dimension is non-zero (i.e., that the pixel is inside the subarray)
-            if np.sum(images[:, i, j]):
-                _, hit_map[:, i, j] = array1D_clip(images[:, i, j], threshold, mode = 'median')
+    # copy images, unless working within a memory budget
+    rows, cols = active_slices(obs)
+    bands = plan_stage_chunks('free_iteration_rejection', obs.images.shape, obs.images.dtype, memory_budget, (rows, cols))
+    if memory_budget is None:
+        images, originals = obs.images.data.copy(), obs.images.data
+    else:
+        images = obs.images.data
+        originals = images.copy() if check_all else images[:1].copy() if plot else None
+
+    print('Removing cosmic rays and bad pixels...')
+    hit_lists = []
+    for band in bands:
+        # check once which pixels of the band have a non-zero sum along the temporal dimension 
+        # (i.e., that the pixel is inside the subarray)
+        region = images[:, band, cols]
+        inside = np.sum(region, axis = 0) != 0
+        xin, yin = np.nonzero(inside)
+
+        # clip the time series of every pixel inside the subarray at once, each converging on its own
+        mask, median, _ = sigma_clip(region[:, xin, yin], axis = 0, sigma = threshold, cumulative = False)
+        thits, pix = np.nonzero(~mask)
+
+        # replace the outliers with the median of their pixel and collect the hits as sparse (time, row, column) lists
+        region[thits, xin[pix], yin[pix]] = median[pix]
+        hit_lists.append((thits, xin[pix] + band.start, yin[pix] + cols.start))
+
+    hits = tuple(np.concatenate(h) for h in zip(*hit_lists))
+    thits, xhits, yhits = hits
+    flag_badpix(obs, hits)
     
     # if true, plot one exposure and draw location of all detected cosmic rays in all exposures
+    if plot or check_all:
+        from exotic_uvis.plotting import plot_exposure
+
     if plot:
-        thits, xhits, yhits = np.where(hit_map == 1)
-        plot_exposure([obs.images.data[0], images[0]], min = 0, title = 'Temporal Bad Pixel removal Example')
-        plot_exposure([obs.images.data[0]], scatter_data=[yhits, xhits], min = 0, title = 'Location of corrected pixels', mark_size = 1)
+        plot_exposure([originals[0], images[0]], min = 0, title = 'Temporal Bad Pixel removal Example')
+        plot_exposure([originals[0]], scatter_data=[yhits, xhits], min = 0, title = 'Location of corrected pixels', mark_size = 1)
 
     # if true, check each exposure separately
     if check_all:
         for i in range(len(images)):
-            xhits, yhits = np.where(hit_map[i] == 1)
-            plot_exposure([obs.images.data[i]], scatter_data=[yhits, xhits], min = 0)
+            plot_exposure([originals[i]], scatter_data=[yhits[thits == i], xhits[thits == i]], min = 0)
     
     # modify original images
     obs.images.data = images
 
-    return 0
\ No newline at end of file
+    return 0
+
+
+def sweep_free_iteration_rejection(obs, thresholds = [3, 3.5, 4, 5]):
+
+    """
+
+    Function to evaluate many temporal outlier thresholds at once. The per-pixel temporal median and std
+    are computed once and every threshold is tested against them, so the counts match the first clipping
+    pass of free_iteration_rejection. obs is not modified. Returns a DataArray of flagged pixel counts with
+    dims (threshold, exp_time) and a dict of (t, y, x) hit lists keyed by threshold.
+    
+    """
+
+    # compute the temporal statistics of the active region once, accumulating the std in float64
+    rows, cols = active_slices(obs)
+    images = obs.images.values[:, rows, cols]
+    inside = np.sum(images, axis = 0) != 0
+    median = nanmedian(images, axis = 0)
+    deviation = np.abs(images - median)
+    sigma = nanstd(images, axis = 0)
+
+    # evaluate every threshold against the shared statistics
+    counts = np.zeros((len(thresholds), images.shape[0]), dtype = int)
+    hit_lists = {}
+    for n, threshold in enumerate(thresholds):
+        t, y, x = np.nonzero(~(deviation < threshold * sigma) & inside)
+        counts[n] = np.bincount(t, minlength = images.shape[0])
+        hit_lists[threshold] = np.array([t, y + rows.start, x + cols.start])
+
+    counts = xr.DataArray(counts, dims = ['threshold', 'exp_time'], 
+                          coords = dict(threshold = thresholds, exp_time = obs.exp_time.values), 
+                          name = 'flagged_pixels')
+
+    return counts, hit_lists
@@ -0,0 +1,105 @@
+import os
+import hashlib
+
+import numpy as np
+
+# Light travel time tables already computed in this session, keyed by target and visit.
+_light_travel_cache = {}
+
+
+def light_travel_table(ra, dec, start, stop, step=10/1440, cache_dir=None):
+    '''
+    Tabulates the barycentric light travel time towards a target over a visit, with one vectorised
+    astropy call using its built-in ephemeris, so no network access is needed. Tables are cached per
+    target and visit in memory and, if cache_dir is given, on disk.
+
+    :param ra: float. Right ascension of the target, in degrees.
+    :param dec: float. Declination of the target, in degrees.
+    :param start: float. Start of the visit, MJD (UTC).
+    :param stop: float. End of the visit, MJD (UTC).
+    :param step: float. Spacing of the table, in days. The light travel time changes smoothly enough that linear interpolation on a 10 minute grid is accurate to microseconds.
+    :param cache_dir: str or None. Directory where tables are also saved, to be reused by later sessions.
+    :return: arrays of the table times (MJD UTC) and light travel times (s).
+    '''
+    key = (round(float(ra), 6), round(float(dec), 6), round(float(start), 4), round(float(stop), 4), step)
+    if key in _light_travel_cache:
+        return _light_travel_cache[key]
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, 'light_travel_{}.npz'.format(hashlib.md5(repr(key).encode()).hexdigest()[:16]))
+        if os.path.exists(path):
+            with np.load(path) as saved:
+                _light_travel_cache[key] = (saved['mjd'], saved['light_travel'])
+            return _light_travel_cache[key]
+
+    from astropy.time import Time
+    from astropy.coordinates import SkyCoord, EarthLocation
+    import astropy.units as u
+
+    # Pad the table by a step on either side so every exposure is interpolated, never extrapolated.
+    n_steps = int(np.ceil((key[3] - key[2])/step)) + 3
+    mjd = key[2] - step + step*np.arange(n_steps)
+    geocentre = EarthLocation.from_geocentric(0, 0, 0, unit=u.m)
+    times = Time(mjd, format='mjd', scale='utc', location=geocentre)
+    target = SkyCoord(ra=key[0]*u.deg, dec=key[1]*u.deg)
+    light_travel = times.light_travel_time(target, kind='barycentric', ephemeris='builtin').to_value(u.s)
+
+    _light_travel_cache[key] = (mjd, light_travel)
+    if path is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        np.savez(path, mjd=mjd, light_travel=light_travel)
+    return _light_travel_cache[key]
+
+
+def mjd_to_bjd_tdb(mjd, ra, dec, cache_dir=None, position=None):
+    '''
+    Converts UTC MJD times, e.g. exposure midpoints, to BJD_TDB. The times are converted to TDB in one
+    vectorised call and shifted by the light travel time interpolated from light_travel_table, which
+    places the observer at the geocentre. Unless the position of HST at each time is given, its own
+    orbit, which moves the times by up to about 23 ms either way, is not corrected for.
+
+    :param mjd: array of float. Times in MJD (UTC).
+    :param ra: float. Right ascension of the target, in degrees.
+    :param dec: float. Declination of the target, in degrees.
+    :param cache_dir: str or None. Directory for the on-disk light travel time cache, see light_travel_table.
+    :param position: array of shape (len(mjd), 3) or None. Geocentric position of the spacecraft at each time, in km, in the equatorial (GCRS) frame, e.g. the POSTNSTX/Y/Z keywords of the _spt files. If None, the observer is at the geocentre.
+    :return: array of BJD_TDB times, as Julian dates.
+    '''
+    from astropy.time import Time
+
+    mjd = np.asarray(mjd, dtype=np.float64)
+    table_mjd, light_travel = light_travel_table(ra, dec, mjd.min(), mjd.max(), cache_dir=cache_dir)
+    light_travel = np.interp(mjd, table_mjd, light_travel)
+    if position is not None:
+        # Light reaches a spacecraft ahead of the geocentre towards the target earlier, by the projected distance over c.
+        ra_rad, dec_rad = np.radians(ra), np.radians(dec)
+        towards = np.array([np.cos(dec_rad)*np.cos(ra_rad), np.cos(dec_rad)*np.sin(ra_rad), np.sin(dec_rad)])
+        light_travel = light_travel + np.asarray(position, dtype=np.float64).reshape(-1, 3) @ towards/299792.458
+    tdb = Time(mjd, format='mjd', scale='utc').tdb
+    return (tdb.jd1 + tdb.jd2) + light_travel/86400
+
+
+def add_bjd_tdb(obs, ra=None, dec=None, cache_dir=None, position=None):
+    '''
+    Attaches the BJD_TDB time of every exposure to obs as the bjd_tdb coordinate along exp_time. Its
+    observer attribute records whether the times are for HST itself or for the geocentre, see mjd_to_bjd_tdb.
+
+    :param obs: xarray. Its exp_time holds the exposure midpoints in MJD (UTC), as set by read_data.
+    :param ra: float or None. Right ascension of the target, in degrees. If None, use the ra_targ attribute set by read_data.
+    :param dec: float or None. Declination of the target, in degrees. If None, use the dec_targ attribute set by read_data.
+    :param cache_dir: str or None. Directory for the on-disk light travel time cache, see light_travel_table.
+    :param position: array of shape (exp_time, 3) or None. Geocentric position of HST at each exposure midpoint, in km, see mjd_to_bjd_tdb. If None, the times are geocentric.
+    :return: obs with the bjd_tdb coordinate.
+    '''
+    ra = obs.attrs['ra_targ'] if ra is None else ra
+    dec = obs.attrs['dec_targ'] if dec is None else dec
+    bjd_tdb = mjd_to_bjd_tdb(obs.exp_time.values, ra, dec, cache_dir=cache_dir, position=position)
+    if position is None:
+        attrs = dict(observer='geocentre',
+                     note="Light travel time to the geocentre. HST's orbit is not corrected for, which can shift the times by up to about 23 ms.")
+    else:
+        attrs = dict(observer='spacecraft', note="Light travel time to HST at the given geocentric positions.")
+    obs.coords['bjd_tdb'] = (['exp_time'], bjd_tdb, attrs)
+    return obs
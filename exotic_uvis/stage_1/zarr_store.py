@@ -0,0 +1,91 @@
+import numpy as np
+import xarray as xr
+
+
+# Per-frame quantities that later stages compute, and the extra dimensions of each, so they can be
+# allocated in the store before any worker writes them.
+PER_FRAME_VARIABLES = {'bkg_vals': (), 'meanstar_disp': (('xy', 2),)}
+
+
+def create_zarr_store(obs, path, per_frame=('bkg_vals', 'meanstar_disp'), cname='zstd', clevel=5):
+    '''
+    Writes obs to a Zarr store with one chunk per frame, so that worker processes can each write back
+    their own frames with write_zarr_frames, concurrently and without locks. Requires the zarr package.
+
+    :param obs: xarray. The obs Dataset, as returned by read_data.
+    :param path: str. Directory of the store. Overwritten if it exists.
+    :param per_frame: lst of str. Keys of PER_FRAME_VARIABLES that are allocated (as NaN) if obs does not hold them yet, so that workers can fill them in.
+    :param cname: str. Blosc compressor, e.g. 'zstd', 'lz4', or 'blosclz'.
+    :param clevel: int. Blosc compression level, from 0 (none) to 9.
+    :return: path.
+    '''
+    from zarr.codecs import BloscCodec
+
+    obs = obs.copy()
+    n_frames = obs.sizes['exp_time']
+    for name in per_frame:
+        if name not in obs:
+            extra = PER_FRAME_VARIABLES[name]
+            obs[name] = (('exp_time',) + tuple(dim for dim, size in extra),
+                         np.full((n_frames,) + tuple(size for dim, size in extra), np.nan))
+
+    # Chunk everything that runs along exp_time frame by frame, and keep the rest whole.
+    compressor = BloscCodec(cname=cname, clevel=clevel, shuffle='bitshuffle')
+    encoding = {}
+    for name, var in obs.variables.items():
+        encoding[name] = dict(chunks=tuple(1 if dim == 'exp_time' else size for dim, size in zip(var.dims, var.shape)))
+        if var.dtype.kind in 'iuf':
+            encoding[name]['compressors'] = (compressor,)
+
+    obs.to_zarr(path, mode='w', encoding=encoding, consolidated=False)
+    return path
+
+
+def write_zarr_frames(obs, path):
+    '''
+    Writes frames back into a store made by create_zarr_store. Each frame lives in its own chunks, so
+    processes that write different frames never touch the same files and need no locking.
+
+    :param obs: xarray. Contiguous frames of the stored obs, e.g. obs.isel(exp_time=slice(i, j)), after some stages have run on them.
+    :param path: str. Directory of the store.
+    :return: slice of the frames written.
+    '''
+    stored = xr.open_zarr(path, chunks=None, consolidated=False)
+
+    # Find where the frames sit in the store from their exposure times.
+    start = int(np.searchsorted(stored.exp_time.values, obs.exp_time.values[0]))
+    frames = slice(start, start + obs.sizes['exp_time'])
+    if not np.array_equal(stored.exp_time.values[frames], obs.exp_time.values):
+        raise ValueError("The frames to write are not a contiguous run of the frames in {}.".format(path))
+
+    # Only per-frame variables are written, and only those the store holds.
+    names = [name for name in obs.data_vars if 'exp_time' in obs[name].dims]
+    skipped = [name for name in names if name not in stored]
+    if skipped:
+        print("Not written to {}, as the store has no such variables: {}.".format(path, ', '.join(skipped)))
+    region = obs[[name for name in names if name not in skipped]]
+    region = region.drop_vars([name for name in region.coords if name != 'exp_time'])
+
+    region.to_zarr(path, mode='r+', region=dict(exp_time=frames), consolidated=False)
+    return frames
+
+
+def open_zarr_obs(path):
+    '''
+    Opens a store made by create_zarr_store lazily: frames are only read from disk when they are used.
+
+    :param path: str. Directory of the store.
+    :return: obs, with lazily loaded variables.
+    '''
+    return xr.open_zarr(path, chunks=None, consolidated=False)
+
+
+def load_zarr_obs(path):
+    '''
+    Loads a store made by create_zarr_store into memory.
+
+    :param path: str. Directory of the store.
+    :return: obs.
+    '''
+    with open_zarr_obs(path) as stored:
+        return stored.load()
@@ -0,0 +1,19 @@
+__all__ = [
+    "read_grismconf",
+    "extraction_tables",
+    "extract_spectra",
+    "bin_light_curves",
+    "bin_image_light_curves"
+]
+
+from exotic_uvis.utils.lazy_import import lazy_package
+
+# Each public name and the module defining it. A module, and its dependencies, is only imported
+# when one of its names is first used.
+lazy_package(__name__, {
+    "read_grismconf": "exotic_uvis.stage_2.grism_config",
+    "extraction_tables": "exotic_uvis.stage_2.extract_spectra",
+    "extract_spectra": "exotic_uvis.stage_2.extract_spectra",
+    "bin_light_curves": "exotic_uvis.stage_2.bin_light_curves",
+    "bin_image_light_curves": "exotic_uvis.stage_2.bin_light_curves"
+})
@@ -0,0 +1,141 @@
+import numpy as np
+import xarray as xr
+
+
+def wavelength_binning_matrix(wavelengths, bin_edges):
+    '''
+    Builds the sparse matrix that sums spectral elements into wavelength bins. Each element covers the
+    wavelengths halfway to its neighbours and is shared between the bins it straddles in proportion
+    to its overlap with each.
+
+    :param wavelengths: array of float. Increasing wavelengths of the spectral elements.
+    :param bin_edges: array of float. Increasing edges of the bins.
+    :return: scipy.sparse CSR matrix of shape (number of bins, number of elements).
+    '''
+    from scipy import sparse
+
+    wavelengths, bin_edges = np.asarray(wavelengths, dtype=np.float64), np.asarray(bin_edges, dtype=np.float64)
+    middles = (wavelengths[1:] + wavelengths[:-1])/2
+    low = np.concatenate(([2*wavelengths[0] - middles[0]], middles))
+    high = np.concatenate((middles, [2*wavelengths[-1] - middles[-1]]))
+
+    # Pair every element with each bin from the one holding its low edge to the one holding its high edge.
+    first = np.clip(np.searchsorted(bin_edges, low, side='right') - 1, 0, len(bin_edges) - 2)
+    last = np.clip(np.searchsorted(bin_edges, high, side='left') - 1, 0, len(bin_edges) - 2)
+    n_pairs = np.maximum(last - first + 1, 0)
+    elements = np.repeat(np.arange(len(wavelengths)), n_pairs)
+    bins = np.repeat(first, n_pairs) + np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+
+    overlap = np.minimum(high[elements], bin_edges[bins + 1]) - np.maximum(low[elements], bin_edges[bins])
+    weights = np.clip(overlap/(high - low)[elements], 0, 1)
+    matrix = sparse.csr_matrix((weights, (bins, elements)), shape=(len(bin_edges) - 1, len(wavelengths)))
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def pixel_binning_matrix(table, bin_edges, frame_shape):
+    '''
+    Builds the sparse matrix that sums the pixels of a frame straight into wavelength bins, combining
+    the aperture weights of an extraction table with the fractional wavelength binning.
+
+    :param table: dict. One order of stage_2.extraction_tables.
+    :param bin_edges: array of float. Increasing edges of the bins.
+    :param frame_shape: tuple of int. (rows, columns) of the frames.
+    :return: scipy.sparse CSR matrix of shape (number of bins, rows*columns).
+    '''
+    from scipy import sparse
+
+    n_elements, n_pixels = table['weights'].shape
+    pixels = np.ravel_multi_index((table['pixel_rows'], table['pixel_cols']), frame_shape)
+    aperture = sparse.csr_matrix((table['weights'].ravel(), (np.repeat(np.arange(n_elements), n_pixels), pixels.ravel())),
+                                 shape=(n_elements, int(np.prod(frame_shape))))
+    return (wavelength_binning_matrix(table['wavelengths'], bin_edges) @ aperture).tocsr()
+
+
+def apply_binning(matrix, data, errors, chunk_size=64):
+    '''
+    Bins every frame at once with a sparse matrix product, propagating the errors with the squared
+    weights. Frames are taken in chunks so only chunk_size frames are ever held in float64.
+
+    :param matrix: scipy.sparse matrix. Binning matrix of shape (number of bins, values per frame).
+    :param data: 2D array. Values of each frame, of shape (exp_time, values per frame).
+    :param errors: 2D array. Errors of the values.
+    :param chunk_size: int. Number of frames binned per product.
+    :return: the binned values and their errors, of shape (exp_time, number of bins).
+    '''
+    squared = matrix.multiply(matrix).tocsr()
+    binned = np.empty((data.shape[0], matrix.shape[0]))
+    binned_var = np.empty_like(binned)
+    for k in range(0, data.shape[0], chunk_size):
+        frames = slice(k, k + chunk_size)
+        binned[frames] = (matrix @ data[frames].astype(np.float64).T).T
+        binned_var[frames] = (squared @ (errors[frames].astype(np.float64)**2).T).T
+    return binned, np.sqrt(binned_var)
+
+
+def light_curve_dataset(exp_time, bin_edges, flux, flux_err, attrs):
+    '''
+    Stores binned light curves in an xarray Dataset keyed by exp_time and wavelength bin centre.
+
+    :param exp_time: array of float. Exposure times.
+    :param bin_edges: array of float. Edges of the bins.
+    :param flux: 2D array. Light curves, of shape (exp_time, number of bins).
+    :param flux_err: 2D array. Errors of the light curves.
+    :param attrs: dict. Attributes of the Dataset.
+    :return: xarray Dataset.
+    '''
+    bin_edges = np.asarray(bin_edges, dtype=np.float64)
+    return xr.Dataset(
+        data_vars=dict(
+            light_curve=(["exp_time", "wavelength_bin"], flux),
+            light_curve_err=(["exp_time", "wavelength_bin"], flux_err),
+        ),
+        coords=dict(
+            exp_time=exp_time,
+            wavelength_bin=(bin_edges[1:] + bin_edges[:-1])/2,
+            bin_low=(["wavelength_bin"], bin_edges[:-1]),
+            bin_high=(["wavelength_bin"], bin_edges[1:]),
+        ),
+        attrs=attrs,
+    )
+
+
+def bin_light_curves(spectra, bin_edges, chunk_size=64):
+    '''
+    Bins extracted spectra into spectroscopic light curves with one sparse matrix product.
+
+    :param spectra: xarray. One order of stage_2.extract_spectra.
+    :param bin_edges: array of float. Increasing edges of the wavelength bins.
+    :param chunk_size: int. Number of frames binned per product.
+    :return: xarray Dataset of the light curves and their errors, keyed by exp_time and wavelength_bin.
+    '''
+    matrix = wavelength_binning_matrix(spectra.wavelength.values, bin_edges)
+    flux, flux_err = apply_binning(matrix, spectra.spec.values, spectra.spec_err.values, chunk_size=chunk_size)
+    return light_curve_dataset(spectra.exp_time.values, bin_edges, flux, flux_err,
+                               dict(order=spectra.attrs.get('order', ''), source='spectra'))
+
+
+def bin_image_light_curves(obs, config, bin_edges, order='+1', halfwidth=12, position=None, t_range=(0, 1), chunk_size=64):
+    '''
+    Bins the pixels of the cleaned obs.images straight into spectroscopic light curves, skipping the
+    extraction of spectra, with one sparse matrix product. The sums match box extraction followed by
+    bin_light_curves.
+
+    :param obs: xarray. Cleaned obs from stage_1.
+    :param config: str or dict. Path to a GRISMCONF-format configuration file, or the result of read_grismconf.
+    :param bin_edges: array of float. Increasing edges of the wavelength bins.
+    :param order: str. Order to bin, as named in the configuration.
+    :param halfwidth: float. Half-width of the aperture, in pixels.
+    :param position: tuple of float or None. (x, y) position of the target in frame pixels. If None, use the target_posx and target_posy attributes of obs.
+    :param t_range: tuple of float. Range of the trace parameter t covered by the calibration.
+    :param chunk_size: int. Number of frames binned per product.
+    :return: xarray Dataset of the light curves and their errors, keyed by exp_time and wavelength_bin.
+    '''
+    from exotic_uvis.stage_2.extract_spectra import extraction_tables
+
+    table = extraction_tables(obs, config, orders=(order,), halfwidth=halfwidth, position=position, t_range=t_range)[order]
+    n_frames, n_rows, n_cols = obs.images.shape
+    matrix = pixel_binning_matrix(table, bin_edges, (n_rows, n_cols))
+    flux, flux_err = apply_binning(matrix, obs.images.values.reshape(n_frames, -1),
+                                   obs.errors.values.reshape(n_frames, -1), chunk_size=chunk_size)
+    return light_curve_dataset(obs.exp_time.values, bin_edges, flux, flux_err, dict(order=order, source='images'))
@@ -0,0 +1,149 @@
+import numpy as np
+import xarray as xr
+
+from exotic_uvis.stage_1.active_region import active_slices
+from exotic_uvis.stage_1.data_quality import get_badpix_mask
+from exotic_uvis.stage_2.grism_config import read_grismconf, trace_table
+from exotic_uvis.utils.robust_stats import nanmedian
+
+
+def extraction_tables(obs, config, orders=('+1', '-1'), halfwidth=12, position=None, t_range=(0, 1), wave_range=None):
+    '''
+    Precomputes, once per visit, the pixels each spectral element of each order is extracted from.
+    The trace and wavelength solution are evaluated at the direct image position of the target, and
+    stored as lookup tables of the rows and columns of an aperture of halfwidth pixels on either side
+    of the trace, with fractional weights for the pixels cut by its edges.
+
+    :param obs: xarray. Its target_posx and target_posy attributes give the target position, and its subarr_coords the offset of the frames on the full detector.
+    :param config: str or dict. Path to a GRISMCONF-format configuration file, or the result of read_grismconf.
+    :param orders: tuple of str. Orders to extract, as named in the configuration.
+    :param halfwidth: float. Half-width of the aperture, in pixels.
+    :param position: tuple of float or None. (x, y) position of the target in frame pixels. If None, use the target_posx and target_posy attributes of obs.
+    :param t_range: tuple of float. Range of the trace parameter t covered by the calibration.
+    :param wave_range: tuple of float or None. Only keep the wavelengths in this (min, max) range, in the units of the configuration.
+    :return: dict keyed by order of dicts with the columns, trace rows, and wavelengths of the spectral elements, and the (element, pixel) row index, column index, and weight tables of the aperture.
+    '''
+    if isinstance(config, str):
+        config = read_grismconf(config)
+    if position is None:
+        position = (obs.attrs['target_posx'], obs.attrs['target_posy'])
+    x0, y0 = position
+
+    # The calibration depends on the position on the full detector, whose subarray corners are 1-indexed.
+    left, right, bottom, top = [int(c) for c in obs.subarr_coords.values[0]]
+    field_position = (x0 + left - 1, y0 + bottom - 1)
+
+    rows, cols = active_slices(obs)
+    n_pixels = 2*int(np.ceil(halfwidth)) + 2
+    tables = {}
+    for order in orders:
+        if order not in config:
+            raise KeyError("Order {} is not in the configuration, which has orders {}.".format(order, ', '.join(config)))
+        columns, trace_rows, wavelengths = trace_table(config[order], x0, y0, np.arange(cols.start, cols.stop),
+                                                       field_position=field_position, t_range=t_range)
+        if wave_range is not None:
+            keep = (wavelengths >= wave_range[0]) & (wavelengths <= wave_range[1])
+            columns, trace_rows, wavelengths = columns[keep], trace_rows[keep], wavelengths[keep]
+
+        # Each pixel covers [row - 0.5, row + 0.5]; its weight is its overlap with the aperture.
+        first = np.floor(trace_rows - halfwidth + 0.5).astype(int)
+        pixel_rows = first[:, None] + np.arange(n_pixels)[None, :]
+        low, high = (trace_rows - halfwidth)[:, None], (trace_rows + halfwidth)[:, None]
+        weights = np.clip(np.minimum(pixel_rows + 0.5, high) - np.maximum(pixel_rows - 0.5, low), 0, 1)
+
+        # Pixels outside the active region do not count, and elements left with none are dropped.
+        outside = (pixel_rows < rows.start) | (pixel_rows >= rows.stop)
+        weights[outside] = 0
+        pixel_rows = np.clip(pixel_rows, rows.start, rows.stop - 1)
+        keep = weights.sum(axis=1) > 0
+
+        # List the spectral elements by increasing wavelength, whichever way the order disperses.
+        sort = np.argsort(wavelengths[keep])
+        tables[order] = dict(columns=columns[keep][sort], trace_rows=trace_rows[keep][sort],
+                             wavelengths=wavelengths[keep][sort], pixel_rows=pixel_rows[keep][sort],
+                             pixel_cols=np.repeat(columns[keep][sort][:, None], n_pixels, axis=1),
+                             weights=weights[keep][sort])
+    return tables
+
+
+def extract_spectra(obs, config, orders=('+1', '-1'), method='box', halfwidth=12, position=None,
+                    t_range=(0, 1), wave_range=None):
+    '''
+    Extracts the spectra of the G280 orders from every frame at once. The aperture of each order is
+    tabulated once by extraction_tables and gathered from the whole cube in a single indexing
+    operation. Box extraction sums the aperture. Optimal extraction (Horne 1986) weights it by the
+    median spatial profile of the visit and the inverse variance, and ignores bad pixels.
+
+    :param obs: xarray. Cleaned obs from stage_1.
+    :param config: str or dict. Path to a GRISMCONF-format configuration file, or the result of read_grismconf.
+    :param orders: tuple of str. Orders to extract, as named in the configuration.
+    :param method: str. 'box' or 'optimal'.
+    :param halfwidth: float. Half-width of the aperture, in pixels.
+    :param position: tuple of float or None. (x, y) position of the target in frame pixels. If None, use the target_posx and target_posy attributes of obs.
+    :param t_range: tuple of float. Range of the trace parameter t covered by the calibration.
+    :param wave_range: tuple of float or None. Only keep the wavelengths in this (min, max) range.
+    :return: dict keyed by order of xarray Datasets with the spectra and their errors, keyed by exp_time and wavelength.
+    '''
+    if method not in ('box', 'optimal'):
+        raise ValueError("method must be 'box' or 'optimal', not {!r}.".format(method))
+
+    tables = extraction_tables(obs, config, orders=orders, halfwidth=halfwidth, position=position,
+                               t_range=t_range, wave_range=wave_range)
+    images, errors = obs.images.values, obs.errors.values
+    if method == 'optimal':
+        good = get_badpix_mask(obs)
+
+    spectra = {}
+    for order, table in tables.items():
+        # Gather the aperture of every frame: (exp_time, element, pixel).
+        index = (slice(None), table['pixel_rows'], table['pixel_cols'])
+        data = images[index].astype(np.float64)
+        variance = errors[index].astype(np.float64)**2
+        weights = table['weights']
+
+        if method == 'box':
+            flux = np.einsum('tkp,kp->tk', data, weights)
+            flux_err = np.sqrt(np.einsum('tkp,kp->tk', variance, weights**2))
+        else:
+            flux, flux_err = optimal_extraction(data, variance, weights, good[index])
+
+        spectra[order] = xr.Dataset(
+            data_vars=dict(
+                spec=(["exp_time", "wavelength"], flux.astype(images.dtype)),
+                spec_err=(["exp_time", "wavelength"], flux_err.astype(images.dtype)),
+            ),
+            coords=dict(
+                exp_time=obs.exp_time.values,
+                wavelength=table['wavelengths'],
+                column=(["wavelength"], table['columns']),
+                trace_row=(["wavelength"], table['trace_rows']),
+            ),
+            attrs=dict(order=order, method=method, halfwidth=halfwidth),
+        )
+    return spectra
+
+
+def optimal_extraction(data, variance, weights, good):
+    '''
+    Optimally extracts gathered apertures, with the profile taken as the median over all frames.
+
+    :param data: 3D array. Aperture pixels, of shape (exp_time, element, pixel).
+    :param variance: 3D array. Variances of the aperture pixels.
+    :param weights: 2D array. Aperture weights, of shape (element, pixel).
+    :param good: 3D bool array. True for pixels that can be used.
+    :return: the flux and flux error arrays, of shape (exp_time, element).
+    '''
+    good = good & np.isfinite(data) & (variance > 0)
+    median = nanmedian(np.where(good, data, np.nan), axis=0)
+    profile = np.clip(np.nan_to_num(median), 0, None)*weights
+
+    # Elements with no signal fall back to a flat profile over the aperture.
+    total = profile.sum(axis=1, keepdims=True)
+    profile = np.where(total > 0, profile/np.where(total > 0, total, 1), weights/weights.sum(axis=1, keepdims=True))
+
+    inverse_variance = np.where(good, 1/np.where(good, variance, 1), 0)
+    denominator = np.einsum('tkp,kp->tk', inverse_variance, profile**2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        flux = np.einsum('tkp,kp->tk', np.where(good, data, 0)*inverse_variance, profile)/denominator
+        flux_err = np.sqrt(np.einsum('tkp,kp->tk', good.astype(np.float64), profile)/denominator)
+    return flux, flux_err
@@ -0,0 +1,100 @@
+import numpy as np
+
+
+def read_grismconf(path):
+    '''
+    Reads a GRISMCONF-format grism configuration file, such as the WFC3/UVIS G280 calibration files.
+    Each order is described by the parametric trace x(t), y(t) and wavelength l(t), relative to the
+    direct image position, as polynomials in t whose coefficients are themselves polynomials in the
+    direct image position (x0, y0), e.g. the lines DISPX_+1_0, DISPX_+1_1, DISPY_+1_0, DISPL_+1_0...
+
+    :param path: str. Path to the configuration file.
+    :return: dict keyed by order (e.g. '+1', '-1') of dicts with the DISPX, DISPY, and DISPL lists of field coefficient arrays, lowest power of t first, and the other keywords of the file under 'keywords'.
+    '''
+    orders, keywords = {}, {}
+    with open(path) as f:
+        for line in f:
+            words = line.split('#')[0].split()
+            if not words:
+                continue
+            key, values = words[0], words[1:]
+            parts = key.split('_')
+            if len(parts) == 3 and parts[0] in ('DISPX', 'DISPY', 'DISPL'):
+                name, order, power = parts[0], parts[1], int(parts[2])
+                coeffs = orders.setdefault(order, dict(DISPX=[], DISPY=[], DISPL=[]))[name]
+                coeffs.extend([None]*(power + 1 - len(coeffs)))
+                coeffs[power] = np.array(values, dtype=float)
+            else:
+                keywords[key] = values
+
+    for order, solution in orders.items():
+        for name, coeffs in solution.items():
+            if not coeffs or any(c is None for c in coeffs):
+                raise ValueError("{} of order {} in {} is missing or has gaps in its powers of t.".format(name, order, path))
+        solution['keywords'] = keywords
+    return orders
+
+
+def field_polynomial(coeffs, x0, y0):
+    '''
+    Evaluates a GRISMCONF field-dependent coefficient, a 2D polynomial in the direct image position
+    with terms ordered 1, x, y, x^2, x*y, y^2, x^3, ...
+
+    :param coeffs: array of float. Coefficients of the 2D polynomial.
+    :param x0: float. Direct image x position, in full-frame pixels.
+    :param y0: float. Direct image y position, in full-frame pixels.
+    :return: float value of the coefficient at (x0, y0).
+    '''
+    value, term, degree = 0., 0, 0
+    while term < len(coeffs):
+        for j in range(degree + 1):
+            if term == len(coeffs):
+                break
+            value += coeffs[term]*x0**(degree - j)*y0**j
+            term += 1
+        degree += 1
+    return value
+
+
+def trace_polynomials(solution, x0, y0):
+    '''
+    Evaluates the field dependence of an order once, giving plain polynomials in t.
+
+    :param solution: dict. One order of read_grismconf.
+    :param x0: float. Direct image x position, in full-frame pixels.
+    :param y0: float. Direct image y position, in full-frame pixels.
+    :return: tuple of the dx(t), dy(t), and wavelength(t) polynomial coefficients, lowest power first.
+    '''
+    return tuple(np.array([field_polynomial(c, x0, y0) for c in solution[name]])
+                 for name in ('DISPX', 'DISPY', 'DISPL'))
+
+
+def trace_table(solution, x0, y0, columns, field_position=None, t_range=(0, 1), n_samples=10001):
+    '''
+    Builds the per-column lookup table of an order: for every detector column the trace crosses, the
+    row of the trace centre and the wavelength there. dx(t) must be monotonic over t_range.
+
+    :param solution: dict. One order of read_grismconf.
+    :param x0: float. Direct image x position, in the same pixel units as columns.
+    :param y0: float. Direct image y position, in the same pixel units as columns.
+    :param columns: array of int. Candidate columns, e.g. all columns of the active region.
+    :param field_position: tuple of float or None. Full-frame (x, y) position of the source, at which the field dependence is evaluated. If None, use (x0, y0).
+    :param t_range: tuple of float. Range of the trace parameter t covered by the calibration.
+    :param n_samples: int. Number of samples of t used to invert dx(t).
+    :return: the columns the trace covers, and the trace row and wavelength at each of them.
+    '''
+    dx, dy, dl = trace_polynomials(solution, *(field_position or (x0, y0)))
+    t = np.linspace(t_range[0], t_range[1], n_samples)
+    x = np.polynomial.polynomial.polyval(t, dx)
+    if not (np.all(np.diff(x) > 0) or np.all(np.diff(x) < 0)):
+        raise ValueError("DISPX is not monotonic over t_range {}, so the trace cannot be tabulated by column.".format(t_range))
+    order = np.argsort(x)
+
+    # Invert dx(t) at every column, then evaluate the trace row and wavelength there.
+    columns = np.asarray(columns)
+    offsets = columns - x0
+    covered = (offsets >= x[order[0]]) & (offsets <= x[order[-1]])
+    t_col = np.interp(offsets[covered], x[order], t[order])
+    rows = y0 + np.polynomial.polynomial.polyval(t_col, dy)
+    wavelengths = np.polynomial.polynomial.polyval(t_col, dl)
+    return columns[covered], rows, wavelengths
@@ -0,0 +1,15 @@
+__all__ = [
+    "transit_light_curve",
+    "systematics_design_matrix",
+    "fit_light_curves"
+]
+
+from exotic_uvis.utils.lazy_import import lazy_package
+
+# Each public name and the module defining it. A module, and its dependencies, is only imported
+# when one of its names is first used.
+lazy_package(__name__, {
+    "transit_light_curve": "exotic_uvis.stage_3.transit_model",
+    "systematics_design_matrix": "exotic_uvis.stage_3.fit_light_curves",
+    "fit_light_curves": "exotic_uvis.stage_3.fit_light_curves"
+})
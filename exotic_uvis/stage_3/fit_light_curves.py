@@ -0,0 +1,176 @@
+import numpy as np
+import xarray as xr
+
+from exotic_uvis.stage_3.transit_model import transit_light_curve
+
+# Transit parameters that can be refined, and the finite-difference step used for each.
+TRANSIT_PARAMETERS = {'t0': 1e-6, 'period': 1e-7, 'rp': 1e-6, 'a': 1e-4, 'inc': 1e-4, 'u1': 1e-5, 'u2': 1e-5}
+
+
+def systematics_design_matrix(exp_time, orbit_degree=2, visit_degree=1, jitter=None, orbit_gap=45/1440):
+    '''
+    Builds the systematics regressors shared by all channels of a visit: a constant, a polynomial in
+    time over the visit, a polynomial in the time since the start of each orbit (the HST orbit ramp),
+    and optional jitter regressors such as obs.meanstar_disp.
+
+    :param exp_time: array of float. Exposure times, in days.
+    :param orbit_degree: int. Degree of the orbit phase polynomial.
+    :param visit_degree: int. Degree of the visit-long trend.
+    :param jitter: 2D array or None. Extra regressors of shape (exp_time, n), e.g. the x and y displacements. They are standardised before use.
+    :param orbit_gap: float. Time jump in days that separates two orbits.
+    :return: 2D array of shape (exp_time, number of regressors), and the list of regressor names.
+    '''
+    from exotic_uvis.stage_0.quicklookup import assign_orbits
+
+    exp_time = np.asarray(exp_time, dtype=np.float64)
+    orbits = assign_orbits(exp_time, orbit_gap)
+    starts = np.array([exp_time[orbits == orbit].min() for orbit in range(orbits.max() + 1)])
+    orbit_phase = exp_time - starts[orbits]
+    orbit_phase /= max(orbit_phase.max(), 1e-12)
+    visit_phase = (exp_time - exp_time.min())/max(np.ptp(exp_time), 1e-12)
+
+    columns, names = [np.ones_like(exp_time)], ['constant']
+    for degree in range(1, visit_degree + 1):
+        columns.append(visit_phase**degree)
+        names.append('visit_{}'.format(degree))
+    for degree in range(1, orbit_degree + 1):
+        columns.append(orbit_phase**degree)
+        names.append('orbit_{}'.format(degree))
+    if jitter is not None:
+        jitter = np.asarray(jitter, dtype=np.float64).reshape(len(exp_time), -1)
+        for i, regressor in enumerate(jitter.T):
+            columns.append((regressor - regressor.mean())/max(regressor.std(), 1e-12))
+            names.append('jitter_{}'.format(i))
+    return np.stack(columns, axis=1), names
+
+
+def solve_systematics(design, transit, flux, flux_err):
+    '''
+    Solves the weighted linear least squares for the systematics coefficients of every channel at
+    once, for the model flux = transit*(design @ coefficients).
+
+    :param design: 2D array. Systematics regressors, of shape (time, regressor).
+    :param transit: 2D array. Transit model of each channel, of shape (channel, time).
+    :param flux: 2D array. Light curves, of shape (channel, time).
+    :param flux_err: 2D array. Errors of the light curves.
+    :return: coefficients of shape (channel, regressor), and the model of shape (channel, time).
+    '''
+    regressors = transit[:, :, None]*design[None, :, :]
+    weights = 1/flux_err**2
+    normal = np.einsum('ctp,ct,ctq->cpq', regressors, weights, regressors)
+    projection = np.einsum('ctp,ct,ct->cp', regressors, weights, flux)
+    coefficients = np.linalg.solve(normal, projection[..., None])[..., 0]
+    return coefficients, np.einsum('ctp,cp->ct', regressors, coefficients)
+
+
+def fit_light_curves(light_curves, t0, period, a, inc, rp=0.1, u1=0.3, u2=0.1, fit=('rp',), jitter=None,
+                     orbit_degree=2, visit_degree=1, orbit_gap=45/1440, max_iter=50, tol=1e-8, verbose=1):
+    '''
+    Fits a transit times a systematics model to every spectroscopic channel at once. The systematics
+    are linear in a design matrix shared by all channels, so for given transit parameters they are
+    solved exactly for all channels together by solve_systematics. The transit parameters listed in
+    fit are then refined for all channels together by a vectorised Levenberg-Marquardt solver, with
+    the systematics solved again at each step.
+
+    :param light_curves: xarray. Binned light curves, e.g. from stage_2.bin_light_curves, with light_curve and light_curve_err keyed by exp_time and wavelength_bin.
+    :param t0: float or array of shape (channel,). Mid-transit time, in the units of exp_time.
+    :param period: float or array. Orbital period, in days.
+    :param a: float or array. Semi-major axis, in stellar radii.
+    :param inc: float or array. Inclination, in degrees.
+    :param rp: float or array. Initial planet to star radius ratio.
+    :param u1: float or array. Linear limb darkening coefficient.
+    :param u2: float or array. Quadratic limb darkening coefficient.
+    :param fit: tuple of str. Transit parameters refined independently in each channel, keys of TRANSIT_PARAMETERS. If empty, only the systematics are fitted.
+    :param jitter: 2D array or None. Jitter regressors of shape (exp_time, n), e.g. obs.meanstar_disp.values.
+    :param orbit_degree: int. Degree of the orbit phase polynomial.
+    :param visit_degree: int. Degree of the visit-long trend.
+    :param orbit_gap: float. Time jump in days that separates two orbits.
+    :param max_iter: int. Maximum number of Levenberg-Marquardt iterations.
+    :param tol: float. Stop once no channel improves its chi-squared by more than this fraction.
+    :param verbose: int. If 1 or more, print a summary of the fit.
+    :return: xarray Dataset keyed by wavelength_bin of the fitted parameters and their errors, the systematics coefficients, and the model, transit, systematics, and residuals keyed by exp_time.
+    '''
+    for name in fit:
+        if name not in TRANSIT_PARAMETERS:
+            raise KeyError("Cannot fit {}, choose from {}.".format(name, ', '.join(TRANSIT_PARAMETERS)))
+
+    time = light_curves.exp_time.values
+    flux = light_curves.light_curve.values.T.astype(np.float64)
+    flux_err = light_curves.light_curve_err.values.T.astype(np.float64)
+    n_channels = flux.shape[0]
+    design, names = systematics_design_matrix(time, orbit_degree, visit_degree, jitter, orbit_gap)
+
+    params = {name: np.broadcast_to(np.asarray(value, dtype=np.float64), (n_channels,)).copy()
+              for name, value in dict(t0=t0, period=period, rp=rp, a=a, inc=inc, u1=u1, u2=u2).items()}
+
+    def evaluate(values):
+        transit = transit_light_curve(time, **values)
+        coefficients, model = solve_systematics(design, transit, flux, flux_err)
+        return (flux - model)/flux_err, transit, coefficients
+
+    residuals, transit, coefficients = evaluate(params)
+    chi2 = np.sum(residuals**2, axis=1)
+    errors = {}
+
+    if fit:
+        damping = np.full(n_channels, 1e-3)
+        for iteration in range(max_iter):
+            # Jacobian of the residuals of all channels by forward differences, one parameter at a time.
+            jacobian = np.empty(residuals.shape + (len(fit),))
+            for k, name in enumerate(fit):
+                stepped = dict(params, **{name: params[name] + TRANSIT_PARAMETERS[name]})
+                jacobian[..., k] = (evaluate(stepped)[0] - residuals)/TRANSIT_PARAMETERS[name]
+
+            curvature = np.einsum('ctk,ctl->ckl', jacobian, jacobian)
+            gradient = np.einsum('ctk,ct->ck', jacobian, residuals)
+            diagonal = np.einsum('ckk->ck', curvature)
+            step = -np.linalg.solve(curvature + damping[:, None, None]*diagonal[:, :, None]*np.eye(len(fit)),
+                                    gradient[..., None])[..., 0]
+
+            trial = dict(params, **{name: params[name] + step[:, k] for k, name in enumerate(fit)})
+            trial['rp'] = np.abs(trial['rp'])
+            trial_residuals, trial_transit, trial_coefficients = evaluate(trial)
+            trial_chi2 = np.sum(trial_residuals**2, axis=1)
+
+            # Each channel keeps its step only if it improved, and adapts its own damping.
+            better = trial_chi2 < chi2
+            improvement = np.where(better, (chi2 - trial_chi2)/np.maximum(chi2, 1e-300), 0)
+            for name in fit:
+                params[name] = np.where(better, trial[name], params[name])
+            residuals = np.where(better[:, None], trial_residuals, residuals)
+            transit = np.where(better[:, None], trial_transit, transit)
+            coefficients = np.where(better[:, None], trial_coefficients, coefficients)
+            chi2 = np.where(better, trial_chi2, chi2)
+            damping = np.where(better, damping/10, damping*10)
+
+            # A channel has converged once its steps barely help, or no step helps at all.
+            converged = (better & (improvement < tol)) | (~better & (damping > 1e6))
+            if np.all(converged):
+                break
+
+        # Parameter errors from the curvature at the solution.
+        covariance = np.linalg.pinv(curvature)
+        for k, name in enumerate(fit):
+            errors[name] = np.sqrt(np.abs(covariance[:, k, k]))
+
+    systematics = design @ coefficients.T
+    model = transit*systematics.T
+    if verbose >= 1:
+        print("Fitted {} channels: reduced chi-squared {:.3f} to {:.3f}.".format(
+            n_channels, np.min(chi2)/(len(time) - len(names) - len(fit)), np.max(chi2)/(len(time) - len(names) - len(fit))))
+
+    data_vars = {name: (["wavelength_bin"], params[name]) for name in params}
+    data_vars.update({name + '_err': (["wavelength_bin"], errors[name]) for name in errors})
+    data_vars.update(
+        coefficients=(["wavelength_bin", "regressor"], coefficients),
+        chi2=(["wavelength_bin"], chi2),
+        model=(["exp_time", "wavelength_bin"], model.T),
+        transit=(["exp_time", "wavelength_bin"], transit.T),
+        systematics=(["exp_time", "wavelength_bin"], systematics),
+        residuals=(["exp_time", "wavelength_bin"], (flux - model).T),
+    )
+    return xr.Dataset(
+        data_vars=data_vars,
+        coords=dict(exp_time=time, wavelength_bin=light_curves.wavelength_bin.values, regressor=names),
+        attrs=dict(fitted=list(fit)),
+    )
@@ -0,0 +1,76 @@
+import numpy as np
+
+
+def sky_separation(time, t0, period, a, inc):
+    '''
+    Computes the projected separation of a planet on a circular orbit from the centre of its star.
+
+    :param time: array of float. Times, in days.
+    :param t0: float or array. Mid-transit time, in days.
+    :param period: float or array. Orbital period, in days.
+    :param a: float or array. Semi-major axis, in stellar radii.
+    :param inc: float or array. Inclination, in degrees.
+    :return: array of separations in stellar radii. Times when the planet is behind the star get infinity.
+    '''
+    phase = 2*np.pi*(time - t0)/period
+    inc = np.radians(inc)
+    z = a*np.sqrt(np.sin(phase)**2 + (np.cos(inc)*np.cos(phase))**2)
+    return np.where(np.cos(phase) > 0, z, np.inf)
+
+
+def circle_overlap(r, p, z):
+    '''
+    Computes the area where a circle of radius r centred at the origin and a circle of radius p at
+    distance z overlap. All arguments broadcast.
+
+    :param r: array of float. Radius of the first circle.
+    :param p: array of float. Radius of the second circle.
+    :param z: array of float. Distance between the centres.
+    :return: array of overlap areas.
+    '''
+    r, p, z = np.broadcast_arrays(r, p, z)
+    area = np.where(z <= np.abs(r - p), np.pi*np.minimum(r, p)**2, 0.)
+    partial = (z < r + p) & (z > np.abs(r - p))
+    r, p, z = r[partial], p[partial], z[partial]
+    area[partial] = (r**2*np.arccos(np.clip((z**2 + r**2 - p**2)/(2*z*r), -1, 1))
+                     + p**2*np.arccos(np.clip((z**2 + p**2 - r**2)/(2*z*p), -1, 1))
+                     - 0.5*np.sqrt(np.clip((-z + r + p)*(z + r - p)*(z - r + p)*(z + r + p), 0, None)))
+    return area
+
+
+def transit_light_curve(time, t0, period, rp, a, inc, u1, u2, n_annuli=500):
+    '''
+    Computes transit light curves for many channels at once, for a star with quadratic limb darkening.
+    The stellar disk is split into n_annuli rings of constant intensity, and the light blocked in each
+    is the difference of circle overlaps at its edges, so every channel and time is computed together.
+
+    :param time: array of float. Times, in days.
+    :param t0: float or array of shape (channel,). Mid-transit time, in days.
+    :param period: float or array of shape (channel,). Orbital period, in days.
+    :param rp: float or array of shape (channel,). Planet to star radius ratio.
+    :param a: float or array of shape (channel,). Semi-major axis, in stellar radii.
+    :param inc: float or array of shape (channel,). Inclination, in degrees.
+    :param u1: float or array of shape (channel,). Linear limb darkening coefficient.
+    :param u2: float or array of shape (channel,). Quadratic limb darkening coefficient.
+    :param n_annuli: int. Number of rings the stellar disk is split into.
+    :return: array of relative fluxes, of shape (channel, time).
+    '''
+    time = np.asarray(time, dtype=np.float64)
+    t0, period, rp, a, inc, u1, u2 = [np.atleast_1d(np.asarray(x, dtype=np.float64))[:, None]
+                                      for x in (t0, period, rp, a, inc, u1, u2)]
+    z = sky_separation(time[None, :], t0, period, a, inc)
+
+    # Intensity of each ring at its middle, and the overlap of the planet with the disk inside each edge.
+    edges = np.linspace(0, 1, n_annuli + 1)
+    mu = np.sqrt(1 - ((edges[1:] + edges[:-1])/2)**2)
+    intensity = 1 - u1[..., None]*(1 - mu) - u2[..., None]*(1 - mu)**2
+    total = np.sum(intensity*np.pi*np.diff(edges**2), axis=-1)
+
+    flux = np.ones(np.broadcast(z, rp, u1, u2).shape)
+    z = np.broadcast_to(z, flux.shape)
+    transiting = z < 1 + rp
+    if np.any(transiting):
+        overlap = circle_overlap(edges[None, :], np.broadcast_to(rp, flux.shape)[transiting][:, None], z[transiting][:, None])
+        blocked = np.sum(np.broadcast_to(intensity, flux.shape + (n_annuli,))[transiting]*np.diff(overlap, axis=-1), axis=-1)
+        flux[transiting] = 1 - blocked/np.broadcast_to(total, flux.shape)[transiting]
+    return flux
@@ -0,0 +1,37 @@
+__all__ = [
+    "nanmedian",
+    "nanstd",
+    "nanmad",
+    "nanhistogram",
+    "nanmode",
+    "sigma_clip",
+    "sigma_clipped_stats",
+    "prefetch_fits",
+    "read_hdus",
+    "new_io_metrics",
+    "print_io_metrics",
+    "parse_memory",
+    "plan_chunks",
+    "plan_stage_chunks"
+]
+
+from exotic_uvis.utils.lazy_import import lazy_package
+
+# Each public name and the module defining it. A module, and its dependencies, is only imported
+# when one of its names is first used.
+lazy_package(__name__, {
+    "nanmedian": "exotic_uvis.utils.robust_stats",
+    "nanstd": "exotic_uvis.utils.robust_stats",
+    "nanmad": "exotic_uvis.utils.robust_stats",
+    "nanhistogram": "exotic_uvis.utils.robust_stats",
+    "nanmode": "exotic_uvis.utils.robust_stats",
+    "sigma_clip": "exotic_uvis.utils.robust_stats",
+    "sigma_clipped_stats": "exotic_uvis.utils.robust_stats",
+    "prefetch_fits": "exotic_uvis.utils.fits_prefetch",
+    "read_hdus": "exotic_uvis.utils.fits_prefetch",
+    "new_io_metrics": "exotic_uvis.utils.fits_prefetch",
+    "print_io_metrics": "exotic_uvis.utils.fits_prefetch",
+    "parse_memory": "exotic_uvis.utils.chunk_planner",
+    "plan_chunks": "exotic_uvis.utils.chunk_planner",
+    "plan_stage_chunks": "exotic_uvis.utils.chunk_planner"
+})
@@ -0,0 +1,108 @@
+import os
+import re
+
+import numpy as np
+
+# Temporary memory each stage needs for every pixel of every frame it works on at once: the number of
+# copies in the working precision, in float64, and as booleans, and the axis it can be chunked along.
+# Temporal stages need whole time series, so they are split into bands of rows. Stages that work frame
+# by frame are split into chunks of frames. LED is not listed, as it already holds one frame at a time.
+STAGE_FOOTPRINTS = {
+    # A partitioned copy for the median, and float64 deviations for the std.
+    'fixed_iteration_rejection': dict(working=1, float64=2, bool=0, axis='rows'),
+    # The gathered time series and its clipped copy, float64 clipping statistics, and the masks.
+    'free_iteration_rejection': dict(working=2, float64=2, bool=3, axis='rows'),
+    # The gathered frames and their deviations from the median for the MAD, and the NaN mask.
+    'full_frame_bckg_subtraction': dict(working=2, float64=0, bool=1, axis='frames'),
+    # The copy of the frames the background is subtracted from.
+    'corner_bkg_subtraction': dict(working=1, float64=0, bool=0, axis='frames'),
+    # The float64 sky pixels gathered for the batched least-squares solve.
+    'surface_bckg_subtraction': dict(working=0, float64=1, bool=0, axis='frames'),
+    # The float64 frames, their Fourier transform and phase ramp, the variances, the outputs, and the masks.
+    'align_frames': dict(working=2, float64=6, bool=3, axis='frames'),
+}
+
+_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def available_memory():
+    '''
+    Returns the memory currently available to new allocations.
+
+    :return: int number of bytes, or None if it cannot be told on this system.
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def parse_memory(budget):
+    '''
+    Converts a memory budget to bytes.
+
+    :param budget: int, float, or str. Bytes, a size such as '512MB' or '4 GB', or 'auto' for half of the available memory.
+    :return: int number of bytes.
+    '''
+    if isinstance(budget, str):
+        if budget.strip().lower() == 'auto':
+            available = available_memory()
+            if available is None:
+                raise ValueError("Cannot tell the available memory on this system, give the memory budget explicitly.")
+            return available//2
+        match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)B?\s*', budget.upper())
+        if match is None:
+            raise ValueError("Cannot read memory budget {!r}, use e.g. '512MB' or '4GB'.".format(budget))
+        return int(float(match.group(1))*_UNITS[match.group(2)])
+    return int(budget)
+
+
+def plan_chunks(n_items, bytes_per_item, memory_budget, start=0):
+    '''
+    Splits n_items into equal contiguous chunks, each needing no more than memory_budget.
+
+    :param n_items: int. Number of items (e.g. rows or frames) to split.
+    :param bytes_per_item: float. Temporary memory needed per item.
+    :param memory_budget: int, str, or None. Memory allowed for one chunk, see parse_memory. If None, use one chunk.
+    :param start: int. Index of the first item, added to the slices.
+    :return: lst of slices.
+    '''
+    if memory_budget is None or n_items == 0:
+        return [slice(start, start + n_items)]
+    per_chunk = int(parse_memory(memory_budget)//max(bytes_per_item, 1))
+    if per_chunk < 1:
+        print("Memory budget of {} bytes is below the {:.0f} bytes one item needs, processing one at a time.".format(
+            parse_memory(memory_budget), bytes_per_item))
+        per_chunk = 1
+    n_chunks = -(-n_items//per_chunk)
+    size = -(-n_items//n_chunks)
+    return [slice(start + k, start + min(k + size, n_items)) for k in range(0, n_items, size)]
+
+
+def plan_stage_chunks(stage, shape, dtype, memory_budget, region=None):
+    '''
+    Plans the chunks of a stage from its declared footprint in STAGE_FOOTPRINTS.
+
+    :param stage: str. Name of the stage, a key of STAGE_FOOTPRINTS.
+    :param shape: tuple of int. Shape (exp_time, rows, columns) of the cube the stage works on.
+    :param dtype: numpy dtype. Working precision of the cube.
+    :param memory_budget: int, str, or None. Memory allowed for the temporaries of one chunk, see parse_memory. If None, use one chunk.
+    :param region: tuple of slices or None. (row slice, column slice) of the part of the frames that is processed, e.g. from active_slices. If None, the whole frame.
+    :return: lst of slices, of rows or of frames depending on the axis the stage is chunked along.
+    '''
+    footprint = STAGE_FOOTPRINTS[stage]
+    n_frames, n_rows, n_cols = shape
+    rows, cols = region if region is not None else (slice(0, n_rows), slice(0, n_cols))
+    n_rows, n_cols = rows.stop - rows.start, cols.stop - cols.start
+    pixel_bytes = footprint['working']*np.dtype(dtype).itemsize + footprint['float64']*8 + footprint['bool']
+
+    if footprint['axis'] == 'rows':
+        return plan_chunks(n_rows, pixel_bytes*n_frames*n_cols, memory_budget, start=rows.start)
+    return plan_chunks(n_frames, pixel_bytes*n_rows*n_cols, memory_budget)
@@ -0,0 +1,90 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def new_io_metrics():
+    '''
+    Returns empty I/O metrics, to be filled in by prefetch_fits.
+
+    :return: dict with the number of files, the seconds spent reading and decoding them in the background ('read'), the seconds the caller waited for a file that was not ready yet ('read_wait'), and the seconds the caller spent on each file between reads ('compute').
+    '''
+    return dict(files=0, read=0., read_wait=0., compute=0.)
+
+
+def read_hdus(path, extensions=(0, 1)):
+    '''
+    Reads the headers and data of some extensions of a FITS file into memory.
+
+    :param path: str. Path to the FITS file.
+    :param extensions: tuple of int. Extensions to read.
+    :return: lst of (header, data array or None) pairs, one per extension.
+    '''
+    from astropy.io import fits
+
+    with fits.open(path) as hdul:
+        return [(hdul[ext].header.copy(), None if hdul[ext].data is None else np.array(hdul[ext].data))
+                for ext in extensions]
+
+
+def prefetch_fits(paths, decode=read_hdus, depth=4, n_threads=None, metrics=None):
+    '''
+    Yields the decoded contents of each file in order, while the next files are read and decoded on
+    background threads. Disk or network reads then overlap with whatever the caller does with each file.
+
+    :param paths: lst of str. Files to read, in the order they are wanted.
+    :param decode: function. Called as decode(path) on a background thread. It should read everything the caller needs into memory, e.g. with np.array(hdul[1].data), as memory-mapped data is lost when the file is closed.
+    :param depth: int. Number of files read ahead of the one being processed. 0 reads each file only when it is asked for.
+    :param n_threads: int or None. Number of reader threads. If None, use min(depth, number of CPUs), and at least 1.
+    :param metrics: dict or None. If given (see new_io_metrics), read, read-wait, and compute times are added to it.
+    :return: generator of (path, decode(path)) pairs.
+    '''
+    paths = list(paths)
+    if metrics is None:
+        metrics = new_io_metrics()
+    if n_threads is None:
+        n_threads = max(1, min(depth, os.cpu_count() or 1))
+
+    def timed_decode(path):
+        t = time.perf_counter()
+        result = decode(path)
+        return result, time.perf_counter() - t
+
+    executor = ThreadPoolExecutor(max_workers=n_threads)
+    pending = {}
+    try:
+        # Fill the read-ahead queue, then keep it full as each file is handed over.
+        for i in range(min(depth, len(paths))):
+            pending[i] = executor.submit(timed_decode, paths[i])
+        for i, path in enumerate(paths):
+            t = time.perf_counter()
+            future = pending.pop(i, None) or executor.submit(timed_decode, path)
+            if i + depth < len(paths):
+                pending[i + depth] = executor.submit(timed_decode, paths[i + depth])
+            result, read_time = future.result()
+            metrics['read_wait'] += time.perf_counter() - t
+            metrics['read'] += read_time
+            metrics['files'] += 1
+
+            t = time.perf_counter()
+            yield path, result
+            metrics['compute'] += time.perf_counter() - t
+    finally:
+        # Stop reading ahead if the caller stops early.
+        for future in pending.values():
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def print_io_metrics(metrics, label='Read'):
+    '''
+    Prints a one line summary of I/O metrics.
+
+    :param metrics: dict. Metrics filled in by prefetch_fits.
+    :param label: str. What was read, used as the start of the line.
+    :return: None.
+    '''
+    print("{} {:.0f} files: {:.2f} s waiting on reads, {:.2f} s computing, {:.2f} s of reads overlapped in the background.".format(
+        label, metrics['files'], metrics['read_wait'], metrics['compute'], max(metrics['read'] - metrics['read_wait'], 0.)))
@@ -0,0 +1,40 @@
+import sys
+import types
+import importlib
+
+
+class _LazyPackage(types.ModuleType):
+    '''
+    Package module whose public functions are imported from their modules on first use (PEP 562).
+    '''
+    def __getattr__(self, name):
+        exports = self.__dict__.get('_lazy_exports', {})
+        if name not in exports:
+            raise AttributeError("module {!r} has no attribute {!r}".format(self.__name__, name))
+        value = getattr(importlib.import_module(exports[name]), name)
+        self.__dict__[name] = value
+        return value
+
+    def __setattr__(self, name, value):
+        # Importing a submodule binds it on the package, which would shadow an exported function of
+        # the same name (e.g. stage_0.quicklookup), so leave those to __getattr__.
+        if isinstance(value, types.ModuleType) and name in self.__dict__.get('_lazy_exports', {}):
+            return
+        super().__setattr__(name, value)
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self.__dict__.get('_lazy_exports', {})))
+
+
+def lazy_package(name, exports):
+    '''
+    Makes the public functions of a package load on first use, so that importing the package does
+    not import every stage and its dependencies.
+
+    :param name: str. Name of the package, i.e. __name__ in its __init__.
+    :param exports: dict. Maps each public name to the full name of the module defining it.
+    :return: None. The package module is updated in place.
+    '''
+    package = sys.modules[name]
+    package.__class__ = _LazyPackage
+    package.__dict__['_lazy_exports'] = exports
@@ -0,0 +1,288 @@
+import numpy as np
+
+
+# Number of array elements a batched kernel works on at once, to bound its temporary memory.
+BLOCK_SIZE = 2**22
+
+
+def _to_rows(a, axis):
+    '''
+    Moves the reduced axes of an array to the end and flattens them, so that each row is one reduction.
+
+    :param a: array-like. Input array.
+    :param axis: int, tuple of int, or None. Axes to reduce over. If None, reduce over all axes.
+    :return: 2D array of shape (number of reductions, reduction length), the output shape, and the moved shape.
+    '''
+    a = np.asarray(a)
+    if axis is None:
+        axis = tuple(range(a.ndim))
+    axis = tuple(ax % a.ndim for ax in np.atleast_1d(axis))
+    moved = np.moveaxis(a, axis, tuple(range(a.ndim - len(axis), a.ndim)))
+    out_shape = moved.shape[:a.ndim - len(axis)]
+    n = int(np.prod(moved.shape[a.ndim - len(axis):], dtype=np.int64))
+    return np.ascontiguousarray(moved).reshape(-1, n), out_shape, moved.shape
+
+
+def _from_rows(values, out_shape):
+    '''
+    Reshapes one value per reduction back to the output shape, returning a scalar for full reductions.
+
+    :param values: 1D array. One value per reduction.
+    :param out_shape: tuple of int. Output shape from _to_rows.
+    :return: array of out_shape, or numpy scalar if out_shape is empty.
+    '''
+    return values.reshape(out_shape)[()]
+
+
+def _row_blocks(n_rows, n):
+    '''
+    Splits the rows of a batched reduction into blocks of roughly BLOCK_SIZE elements.
+
+    :param n_rows: int. Number of reductions.
+    :param n: int. Length of each reduction.
+    :return: generator of row slices.
+    '''
+    step = max(1, BLOCK_SIZE//max(n, 1))
+    for start in range(0, n_rows, step):
+        yield slice(start, min(start + step, n_rows))
+
+
+def nanmedian(a, axis=None, keepdims=False):
+    '''
+    Median that ignores NaNs, using the much faster np.median when there are none.
+
+    :param a: array-like. Input array.
+    :param axis: int, tuple of int, or None. Axes to take the median over.
+    :param keepdims: bool. If True, keep the reduced axes with length one.
+    :return: median along axis.
+    '''
+    a = np.asarray(a)
+    if a.dtype.kind == 'f' and np.isnan(a).any():
+        return np.nanmedian(a, axis=axis, keepdims=keepdims)
+    return np.median(a, axis=axis, keepdims=keepdims)
+
+
+def nanstd(a, axis=None, ddof=0, keepdims=False):
+    '''
+    Standard deviation that ignores NaNs, accumulated in float64 whatever the working precision.
+
+    :param a: array-like. Input array.
+    :param axis: int, tuple of int, or None. Axes to take the standard deviation over.
+    :param ddof: int. Delta degrees of freedom.
+    :param keepdims: bool. If True, keep the reduced axes with length one.
+    :return: float64 standard deviation along axis.
+    '''
+    a = np.asarray(a)
+    if a.dtype.kind == 'f' and np.isnan(a).any():
+        return np.nanstd(a, axis=axis, ddof=ddof, dtype=np.float64, keepdims=keepdims)
+    return np.std(a, axis=axis, ddof=ddof, dtype=np.float64, keepdims=keepdims)
+
+
+def nanmad(a, axis=None, scale=1.0):
+    '''
+    Median absolute deviation from the median, ignoring NaNs.
+
+    :param a: array-like. Input array.
+    :param axis: int, tuple of int, or None. Axes to take the MAD over.
+    :param scale: float. Factor applied to the MAD. Use 1.4826 to estimate the standard deviation of Gaussian data.
+    :return: MAD along axis.
+    '''
+    a = np.asarray(a)
+    median = nanmedian(a, axis=axis, keepdims=True)
+    return scale*nanmedian(np.abs(a - median), axis=axis)
+
+
+def _histogram_rows(rows, bins, range=None):
+    '''
+    Histograms each row of a 2D array at once, with the same bins and edge handling as np.histogram.
+
+    :param rows: 2D array. One histogram is built per row. NaNs and infs are ignored.
+    :param bins: int or 1D array. Number of equal-width bins spanning each row (or range), or shared bin edges.
+    :param range: tuple of float or None. Lower and upper edge of the bins if bins is an int. If None, use the finite min and max of each row.
+    :return: counts of shape (rows, bins) and edges of shape (rows, bins + 1).
+    '''
+    n_rows = rows.shape[0]
+    finite = np.isfinite(rows)
+
+    if np.ndim(bins) == 1:
+        # Shared, possibly uneven edges. The last bin includes its right edge.
+        edges = np.asarray(bins)
+        n_bins = len(edges) - 1
+        idx = np.searchsorted(edges, rows, side='right') - 1
+        idx[rows == edges[-1]] = n_bins - 1
+        keep = finite & (idx >= 0) & (idx < n_bins)
+        edges = np.broadcast_to(edges, (n_rows, n_bins + 1))
+    else:
+        # Equal bins per row, built exactly as np.histogram builds them.
+        n_bins = int(bins)
+        edges = []
+        for row, row_finite in zip(rows, finite):
+            if range is None:
+                values = row[row_finite]
+                first, last = (values.min().item(), values.max().item()) if values.size else (0., 1.)
+            else:
+                first, last = float(range[0]), float(range[1])
+            if first == last:
+                first, last = first - 0.5, last + 0.5
+            edges.append(np.linspace(first, last, n_bins + 1, endpoint=True,
+                                     dtype=np.result_type(first, last, row)))
+        edges = np.array(edges)
+        first, last = edges[:, :1].astype(np.float64), edges[:, -1:].astype(np.float64)
+        values = rows.astype(edges.dtype, copy=False)
+        keep = finite & (values >= edges[:, :1]) & (values <= edges[:, -1:])
+
+        # Estimate the bin arithmetically, then correct estimates that land one bin off an edge.
+        with np.errstate(invalid='ignore'):
+            idx = ((values - first)/(last - first)*n_bins).astype(np.intp)
+        np.clip(idx, 0, n_bins - 1, out=idx)
+        row_idx = np.arange(n_rows)[:, None]
+        idx -= values < edges[row_idx, idx]
+        np.clip(idx, 0, n_bins - 1, out=idx)
+        idx += (values >= edges[row_idx, np.minimum(idx + 1, n_bins)]) & (idx != n_bins - 1)
+
+    # Count every row at once by offsetting each row's bins.
+    flat = (np.arange(n_rows)[:, None]*n_bins + idx)[keep]
+    counts = np.bincount(flat, minlength=n_rows*n_bins).reshape(n_rows, n_bins)
+    return counts, edges
+
+
+def nanhistogram(a, axis=None, bins=1000, range=None):
+    '''
+    Batched histogram that ignores NaNs and infs. Each reduction along axis gets its own histogram.
+
+    :param a: array-like. Input array.
+    :param axis: int, tuple of int, or None. Axes to histogram over. If None, build one histogram of the whole array.
+    :param bins: int or 1D array. Number of equal-width bins, or shared bin edges.
+    :param range: tuple of float or None. Lower and upper edge of the bins if bins is an int. If None, use the finite min and max of each reduction.
+    :return: counts of shape out_shape + (bins,) and edges of shape out_shape + (bins + 1,).
+    '''
+    rows, out_shape, _ = _to_rows(a, axis)
+    counts, edges = zip(*[_histogram_rows(rows[block], bins, range) for block in _row_blocks(*rows.shape)])
+    counts, edges = np.concatenate(counts), np.concatenate(edges)
+    return counts.reshape(out_shape + counts.shape[1:]), edges.reshape(out_shape + edges.shape[1:])
+
+
+def nanmode(a, axis=None, bins=1000, range=None):
+    '''
+    Batched histogram mode that ignores NaNs and infs, taken as the centre of the fullest bin.
+
+    :param a: array-like. Input array.
+    :param axis: int, tuple of int, or None. Axes to take the mode over, e.g. (1, 2) for the mode of every frame of a cube.
+    :param bins: int or 1D array. Number of equal-width bins, or shared bin edges.
+    :param range: tuple of float or None. Lower and upper edge of the bins if bins is an int. If None, use the finite min and max of each reduction.
+    :return: float64 mode along axis.
+    '''
+    rows, out_shape, _ = _to_rows(a, axis)
+    modes = []
+    for block in _row_blocks(*rows.shape):
+        counts, edges = _histogram_rows(rows[block], bins, range)
+        ind = np.argmax(counts, axis=1)[:, None]
+        centre = np.take_along_axis(edges, ind, 1) + np.take_along_axis(edges, ind + 1, 1)
+        modes.append(centre[:, 0].astype(np.float64)/2)
+    return _from_rows(np.concatenate(modes), out_shape)
+
+
+def _clip_rows(rows, sigma, maxiters, cumulative=True):
+    '''
+    Iterative median-centred sigma clipping of each row of a 2D array, see sigma_clip.
+
+    :param rows: 2D array. Each row is clipped independently.
+    :param sigma: float. Clipping threshold in standard deviations.
+    :param maxiters: int or None. Maximum number of iterations. If None, iterate until every row converges.
+    :param cumulative: bool. If True, clipped values stay clipped and values on the bounds are kept, as in astropy. If False, every value is tested again at each iteration and must lie strictly within the bounds.
+    :return: kept mask of the shape of rows, and the median and float64 std of each row's kept values.
+    '''
+    n_rows = rows.shape[0]
+    valid = np.isfinite(rows)
+    kept = valid.copy()
+    centre = np.full(n_rows, np.nan, dtype=np.result_type(rows.dtype, np.float16))
+    std = np.full(n_rows, np.nan)
+
+    # The values never change, only which are kept, so each row is sorted once.
+    order = np.argsort(rows, axis=1, kind='stable')
+    sorted_rows = np.take_along_axis(rows, order, 1)
+
+    active = np.arange(n_rows)
+    n_iter = 0
+    while len(active):
+        values, mask = rows[active], kept[active]
+        n = np.sum(mask, axis=1)
+
+        # Median of the kept values: the middle one or two kept values in sorted order.
+        rank = np.cumsum(np.take_along_axis(mask, order[active], 1), axis=1)
+        lo = np.argmax(rank >= ((n + 1)//2)[:, None], axis=1)[:, None]
+        hi = np.argmax(rank >= (n//2 + 1)[:, None], axis=1)[:, None]
+        s = sorted_rows[active]
+        median = ((np.take_along_axis(s, lo, 1) + np.take_along_axis(s, hi, 1))/2)[:, 0]
+
+        # Standard deviation of the kept values, accumulated in float64.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.sum(values, axis=1, where=mask, dtype=np.float64)/n
+            sd = np.sqrt(np.sum((values - mean[:, None])**2, axis=1, where=mask, dtype=np.float64)/n)
+            median = np.where(n > 0, median, np.nan)
+        # The statistics are always those of the values kept so far, which are the final ones once a row stops.
+        centre[active], std[active] = median, sd
+        if maxiters is not None and n_iter >= maxiters:
+            break
+
+        with np.errstate(invalid='ignore'):
+            if cumulative:
+                new_mask = mask & (values >= (median - sd*sigma)[:, None]) & (values <= (median + sd*sigma)[:, None])
+            else:
+                # Every value is tested again, so values clipped earlier can come back.
+                new_mask = valid[active] & (np.abs(values - median[:, None]) < sigma*sd[:, None])
+
+        kept[active] = new_mask
+        # A row has converged once the number of kept values stops changing.
+        active = active[np.sum(new_mask, axis=1) != n]
+        n_iter += 1
+
+    return kept, centre, std
+
+
+def sigma_clip(a, axis=None, sigma=3.0, maxiters=None, cumulative=True):
+    '''
+    Iterative median-centred sigma clipping along any axis of an array, ignoring NaNs and infs.
+
+    At each iteration the median and standard deviation of the kept values are recomputed and the
+    values further than sigma standard deviations from the median are clipped, until the number of
+    kept values of each reduction stops changing. Each reduction converges on its own. By default this
+    matches astropy.stats.sigma_clip with its default median centre and std.
+
+    :param a: array-like. Input array.
+    :param axis: int, tuple of int, or None. Axes to clip along, e.g. 0 to clip each pixel of a cube in time. If None, clip the whole array.
+    :param sigma: float. Clipping threshold in standard deviations.
+    :param maxiters: int or None. Maximum number of iterations. If None, iterate until convergence.
+    :param cumulative: bool. If True, clipped values stay clipped and values exactly on the bounds are kept, as in astropy. If False, every value is tested again at each iteration and kept only if strictly within the bounds, as array1D_clip did for free_iteration_rejection.
+    :return: bool mask of the shape of a (True where the value is kept), and the median and float64 std of the kept values along axis.
+    '''
+    a = np.asarray(a)
+    rows, out_shape, moved_shape = _to_rows(a, axis)
+    kept, centre, std = (np.empty(rows.shape, dtype=bool), np.empty(rows.shape[0], dtype=np.result_type(a.dtype, np.float16)),
+                         np.empty(rows.shape[0]))
+    for block in _row_blocks(*rows.shape):
+        kept[block], centre[block], std[block] = _clip_rows(rows[block], sigma, maxiters, cumulative)
+
+    # Put the mask back in the layout of the input.
+    if axis is None:
+        axis = tuple(range(a.ndim))
+    axis = tuple(ax % a.ndim for ax in np.atleast_1d(axis))
+    kept = np.moveaxis(kept.reshape(moved_shape), tuple(range(a.ndim - len(axis), a.ndim)), axis)
+    return kept, _from_rows(centre, out_shape), _from_rows(std, out_shape)
+
+
+def sigma_clipped_stats(a, axis=None, sigma=3.0, maxiters=5):
+    '''
+    Mean, median, and standard deviation of the values kept by sigma_clip, as astropy.stats.sigma_clipped_stats.
+
+    :param a: array-like. Input array.
+    :param axis: int, tuple of int, or None. Axes to take the statistics over.
+    :param sigma: float. Clipping threshold in standard deviations.
+    :param maxiters: int or None. Maximum number of clipping iterations.
+    :return: mean, median, and std of the kept values along axis.
+    '''
+    a = np.asarray(a)
+    kept, median, std = sigma_clip(a, axis=axis, sigma=sigma, maxiters=maxiters)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.sum(a, axis=axis, where=kept, dtype=np.float64)/np.sum(kept, axis=axis)
+    return mean, median, std
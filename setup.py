@@ -7,13 +7,14 @@ setup(
     author='Abby Boehm and Carlos Gascon',
     url='https://github.com/Exo-TiC/ExoTiC-UVIS',
     license='MIT',
-    packages=['exotic_uvis','exotic_uvis.stage_0','exotic_uvis.stage_1'],
+    packages=['exotic_uvis','exotic_uvis.plotting','exotic_uvis.stage_0','exotic_uvis.stage_1','exotic_uvis.stage_2','exotic_uvis.stage_3','exotic_uvis.utils'],
     description='HST UVIS reduction pipeline',
     long_description="Pipeline for analysis of Hubble Space Telescope "
                      "WFC3-UVIS G280 spectroscopic observations.",
     python_requires='>=3.8.0',
     install_requires=['scipy>=1.8.0', 'numpy', 'xarray', 'astroquery', 'astropy',
                       'photutils', 'matplotlib', 'tqdm'],
+    extras_require={'zarr': ['zarr>=3']},
     classifiers=[
         'Intended Audience :: Science/Research',
         'License :: OSI Approved :: MIT License',
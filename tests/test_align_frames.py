@@ -0,0 +1,84 @@
+import unittest
+import numpy as np
+import xarray as xr
+
+from exotic_uvis.stage_1 import align_frames
+from exotic_uvis.stage_1.data_quality import packed_ones, get_badpix_mask
+
+
+def make_obs(n_frames=6, n_rows=40, n_cols=60):
+    """ Builds an obs Dataset of a star that moves from frame to frame by known displacements. """
+    rng = np.random.default_rng(1)
+    disp = rng.uniform(-1.5, 1.5, (n_frames, 2))
+    disp[0] = 0
+    rows, cols = np.mgrid[:n_rows, :n_cols]
+    images = np.array([1000*np.exp(-((cols - 30 - dx)**2 + (rows - 20 - dy)**2)/8) for dx, dy in disp], dtype=np.float32)
+    return xr.Dataset(
+        data_vars=dict(
+            images=(["exp_time", "x", "y"], images),
+            errors=(["exp_time", "x", "y"], np.ones(images.shape, dtype=np.float32)),
+            data_quality=(["exp_time", "x", "y"], np.zeros(images.shape, dtype=np.int16)),
+            badpix_mask=(["exp_time", "x", "packed_y"], packed_ones(images.shape), dict(unpacked_size=n_cols)),
+            meanstar_disp=(["exp_time", "xy"], disp),
+        ),
+        coords=dict(exp_time=np.arange(n_frames, dtype=float)),
+    )
+
+
+class TestAlignFrames(unittest.TestCase):
+    """ Test the exotic_uvis frame alignment stage. """
+
+    def test_a_registers_frames(self):
+        for method, tolerance in [('fourier', 1e-2), ('spline', 5.)]:
+            obs = make_obs()
+            reference = obs.images.values[0].copy()
+            align_frames(obs, method=method, n_workers=1, chunk_size=4)
+            self.assertLess(np.abs(obs.images.values - reference).max(), tolerance, msg=method)
+
+    def test_b_errors_and_dq(self):
+        obs = make_obs()
+        obs.data_quality.values[2, 20, 30] = 16
+        align_frames(obs, n_workers=1)
+
+        # A flagged pixel spreads to every output pixel that draws from it, and the edges become fill.
+        self.assertIn(np.sum(obs.data_quality.values[2] & 16 != 0), (1, 2, 4))
+        fill = (obs.data_quality.values & 2) != 0
+        self.assertFalse(fill[0].any())
+        self.assertTrue(np.array_equal(fill, ~get_badpix_mask(obs)))
+        self.assertTrue(np.all(obs.images.values[fill] == 0))
+
+        # Interpolating between pixels averages their noise down.
+        errors = obs.errors.values[~fill]
+        self.assertTrue(np.all((errors >= 0.5) & (errors <= 1)))
+
+    def test_c_fill_from_outside_only(self):
+        for method in ('fourier', 'spline'):
+            obs = make_obs()
+            shifts = np.zeros((6, 2))
+            shifts[1] = [2.5, -1.5]
+            # calwf3 already flagged a pixel as fill, but it still holds data.
+            obs.data_quality.values[1, 20, 30] = 2
+            align_frames(obs, displacements=shifts, method=method, n_workers=1)
+
+            # The frame moves 1.5 rows down and 2.5 columns left, so the top 2 rows and the
+            # last 3 columns are shifted in from outside. Only those are zeroed.
+            frame, dq = obs.images.values[1], obs.data_quality.values[1]
+            outside = np.zeros(frame.shape, dtype=bool)
+            outside[:2] = outside[:, -3:] = True
+            self.assertTrue(np.all(frame[outside] == 0), msg=method)
+            self.assertTrue(np.all(dq[outside] & 2 != 0), msg=method)
+
+            # The pixels drawing from the flagged one carry its flag but keep their data, near the star's peak.
+            self.assertTrue(np.all(dq[21:23, 27:29] & 2 != 0), msg=method)
+            self.assertTrue(np.all(frame[21:23, 27:29] > 100), msg=method)
+
+    def test_d_pool_matches_serial(self):
+        serial, pooled = make_obs(), make_obs()
+        align_frames(serial, n_workers=1)
+        align_frames(pooled, n_workers=2, chunk_size=2)
+        for name in ['images', 'errors', 'data_quality', 'badpix_mask']:
+            self.assertTrue(np.array_equal(serial[name].values, pooled[name].values), msg=name)
+
+
+if __name__ == '__main__':
+    unittest.main()
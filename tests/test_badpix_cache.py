@@ -0,0 +1,80 @@
+import os
+import io
+import shutil
+import unittest
+import contextlib
+import numpy as np
+
+from exotic_uvis.stage_1 import apply_badpix_cache, update_badpix_cache, laplacian_edge_detection
+from exotic_uvis.stage_1.badpix_cache import load_badpix_cache, cached_badpix
+from exotic_uvis.stage_1.data_quality import get_badpix_mask, OUTLIER_FLAG
+from exotic_uvis.stage_1.equivalence import synthetic_obs
+
+# Hot pixels in detector coordinates, 0-indexed (row, column), away from the 0th order LED leaves alone.
+HOT_PIXELS = np.array([[20, 40], [25, 100], [33, 300], [40, 350]])
+
+
+def make_visit(seed, row_offset, col_offset, n_frames=6, shape=(50, 400)):
+    """ Builds a visit whose subarray starts at the given detector offsets, with the hot pixels lit in every frame. """
+    obs = synthetic_obs(n_frames=n_frames, shape=shape, n_cosmic_rays=30, seed=seed)
+    obs.subarr_coords.values[:] = [col_offset + 1, col_offset + shape[1], row_offset + 1, row_offset + shape[0]]
+    obs.images.values[:, HOT_PIXELS[:, 0] - row_offset, HOT_PIXELS[:, 1] - col_offset] += 5000
+    return obs
+
+
+class TestBadpixCache(unittest.TestCase):
+    """ Test the exotic_uvis persistent bad pixel cache. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cache_dir = 'test_exotic_uvis_badpix_cache'
+        cls.cache_path = os.path.join(cls.cache_dir, 'uvis_badpix.npz')
+        if os.path.exists(cls.cache_dir):
+            shutil.rmtree(cls.cache_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cache_dir, ignore_errors=True)
+
+    def test_a_record_visit(self):
+        obs = make_visit(0, 0, 0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            laplacian_edge_detection(obs, n=2)
+            n = update_badpix_cache(obs, self.cache_path)
+            # Recording the same visit again replaces it.
+            update_badpix_cache(obs, self.cache_path)
+        cache = load_badpix_cache(self.cache_path)
+        self.assertEqual(len(cache['times']), 1)
+        self.assertEqual(cache['flagged'].shape[1], n)
+        recorded = set(map(tuple, cache['flagged'][1:].T))
+        self.assertTrue(set(map(tuple, HOT_PIXELS)) <= recorded)
+
+    def test_b_premask_shifted_visit(self):
+        # The next visit sits elsewhere on the detector, so its hot pixels are at other frame pixels.
+        obs, plain = make_visit(1, 5, 10), make_visit(1, 5, 10)
+        x, y = cached_badpix(obs, self.cache_path, min_visits=1)
+        self.assertEqual(len(cached_badpix(obs, self.cache_path, min_visits=2)[0]), 0)
+        self.assertTrue(set(map(tuple, HOT_PIXELS - [5, 10])) <= set(zip(x, y)))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            apply_badpix_cache(obs, self.cache_path, min_visits=1)
+        hot = (slice(None), HOT_PIXELS[:, 0] - 5, HOT_PIXELS[:, 1] - 10)
+        self.assertLess(np.max(np.abs(obs.images.values[hot] - plain.images.values[hot] + 5000)), 500)
+        self.assertFalse(np.any(get_badpix_mask(obs)[hot]))
+        self.assertTrue(np.all(obs.data_quality.values[hot] & 4))
+        self.assertEqual(obs.cached_badpix.shape, (len(x), 2))
+
+        # LED then has fewer outliers to find, and the premasked pixels are not recorded again.
+        with contextlib.redirect_stdout(io.StringIO()):
+            laplacian_edge_detection(obs, n=2)
+            laplacian_edge_detection(plain, n=2)
+            update_badpix_cache(obs, self.cache_path)
+        self.assertLess(np.sum(obs.data_quality.values & OUTLIER_FLAG != 0), np.sum(plain.data_quality.values & OUTLIER_FLAG != 0))
+        cache = load_badpix_cache(self.cache_path)
+        self.assertEqual(len(cache['times']), 2)
+        self.assertEqual(cache['skipped'].shape[1], len(x))
+        self.assertEqual(len(cached_badpix(obs, self.cache_path, min_visits=1, min_fraction=1)[0]), len(x))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import shutil
+import unittest
+from unittest import mock
+
+from exotic_uvis.batch import load_batch_config, run_batch
+
+
+def fake_reduce_visit(visit, output_dir):
+    """ Stands in for reduce_visit: 'crash' kills its worker, 'bad' raises, 'stop' exits, the others succeed. """
+    if visit['name'] == 'crash':
+        time.sleep(0.2)
+        os._exit(1)
+    if visit['name'] == 'bad':
+        raise ValueError("no data in {}".format(visit['data_dir']))
+    if visit['name'] == 'stop':
+        raise SystemExit(1)
+    time.sleep(0.5)
+    return dict(name=visit['name'], n_frames=visit['n_frames'], output=os.path.join(output_dir, visit['name']),
+                seconds=0.5, timings={})
+
+
+class TestBatch(unittest.TestCase):
+    """ Test the exotic_uvis multi-visit batch runner. """
+
+    def setUp(self):
+        self.output_dir = 'test_exotic_uvis_batch'
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+        os.makedirs(self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+    def write_config(self, names, **config):
+        path = os.path.join(self.output_dir, 'batch.json')
+        config.setdefault('visits', [dict(name=name, data_dir=name, n_frames=i + 1) for i, name in enumerate(names)])
+        with open(path, 'w') as f:
+            json.dump(config, f)
+        return path
+
+    def test_a_load_batch_config(self):
+        path = self.write_config(['v1', 'v2'], defaults=dict(precision='float64', stages=[['laplacian_edge_detection', {}]]),
+                                 retries=3)
+        config = load_batch_config(path)
+        self.assertEqual(config['retries'], 3)
+        self.assertEqual(config['max_workers'], os.cpu_count())
+        self.assertIsNone(config['memory_per_worker_GB'])
+        self.assertEqual(config['output_dir'], os.path.abspath(self.output_dir))
+        for visit in config['visits']:
+            self.assertEqual(visit['precision'], 'float64')
+            self.assertFalse(visit['download'])
+            self.assertEqual(visit['stages'], [['laplacian_edge_detection', {}]])
+
+        # A visit's own settings win over the defaults, and names must be unique.
+        path = self.write_config([], visits=[dict(name='v1', data_dir='a', precision='float32')], defaults=dict(precision='float64'))
+        self.assertEqual(load_batch_config(path)['visits'][0]['precision'], 'float32')
+        path = self.write_config(['v1', 'v1'])
+        with self.assertRaises(ValueError):
+            load_batch_config(path)
+
+    @mock.patch('exotic_uvis.batch.reduce_visit', fake_reduce_visit)
+    def test_b_retries_and_summary(self):
+        path = self.write_config(['v1', 'crash', 'v2', 'bad', 'v3'], max_workers=5, retries=1)
+        summary = run_batch(path)
+
+        # Visits in flight when a neighbour crashed are not charged for it.
+        self.assertEqual(summary['succeeded'], ['v1', 'v2', 'v3'])
+        self.assertEqual(summary['failed'], ['bad', 'crash'])
+        self.assertEqual(summary['attempts'], dict(v1=1, crash=2, v2=1, bad=2, v3=1))
+        self.assertIn('ValueError', summary['failures']['bad']['error'])
+        self.assertIn('BrokenProcessPool', summary['failures']['crash']['error'])
+        self.assertEqual(summary['frames'], 1 + 3 + 5)
+        self.assertAlmostEqual(summary['visit_seconds'], 1.5)
+        self.assertGreater(summary['frames_per_second'], 0)
+        with open(os.path.join(self.output_dir, 'batch_summary.json')) as f:
+            self.assertEqual(json.load(f)['failed'], ['bad', 'crash'])
+
+    @mock.patch('exotic_uvis.batch.reduce_visit', fake_reduce_visit)
+    def test_c_exit_stops_batch(self):
+        path = self.write_config(['stop'], max_workers=1, retries=3)
+        with self.assertRaises(SystemExit):
+            run_batch(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
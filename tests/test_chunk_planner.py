@@ -0,0 +1,81 @@
+import unittest
+import numpy as np
+import xarray as xr
+
+from exotic_uvis.utils import parse_memory, plan_chunks, plan_stage_chunks
+from exotic_uvis.stage_1 import (fixed_iteration_rejection, free_iteration_rejection, full_frame_bckg_subtraction,
+                                 corner_bkg_subtraction, surface_bckg_subtraction, align_frames)
+from exotic_uvis.stage_1.equivalence import synthetic_obs
+from exotic_uvis.stage_1.data_quality import packed_ones
+
+
+def make_obs(n_frames=15, n_rows=50, n_cols=70):
+    """ Builds an obs Dataset of noisy frames hit by cosmic rays, with an empty border outside the subarray. """
+    rng = np.random.default_rng(3)
+    images = rng.normal(100., 5., (n_frames, n_rows, n_cols)).astype(np.float32)
+    images[rng.integers(0, n_frames, 80), rng.integers(0, n_rows, 80), rng.integers(0, n_cols, 80)] += 400.
+    images[:, :, :5] = 0
+    return xr.Dataset(
+        data_vars=dict(
+            images=(["exp_time", "x", "y"], images),
+            data_quality=(["exp_time", "x", "y"], np.zeros(images.shape, dtype=np.int16)),
+            badpix_mask=(["exp_time", "x", "packed_y"], packed_ones(images.shape), dict(unpacked_size=n_cols)),
+        ),
+        coords=dict(exp_time=np.arange(n_frames, dtype=float)),
+    )
+
+
+class TestChunkPlanner(unittest.TestCase):
+    """ Test the exotic_uvis memory-budget chunk planner. """
+
+    def test_a_parse_and_plan(self):
+        self.assertEqual(parse_memory('512MB'), 512*2**20)
+        self.assertEqual(parse_memory('1.5 GB'), 3*2**29)
+        self.assertEqual(parse_memory(2048), 2048)
+        self.assertGreater(parse_memory('auto'), 0)
+        with self.assertRaises(ValueError):
+            parse_memory('lots')
+
+        self.assertEqual(plan_chunks(10, 100, None, start=5), [slice(5, 15)])
+        chunks = plan_chunks(10, 100, 350, start=5)
+        self.assertEqual(chunks, [slice(5, 8), slice(8, 11), slice(11, 14), slice(14, 15)])
+        self.assertEqual(plan_chunks(3, 100, 10), [slice(0, 1), slice(1, 2), slice(2, 3)])
+
+        # Row bands tile the region and each stays within the budget.
+        bands = plan_stage_chunks('free_iteration_rejection', (15, 50, 70), np.float32, '100KB', (slice(10, 40), slice(5, 70)))
+        self.assertEqual(bands[0].start, 10)
+        self.assertEqual(bands[-1].stop, 40)
+        self.assertGreater(len(bands), 1)
+
+    def test_b_chunked_stages_match(self):
+        for stage, kwargs in ((fixed_iteration_rejection, dict(sigmas=[5, 4])),
+                              (free_iteration_rejection, dict(threshold=3.5))):
+            whole, chunked = make_obs(), make_obs()
+            stage(whole, **kwargs)
+            stage(chunked, memory_budget=200000, **kwargs)
+            for name in ('images', 'data_quality', 'badpix_mask'):
+                self.assertTrue(np.array_equal(whole[name].values, chunked[name].values))
+            self.assertFalse(np.array_equal(whole.images.values, make_obs().images.values))
+
+    def test_c_frame_chunked_stages_match(self):
+        chunks = plan_stage_chunks('align_frames', (15, 50, 70), np.float32, '200KB')
+        self.assertEqual(chunks[0].start, 0)
+        self.assertEqual(chunks[-1].stop, 15)
+        self.assertGreater(len(chunks), 1)
+
+        rng = np.random.default_rng(4)
+        for stage, kwargs in ((full_frame_bckg_subtraction, dict(value='median')),
+                              (full_frame_bckg_subtraction, dict(bin_number=500)),
+                              (corner_bkg_subtraction, dict(hist_min=0, hist_max=60)),
+                              (surface_bckg_subtraction, dict()),
+                              (align_frames, dict(displacements=rng.uniform(-2, 2, (12, 2)), n_workers=1))):
+            whole, chunked = synthetic_obs(n_frames=12, shape=(40, 120)), synthetic_obs(n_frames=12, shape=(40, 120))
+            stage(whole, **kwargs)
+            stage(chunked, memory_budget=60000, **kwargs)
+            for name in ('images', 'data_quality', 'badpix_mask'):
+                self.assertTrue(np.array_equal(whole[name].values, chunked[name].values))
+            self.assertFalse(np.array_equal(whole.images.values, synthetic_obs(n_frames=12, shape=(40, 120)).images.values))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import sys
+import stat
+import socket
+import tempfile
+import subprocess
+import unittest
+import numpy as np
+from multiprocessing.connection import AuthenticationError
+
+from exotic_uvis import daemon
+from exotic_uvis.stage_1 import save_obs, load_obs, free_iteration_rejection
+from exotic_uvis.stage_1.equivalence import synthetic_obs
+
+
+class TestDaemon(unittest.TestCase):
+    """ Test the exotic_uvis resident reduction daemon. """
+
+    def test_a_stages_from_checkpoints(self):
+        obs = synthetic_obs(n_frames=12, shape=(50, 160), n_cosmic_rays=60)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = save_obs(obs, os.path.join(tmp, 'obs.nc'))
+            with socket.socket() as s:
+                s.bind(('localhost', 0))
+                port = s.getsockname()[1]
+            address = ('localhost', port)
+            output_dir = os.path.join(tmp, 'output')
+            os.makedirs(output_dir)
+            process = subprocess.Popen([sys.executable, '-m', 'exotic_uvis.daemon', path, str(port), output_dir],
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                loaded = daemon.get_images('loaded', address=address)
+                self.assertTrue(np.array_equal(loaded, obs.images.values))
+
+                # A stage run in the daemon matches the same stage run here.
+                for threshold in (5, 3.5):
+                    reply = daemon.run_stage('free_iteration_rejection', dict(threshold=threshold), address=address)
+                self.assertEqual(reply['checkpoint'], 'free_iteration_rejection')
+                expected = obs.copy(deep=True)
+                free_iteration_rejection(expected, threshold=3.5)
+                self.assertTrue(np.array_equal(daemon.get_images(reply['checkpoint'], address=address), expected.images.values))
+                self.assertTrue(np.array_equal(daemon.get_variable('data_quality', reply['checkpoint'], frames=3, address=address),
+                                               expected.data_quality.values[3]))
+
+                # The loaded visit is left as it was, and errors come back to the client.
+                self.assertTrue(np.array_equal(daemon.get_images('loaded', address=address), obs.images.values))
+                self.assertEqual(sorted(daemon.list_checkpoints(address=address)), ['free_iteration_rejection', 'loaded'])
+                with self.assertRaises(RuntimeError):
+                    daemon.run_stage('no_such_stage', address=address)
+                daemon.drop_checkpoint('free_iteration_rejection', address=address)
+                self.assertEqual(list(daemon.list_checkpoints(address=address)), ['loaded'])
+                daemon.shutdown(address=address)
+                self.assertEqual(process.wait(timeout=30), 0)
+                self.assertFalse(os.path.exists(daemon.key_path(address)))
+            finally:
+                if process.poll() is None:
+                    process.kill()
+
+    def test_b_key_stages_and_paths(self):
+        obs = synthetic_obs(n_frames=4, shape=(30, 60), n_cosmic_rays=10)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = save_obs(obs, os.path.join(tmp, 'obs.nc'))
+            with socket.socket() as s:
+                s.bind(('localhost', 0))
+                port = s.getsockname()[1]
+            address = ('localhost', port)
+            output_dir = os.path.join(tmp, 'output')
+            os.makedirs(output_dir)
+            process = subprocess.Popen([sys.executable, '-m', 'exotic_uvis.daemon', path, str(port), output_dir],
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                # The key is random and only readable by its user, and other keys are turned away.
+                daemon.list_checkpoints(address=address)
+                self.assertEqual(stat.S_IMODE(os.stat(daemon.key_path(address)).st_mode), 0o600)
+                self.assertNotEqual(daemon.read_key(address), b'exotic_uvis')
+                with self.assertRaises(AuthenticationError):
+                    daemon.list_checkpoints(address=address, authkey=b'exotic_uvis')
+
+                # Only the allowed stages run, and checkpoints are only saved inside the output directory.
+                with self.assertRaises(RuntimeError):
+                    daemon.run_stage('update_badpix_cache', dict(cache_path=os.path.join(tmp, 'cache.npz')), address=address)
+                self.assertFalse(os.path.exists(os.path.join(tmp, 'cache.npz')))
+                for outside in (os.path.join(tmp, 'obs_copy.nc'), os.path.join('..', 'obs_copy.nc')):
+                    with self.assertRaises(RuntimeError):
+                        daemon.save_checkpoint(outside, address=address)
+                self.assertFalse(os.path.exists(os.path.join(tmp, 'obs_copy.nc')))
+                saved = daemon.save_checkpoint('obs_copy.nc', address=address)
+                self.assertEqual(saved, os.path.join(os.path.realpath(output_dir), 'obs_copy.nc'))
+                self.assertTrue(np.array_equal(load_obs(saved).images.values, obs.images.values))
+
+                # Plots asked for by a stage are written to files rather than shown, so the daemon keeps serving.
+                daemon.run_stage('free_iteration_rejection', dict(plot=True, check_all=True), address=address)
+                self.assertIn('free_iteration_rejection', daemon.list_checkpoints(address=address))
+                daemon.shutdown(address=address)
+                self.assertEqual(process.wait(timeout=30), 0)
+                plots = os.listdir(os.path.join(output_dir, 'diagnostics'))
+                self.assertEqual(len(plots), 3 + obs.sizes['exp_time'])
+            finally:
+                if process.poll() is None:
+                    process.kill()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import numpy as np
+import xarray as xr
+
+from exotic_uvis.stage_1.data_quality import (
+    OUTLIER_FLAG, dq_bitmask, has_dq_flags, set_dq_flags, hits_from_mask, hits_to_mask, hits_union,
+    pack_mask, unpack_mask, packed_ones, set_packed_bits, get_badpix_mask, flag_badpix)
+
+
+class TestDataQuality(unittest.TestCase):
+    """ Test the exotic_uvis DQ flags, hit lists, and bit-packed bad pixel masks. """
+
+    def test_a_dq_flags(self):
+        self.assertEqual(dq_bitmask(['hot_pixel', 4, 'bad_flat']), 16 | 4 | 512)
+        self.assertEqual(OUTLIER_FLAG, 8)
+
+        # Flags are OR-ed in, keeping the calwf3 flags already there.
+        dq = np.zeros((4, 5), dtype=np.int16)
+        dq[1, 2] = 16
+        set_dq_flags(dq, (np.array([1, 3, 3]), np.array([2, 0, 0])), OUTLIER_FLAG)
+        self.assertEqual(dq[1, 2], 16 | 8)
+        self.assertEqual(dq[3, 0], 8)
+        self.assertEqual(np.count_nonzero(dq), 2)
+        self.assertTrue(np.array_equal(has_dq_flags(dq, 'hot_pixel'), dq == 24))
+        set_dq_flags(dq, (np.array([1]), np.array([2])), 4, overwrite=True)
+        self.assertEqual(dq[1, 2], 4)
+
+    def test_b_hit_lists(self):
+        rng = np.random.default_rng(0)
+        mask = rng.random((7, 9, 13)) < 0.1
+        hits = hits_from_mask(mask)
+        self.assertEqual(hits.shape, (3, np.count_nonzero(mask)))
+        self.assertTrue(np.array_equal(hits_to_mask(hits, mask.shape), mask))
+        other = hits_from_mask(rng.random(mask.shape) < 0.1)
+        merged = hits_to_mask(hits_union(mask.shape, hits, other), mask.shape)
+        self.assertTrue(np.array_equal(merged, mask | hits_to_mask(other, mask.shape)))
+
+    def test_c_packed_masks(self):
+        rng = np.random.default_rng(1)
+        for n_cols in (8, 13, 1, 30):
+            mask = rng.random((3, 5, n_cols)) < 0.7
+            packed = pack_mask(mask)
+            self.assertEqual(packed.shape, (3, 5, -(-n_cols//8)))
+            self.assertTrue(np.array_equal(unpack_mask(packed, n_cols), mask))
+            self.assertTrue(np.all(unpack_mask(packed_ones(mask.shape), n_cols)))
+
+            # Setting and clearing single bits matches doing it on the unpacked mask, including the last byte.
+            hits = (np.array([0, 2, 2, 1]), np.array([4, 0, 0, 3]), np.array([n_cols - 1, 0, n_cols//2, n_cols - 1]))
+            cleared, expected = packed.copy(), mask.copy()
+            set_packed_bits(cleared, hits, False)
+            expected[hits] = False
+            self.assertTrue(np.array_equal(unpack_mask(cleared, n_cols), expected))
+            set_packed_bits(cleared, hits, True)
+            expected[hits] = True
+            self.assertTrue(np.array_equal(unpack_mask(cleared, n_cols), expected))
+
+    def test_d_badpix_mask(self):
+        n_frames, n_rows, n_cols = 4, 6, 21
+        obs = xr.Dataset(dict(badpix_mask=(["exp_time", "x", "packed_y"], packed_ones((n_frames, n_rows, n_cols)),
+                                           dict(unpacked_size=n_cols))))
+        self.assertTrue(np.all(get_badpix_mask(obs)))
+        self.assertEqual(get_badpix_mask(obs).shape, (n_frames, n_rows, n_cols))
+
+        flag_badpix(obs, (np.array([1, 5]), np.array([20, 0])), k=2)
+        flag_badpix(obs, (np.array([0]), np.array([3]), np.array([17])))
+        expected = np.ones((n_frames, n_rows, n_cols), dtype=bool)
+        expected[2, 1, 20] = expected[2, 5, 0] = expected[0, 3, 17] = False
+        self.assertTrue(np.array_equal(get_badpix_mask(obs), expected))
+        self.assertTrue(np.array_equal(get_badpix_mask(obs, 2), expected[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
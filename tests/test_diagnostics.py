@@ -0,0 +1,43 @@
+import os
+import shutil
+import unittest
+import numpy as np
+
+from exotic_uvis.plotting import plot_exposure, plot_lines, plot_histogram, collect_diagnostics
+from exotic_uvis.plotting.diagnostics import downsample_image
+
+
+class TestDiagnostics(unittest.TestCase):
+    """ Test the exotic_uvis background diagnostics sink. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_dir = 'test_exotic_uvis_diagnostics'
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.output_dir, ignore_errors=True)
+
+    def test_a_downsample(self):
+        image = np.arange(100*300, dtype=float).reshape(100, 300)
+        small, extent = downsample_image(image, 2000)
+        self.assertLessEqual(small.size, 2000)
+        self.assertEqual(extent, (-0.5, 299.5, -0.5, 99.5))
+        self.assertAlmostEqual(small.mean(), image.mean())
+
+    def test_b_plots_to_files(self):
+        image = np.random.default_rng(0).normal(10, 1, (200, 600))
+        with collect_diagnostics(self.output_dir, max_pixels=10000):
+            plot_exposure([image, image], scatter_data=[[10, 500], [20, 150]], title='frame')
+            plot_lines(np.arange(5), np.arange(5)**2, xlabel='Exposure')
+            plot_histogram(np.linspace(0, 20, 41), np.histogram(image, bins=np.linspace(0, 20, 41))[0],
+                           markers=[(10, 'gray')], filename='histogram.png')
+        files = sorted(os.listdir(self.output_dir))
+        self.assertEqual(len(files), 4)
+        self.assertIn('histogram.png', files)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import io
+import unittest
+import contextlib
+import numpy as np
+
+from exotic_uvis.stage_1 import dq_premask, laplacian_edge_detection, fixed_iteration_rejection
+from exotic_uvis.stage_1.data_quality import get_badpix_mask, OUTLIER_FLAG
+from exotic_uvis.stage_1.equivalence import synthetic_obs
+
+# Pixels calwf3 flagged as hot (16) and as bad detector pixels (4), away from the 0th order LED leaves alone.
+HOT_PIXELS = np.array([[10, 40], [20, 120], [35, 300]])
+BAD_PIXELS = np.array([[15, 60], [40, 350]])
+
+
+def make_obs():
+    """ Builds a synthetic visit with flagged defects that are bright in every frame, and a warm pixel flag on a normal pixel. """
+    obs = synthetic_obs(n_frames=12, shape=(50, 400), n_cosmic_rays=40)
+    for pixels, flag in ((HOT_PIXELS, 16), (BAD_PIXELS, 4)):
+        obs.images.values[:, pixels[:, 0], pixels[:, 1]] += 5000
+        obs.data_quality.values[:, pixels[:, 0], pixels[:, 1]] = flag
+    obs.data_quality.values[:, 5, 200] = 64
+    return obs
+
+
+class TestDQPremask(unittest.TestCase):
+    """ Test the exotic_uvis DQ-aware premasking of bad pixels. """
+
+    def test_a_premask(self):
+        obs, plain = make_obs(), make_obs()
+        with contextlib.redirect_stdout(io.StringIO()):
+            dq_premask(obs)
+        flagged = (slice(None),) + tuple(np.concatenate([HOT_PIXELS, BAD_PIXELS]).T)
+        self.assertLess(np.max(np.abs(obs.images.values[flagged] - plain.images.values[flagged] + 5000)), 500)
+        self.assertFalse(np.any(get_badpix_mask(obs)[flagged]))
+
+        # Warm pixels are not premasked by default, and nothing else is touched.
+        self.assertTrue(np.all(get_badpix_mask(obs)[:, 5, 200]))
+        self.assertEqual(np.sum(~get_badpix_mask(obs)), 12*5)
+        self.assertTrue(np.array_equal(obs.data_quality.values, plain.data_quality.values))
+        with contextlib.redirect_stdout(io.StringIO()):
+            dq_premask(plain, flags='warm_pixel', replace=False)
+        self.assertFalse(np.any(get_badpix_mask(plain)[:, 5, 200]))
+
+    def test_b_outlier_flag(self):
+        obs, plain = make_obs(), make_obs()
+        with contextlib.redirect_stdout(io.StringIO()):
+            dq_premask(obs)
+            for o in (obs, plain):
+                laplacian_edge_detection(o, n=2)
+                fixed_iteration_rejection(o, sigmas=[5, 5])
+
+        # The outlier stages keep the calwf3 flags and record their own detections in a dedicated bit.
+        for o in (obs, plain):
+            self.assertTrue(np.all(o.data_quality.values[:, HOT_PIXELS[:, 0], HOT_PIXELS[:, 1]] & 16))
+            self.assertTrue(np.any(o.data_quality.values & OUTLIER_FLAG))
+        premasked = obs.data_quality.values[:, HOT_PIXELS[:, 0], HOT_PIXELS[:, 1]]
+        self.assertEqual(np.count_nonzero(premasked & OUTLIER_FLAG), 0)
+        self.assertLess(np.count_nonzero(obs.data_quality.values & OUTLIER_FLAG),
+                        np.count_nonzero(plain.data_quality.values & OUTLIER_FLAG))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from unittest import mock
+
+from exotic_uvis.stage_1 import equivalence_report
+from exotic_uvis.stage_1.equivalence import synthetic_obs
+from exotic_uvis.stage_1.reference_kernels import REFERENCE_KERNELS
+
+
+class TestEquivalence(unittest.TestCase):
+    """ Test the exotic_uvis reference equivalence harness. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.obs = synthetic_obs(n_frames=12, shape=(50, 160), n_cosmic_rays=60)
+
+    def test_a_stages_match_references(self):
+        kernels = [('laplacian_edge_detection', dict(n=2)),
+                   ('laplacian_edge_detection', dict(n=None, build_fine_structure=True)),
+                   ('free_iteration_rejection', dict(threshold=3.5)),
+                   ('full_frame_bckg_subtraction', dict(value='median')),
+                   ('corner_bkg_subtraction', dict(bounds=[[0, 10, 0, 30], [40, 50, 130, 160]])),
+                   ('track_bkgstars', dict(bkg_stars=[[40, 30]], window=8))]
+        report = equivalence_report(self.obs, kernels=kernels, verbose=False)
+        self.assertEqual(list(report), ['laplacian_edge_detection', 'laplacian_edge_detection #2', 'free_iteration_rejection',
+                                        'full_frame_bckg_subtraction', 'corner_bkg_subtraction', 'track_bkgstars'])
+        for name, result in report.items():
+            self.assertTrue(result['within_tolerance'], name)
+            self.assertGreater(result['speedup'], 0)
+
+    def test_b_detects_changes(self):
+        # A reference that leaves the cosmic rays in place must disagree with the stage.
+        with mock.patch.dict(REFERENCE_KERNELS, free_iteration_rejection=lambda obs, threshold: 0):
+            report = equivalence_report(self.obs, kernels=[('free_iteration_rejection', dict(threshold=3.5))], verbose=False)
+        result = report['free_iteration_rejection']
+        self.assertFalse(result['within_tolerance'])
+        self.assertGreater(result['n_outside_tolerance'], 0)
+        self.assertGreater(result['max_abs_diff'], 100)
+
+    def test_c_exemptions(self):
+        # The references overwrite DQ with 1 and have no bad pixel mask, which only the exemptions allow for.
+        kernels = [('laplacian_edge_detection', dict(n=2))]
+        report = equivalence_report(self.obs, kernels=kernels, verbose=False)['laplacian_edge_detection']
+        self.assertTrue(report['within_tolerance'])
+        self.assertEqual(report['exempt'], ['badpix_mask'])
+        strict = equivalence_report(self.obs, kernels=kernels, verbose=False, exemptions=())['laplacian_edge_detection']
+        self.assertFalse(strict['within_tolerance'])
+        self.assertGreater(strict['flag_mismatch'], 0)
+        self.assertEqual(strict['max_abs_diff'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import shutil
+import unittest
+import numpy as np
+from astropy.io import fits
+
+from exotic_uvis.utils import prefetch_fits, read_hdus, new_io_metrics
+
+
+class TestFitsPrefetch(unittest.TestCase):
+    """ Test the exotic_uvis read-ahead FITS loader. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = 'test_exotic_uvis_prefetch'
+        if os.path.exists(cls.data_dir):
+            shutil.rmtree(cls.data_dir)
+        os.makedirs(cls.data_dir)
+        cls.paths = []
+        for i in range(7):
+            path = os.path.join(cls.data_dir, 'frame{}_flt.fits'.format(i))
+            header = fits.Header([('EXPSTART', float(i))])
+            fits.HDUList([fits.PrimaryHDU(header=header),
+                          fits.ImageHDU(np.full((4, 5), i, dtype='>f4'))]).writeto(path)
+            cls.paths.append(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def test_a_in_order(self):
+        for depth in [0, 1, 3, 10]:
+            metrics = new_io_metrics()
+            results = list(prefetch_fits(self.paths, read_hdus, depth=depth, metrics=metrics))
+            self.assertEqual([path for path, _ in results], self.paths)
+            for i, (_, hdus) in enumerate(results):
+                self.assertEqual(hdus[0][0]['EXPSTART'], i)
+                np.testing.assert_array_equal(hdus[1][1], i)
+            self.assertEqual(metrics['files'], len(self.paths))
+            self.assertGreater(metrics['read'], 0)
+
+    def test_b_stop_early(self):
+        frames = prefetch_fits(self.paths, read_hdus, depth=3)
+        self.assertEqual(next(frames)[0], self.paths[0])
+        frames.close()
+
+    def test_c_errors_reach_caller(self):
+        with self.assertRaises(FileNotFoundError):
+            list(prefetch_fits(self.paths + ['missing_flt.fits'], read_hdus, depth=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import sys
+import subprocess
+import unittest
+
+# Dependencies that only some stages need, which must not be imported with the package.
+HEAVY_MODULES = ['matplotlib', 'wfc3tools', 'photutils', 'scipy.optimize', 'astroquery']
+
+
+def time_import(statement, repeats=3):
+    """ Times an import statement in fresh interpreters, returning the best time and the heavy modules it loaded. """
+    code = ("import sys, time\n"
+            "t = time.perf_counter()\n"
+            "{}\n"
+            "print(time.perf_counter() - t)\n"
+            "print(','.join(m for m in {!r} if m in sys.modules))").format(statement, HEAVY_MODULES)
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.split('\n')
+        times.append(float(out[0]))
+        loaded = [m for m in out[1].split(',') if m]
+    return min(times), loaded
+
+
+class TestImport(unittest.TestCase):
+    """ Test that importing exotic_uvis stays fast. """
+
+    def test_a_no_heavy_imports(self):
+        for statement in ["import exotic_uvis",
+                          "from exotic_uvis import stage_0, stage_1, plotting, utils",
+                          "from exotic_uvis.stage_1 import read_data, save_obs, load_obs",
+                          "from exotic_uvis.stage_1 import free_iteration_rejection, fixed_iteration_rejection"]:
+            _, loaded = time_import(statement)
+            self.assertEqual(loaded, [], msg=statement)
+
+    def test_b_import_time(self):
+        # Loading data should cost little more than the libraries read_data itself needs.
+        floor, _ = time_import("import numpy, xarray, tqdm, astropy.io.fits")
+        elapsed, _ = time_import("from exotic_uvis.stage_1 import read_data")
+        print("Import time of read_data: %.2f s (dependency floor %.2f s)" % (elapsed, floor))
+        self.assertLess(elapsed, floor + 0.5)
+
+    def test_c_lazy_names(self):
+        from exotic_uvis import stage_0, stage_1
+        import exotic_uvis.stage_0.quicklookup
+        self.assertTrue(callable(stage_0.quicklookup))
+        self.assertTrue(callable(stage_1.laplacian_edge_detection))
+        self.assertIn("read_data", dir(stage_1))
+        with self.assertRaises(AttributeError):
+            stage_1.not_a_function
+
+
+if __name__ == '__main__':
+    unittest.main()
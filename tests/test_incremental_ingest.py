@@ -0,0 +1,136 @@
+import os
+import io
+import shutil
+import unittest
+import contextlib
+from unittest import mock
+import numpy as np
+from astropy.io import fits
+
+from exotic_uvis.stage_1 import ingest_new_exposures, load_ingested, watch_directory
+from exotic_uvis.stage_1.incremental_ingest import incremental_temporal_rejection, load_running_stats, read_manifest
+from exotic_uvis.stage_1.equivalence import synthetic_obs
+from exotic_uvis.stage_1.data_quality import OUTLIER_FLAG
+
+N_ROWS, N_COLS = 12, 20
+
+
+def write_frames(data_dir, first, n, hot=None):
+    """ Writes n flt files numbered from first, with the spt files sub2full reads the subarray corners from. """
+    rng = np.random.default_rng(first)
+    for sub in ('specimages', 'directimages'):
+        os.makedirs(os.path.join(data_dir, sub), exist_ok=True)
+    for i in range(first, first + n):
+        image = rng.normal(100., 5., (N_ROWS, N_COLS)).astype('>f4')
+        if hot is not None and i == hot:
+            image[4, 7] += 1000
+        write_frame(os.path.join(data_dir, 'specimages', 'iexr16l{:02d}'.format(i)), image, 60000. + i/1000)
+    direct = os.path.join(data_dir, 'directimages', 'iexr16d00')
+    if not os.path.exists(direct + '_flt.fits'):
+        write_frame(direct, np.full((N_ROWS, N_COLS), 100., dtype='>f4'), 60000.)
+
+
+def write_frame(root, image, time):
+    """ Writes one flt file and its spt file. """
+    header = fits.Header([('EXPSTART', time), ('EXPEND', time + 1e-4), ('TIME-OBS', '01:00:00'),
+                          ('EXPTIME', 60.), ('POSTARG1', 0.), ('POSTARG2', 0.)])
+    fits.HDUList([fits.PrimaryHDU(header=header), fits.ImageHDU(image),
+                  fits.ImageHDU(np.sqrt(np.abs(image) + 25).astype('>f4')),
+                  fits.ImageHDU(np.zeros(image.shape, dtype='>i2'))]).writeto(root + '_flt.fits')
+    spt = fits.Header([('XCORNER', 0), ('YCORNER', 0), ('NUMROWS', image.shape[0]), ('NUMCOLS', image.shape[1])])
+    fits.HDUList([fits.PrimaryHDU(header=fits.Header([('SS_DTCTR', 'UVIS'), ('SS_SUBAR', 'YES')])),
+                  fits.ImageHDU(header=spt)]).writeto(root + '_spt.fits')
+
+
+class TestIncrementalIngest(unittest.TestCase):
+    """ Test the exotic_uvis incremental ingest of new exposures. """
+
+    def setUp(self):
+        self.data_dir = 'test_exotic_uvis_ingest_data'
+        self.store_dir = 'test_exotic_uvis_ingest_store'
+        self.tearDown()
+
+    def tearDown(self):
+        for directory in (self.data_dir, self.store_dir):
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def ingest(self, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ingest_new_exposures(self.data_dir, self.store_dir, verbose=0, **kwargs)
+
+    def test_a_running_stats_merge(self):
+        # Folding in batches matches the mean and variance of all the frames at once.
+        frames = synthetic_obs(n_frames=9, shape=(10, 16), n_cosmic_rays=0).images.values
+        frames[:, 2, 3] = np.nan
+        os.makedirs(self.store_dir)
+        for batch in (slice(0, 2), slice(2, 7), slice(7, 9)):
+            obs = synthetic_obs(n_frames=batch.stop - batch.start, shape=(10, 16), n_cosmic_rays=0)
+            obs.images.values[:] = frames[batch]
+            with contextlib.redirect_stdout(io.StringIO()):
+                obs, stats = incremental_temporal_rejection(obs, self.store_dir, sigma=1e6)
+            np.savez(os.path.join(self.store_dir, 'temporal_stats.npz'), count=stats[0], mean=stats[1], m2=stats[2])
+        count, mean, m2 = load_running_stats(self.store_dir, (10, 16))
+        all_frames = frames.astype(np.float64)
+        self.assertEqual(count[0, 0], 9)
+        self.assertEqual(count[2, 3], 0)
+        self.assertTrue(np.allclose(mean[count > 0], np.mean(all_frames, axis=0)[count > 0]))
+        self.assertTrue(np.allclose((m2/8)[count > 0], np.var(all_frames, axis=0, ddof=1)[count > 0], rtol=1e-5))
+
+    def test_b_manifest(self):
+        write_frames(self.data_dir, 0, 4)
+        self.assertEqual(len(self.ingest(min_frames=3).exp_time), 4)
+        write_frames(self.data_dir, 4, 3)
+        self.assertEqual(len(self.ingest(min_frames=3).exp_time), 3)
+        self.assertIsNone(self.ingest())
+
+        manifest = read_manifest(self.store_dir)
+        self.assertEqual(len(manifest['files']), 7)
+        self.assertEqual(manifest['parts'], ['obs_part_0000.nc', 'obs_part_0001.nc'])
+        self.assertEqual(sorted(f for f in os.listdir(self.store_dir) if f.endswith('.npz')), [manifest['stats']])
+        self.assertTrue(np.all(load_running_stats(self.store_dir, (N_ROWS, N_COLS))[0] == 7))
+        obs = load_ingested(self.store_dir)
+        self.assertEqual(obs.images.shape, (7, N_ROWS, N_COLS))
+        self.assertTrue(np.all(np.diff(obs.exp_time.values) > 0))
+
+    def test_c_interrupted_ingest(self):
+        write_frames(self.data_dir, 0, 4)
+        self.ingest(min_frames=3)
+        write_frames(self.data_dir, 4, 3)
+
+        # A failure after the statistics are computed leaves the store as it was.
+        with mock.patch('exotic_uvis.stage_1.incremental_ingest.save_obs', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.ingest(min_frames=3)
+        self.assertEqual(len(read_manifest(self.store_dir)['files']), 4)
+        self.assertTrue(np.all(load_running_stats(self.store_dir, (N_ROWS, N_COLS))[0] == 4))
+
+        # The next poll ingests the frames once.
+        self.ingest(min_frames=3)
+        self.assertEqual(len(read_manifest(self.store_dir)['files']), 7)
+        self.assertTrue(np.all(load_running_stats(self.store_dir, (N_ROWS, N_COLS))[0] == 7))
+
+    def test_d_per_pixel_min_frames(self):
+        # A pixel that never holds data does not stop the others from using their running statistics.
+        write_frames(self.data_dir, 0, 6)
+        for i in range(6):
+            with fits.open(os.path.join(self.data_dir, 'specimages', 'iexr16l{:02d}_flt.fits'.format(i)), mode='update') as hdul:
+                hdul[1].data[0, 0] = np.nan
+        self.ingest(min_frames=3)
+        self.assertEqual(load_running_stats(self.store_dir, (N_ROWS, N_COLS))[0][0, 0], 0)
+
+        # A single new frame can only be judged against the running statistics.
+        write_frames(self.data_dir, 6, 1, hot=6)
+        obs = self.ingest(min_frames=3)
+        self.assertTrue(obs.data_quality.values[0, 4, 7] & OUTLIER_FLAG)
+        self.assertLess(obs.images.values[0, 4, 7], 200)
+
+    def test_e_watch_directory(self):
+        write_frames(self.data_dir, 0, 3)
+        with contextlib.redirect_stdout(io.StringIO()):
+            n_ingests = watch_directory(self.data_dir, self.store_dir, poll_interval=0, max_polls=3, verbose=0)
+        self.assertEqual(n_ingests, 1)
+        self.assertEqual(len(read_manifest(self.store_dir)['files']), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import io
+import unittest
+import contextlib
+import numpy as np
+
+from exotic_uvis.stage_1 import laplacian_edge_detection
+from exotic_uvis.stage_1.equivalence import synthetic_obs
+from exotic_uvis.stage_1.laplacian_edge_detection import led_state, update_led_state, led_intermediates
+
+
+class TestIncrementalLED(unittest.TestCase):
+    """ Test the exotic_uvis incremental Laplacian edge detection. """
+
+    def test_a_update_matches_rebuild(self):
+        rng = np.random.default_rng(5)
+        frame = rng.normal(100., 5., (70, 150)).astype(np.float32)
+        errs = np.full(frame.shape, 12., dtype=np.float32)
+        for build_fine_structure in (False, True):
+            state = led_state(frame.copy(), errs, build_fine_structure=build_fine_structure)
+            # Change pixels in the middle, and at the edges and corners where the Laplacian wraps around.
+            changed = (np.array([0, 0, 35, 69, 69, 10, 69]), np.array([0, 149, 70, 0, 149, 149, 75]))
+            new_frame = frame.copy()
+            new_frame[changed] += 500.
+            update_led_state(state, new_frame, errs, changed)
+            S, resample, F = led_intermediates(new_frame, errs, build_fine_structure=build_fine_structure)
+            self.assertTrue(np.array_equal(state['S'], S))
+            self.assertTrue(np.array_equal(state['resample'], resample))
+            if build_fine_structure:
+                # Non-positive fine structure values keep the mean of the first build.
+                positive = state['F_raw'] > 0
+                self.assertTrue(np.array_equal(state['F'][positive], F[positive]))
+                self.assertTrue(np.all(state['F'][~positive] == state['F_fill']))
+
+    def test_b_same_results(self):
+        obs = synthetic_obs(n_frames=3, shape=(60, 300), n_cosmic_rays=150)
+        for kwargs in (dict(n=3, sigma=4), dict(n=None, sigma=5, build_fine_structure=True)):
+            full, incremental = obs.copy(deep=True), obs.copy(deep=True)
+            with contextlib.redirect_stdout(io.StringIO()):
+                laplacian_edge_detection(full, **kwargs)
+                laplacian_edge_detection(incremental, incremental=True, **kwargs)
+            for name in ('images', 'data_quality', 'badpix_mask'):
+                self.assertTrue(np.array_equal(full[name].values, incremental[name].values))
+
+    def test_c_non_positive_noise_stays_local(self):
+        rng = np.random.default_rng(7)
+        frame = rng.normal(100., 5., (70, 150)).astype(np.float32)
+        errs = np.full(frame.shape, 12., dtype=np.float32)
+        # A dead patch with no counts and no error has zero noise.
+        frame[20:30, 40:60], errs[20:30, 40:60] = 0., 0.
+        state = led_state(frame.copy(), errs, build_fine_structure=True)
+        images = {name: state[name] for name in ('noise', 'S', 'S_median', 'F')}
+        fill = state['noise_fill']
+
+        changed = (np.array([25, 50]), np.array([45, 120]))
+        new_frame = frame.copy()
+        new_frame[changed] += 500.
+        update_led_state(state, new_frame, errs, changed)
+
+        # The images are updated in place rather than rebuilt, and the dead pixels keep the first mean.
+        for name, image in images.items():
+            self.assertIs(state[name], image)
+        self.assertEqual(state['noise_fill'], fill)
+        dead = state['noise_raw'] <= 0
+        self.assertTrue(np.any(dead))
+        self.assertTrue(np.all(state['noise'][dead] == fill))
+        self.assertTrue(np.array_equal(state['noise'][~dead], state['noise_raw'][~dead]))
+
+        # Away from the dead patch the images match a rebuild.
+        S, resample, F = led_intermediates(new_frame, errs, build_fine_structure=True)
+        self.assertTrue(np.array_equal(state['resample'], resample))
+        self.assertTrue(np.array_equal(state['S'][:, 80:], S[:, 80:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
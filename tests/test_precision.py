@@ -0,0 +1,96 @@
+import os
+import shutil
+import unittest
+import numpy as np
+import xarray as xr
+from astropy.io import fits
+
+from exotic_uvis.stage_1 import read_data, set_precision, precision_report
+
+N_FRAMES, N_ROWS, N_COLS = 3, 12, 20
+
+
+def write_visit(data_dir):
+    """ Writes a tiny visit of flt files, with the spt files sub2full reads the subarray corners from. """
+    rng = np.random.default_rng(0)
+    for sub in ('specimages', 'directimages'):
+        os.makedirs(os.path.join(data_dir, sub))
+    for i in range(N_FRAMES + 1):
+        sub = 'specimages' if i < N_FRAMES else 'directimages'
+        root = os.path.join(data_dir, sub, 'iexr16l{:02d}'.format(i))
+        header = fits.Header([('EXPSTART', 60000. + i/100), ('EXPEND', 60000.001 + i/100), ('TIME-OBS', '01:00:00'),
+                              ('EXPTIME', 60.), ('POSTARG1', 0.), ('POSTARG2', 0.)])
+        image = rng.normal(100., 5., (N_ROWS, N_COLS)).astype('>f4')
+        fits.HDUList([fits.PrimaryHDU(header=header), fits.ImageHDU(image),
+                      fits.ImageHDU(np.sqrt(image + 25).astype('>f4')),
+                      fits.ImageHDU(np.zeros((N_ROWS, N_COLS), dtype='>i2'))]).writeto(root + '_flt.fits')
+        spt = fits.Header([('XCORNER', 0), ('YCORNER', 0), ('NUMROWS', N_ROWS), ('NUMCOLS', N_COLS)])
+        fits.HDUList([fits.PrimaryHDU(header=fits.Header([('SS_DTCTR', 'UVIS'), ('SS_SUBAR', 'YES')])),
+                      fits.ImageHDU(header=spt)]).writeto(root + '_spt.fits')
+
+
+def divide_by_three(obs):
+    """ A stage whose result depends on the working precision. """
+    obs.images.values[:] /= 3
+
+
+class TestPrecision(unittest.TestCase):
+    """ Test the exotic_uvis working precision. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = 'test_exotic_uvis_precision'
+        if os.path.exists(cls.data_dir):
+            shutil.rmtree(cls.data_dir)
+        write_visit(cls.data_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def test_a_read_data(self):
+        obs = read_data(self.data_dir, verbose=0)
+        self.assertEqual(obs.images.shape, (N_FRAMES, N_ROWS, N_COLS))
+        for var in ('images', 'errors', 'direct_image'):
+            self.assertEqual(obs[var].dtype, np.float32)
+        self.assertEqual(obs.attrs['precision'], 'float32')
+
+        obs64 = read_data(self.data_dir, verbose=0, precision='float64')
+        self.assertEqual(obs64.images.dtype, np.float64)
+        self.assertEqual(obs64.attrs['precision'], 'float64')
+        self.assertTrue(np.array_equal(obs64.images.values, obs.images.values))
+
+    def test_b_set_precision(self):
+        obs = read_data(self.data_dir, verbose=0)
+        obs64 = set_precision(obs, 'float64')
+        self.assertEqual(obs64.images.dtype, np.float64)
+        self.assertEqual(obs64.errors.dtype, np.float64)
+        self.assertEqual(obs64.data_quality.dtype, obs.data_quality.dtype)
+        self.assertEqual(obs.images.dtype, np.float32)
+        obs64.images.values[:] = 0
+        self.assertGreater(obs.images.values.min(), 0)
+
+        # The float32 path keeps its dtypes through a stage.
+        obs32 = set_precision(obs64, 'float32')
+        divide_by_three(obs32)
+        self.assertEqual(obs32.images.dtype, np.float32)
+
+    def test_c_precision_report(self):
+        images = np.array([[[1., 2.], [4., 10.]]]*2)
+        obs = xr.Dataset(dict(images=(["exp_time", "x", "y"], images),
+                              errors=(["exp_time", "x", "y"], np.full(images.shape, 0.5)),
+                              data_quality=(["exp_time", "x", "y"], np.zeros(images.shape, dtype=np.int16))))
+        report = precision_report(obs, [(divide_by_three, dict())], verbose=False)
+
+        diff = np.abs(images.astype(np.float32)/np.float32(3) - images/3)
+        self.assertAlmostEqual(report['max_abs_diff'], diff.max())
+        self.assertAlmostEqual(report['rms_diff_over_noise'], np.sqrt(np.mean(diff**2))/0.5)
+        flux32 = np.sum((images.astype(np.float32)/np.float32(3)).astype(np.float64), axis=(1, 2))
+        self.assertAlmostEqual(report['white_light_ppm'], np.max(np.abs(flux32/(images.sum(axis=(1, 2))/3) - 1))*1e6)
+        self.assertEqual(report['flag_mismatch'], 0)
+        self.assertEqual(report['memory_MB'], {'float64': 2*8*8/1e6, 'float32': 2*8*4/1e6})
+        self.assertTrue(np.array_equal(obs.images.values, images))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import numpy as np
+
+from exotic_uvis.stage_0.quicklookup import box_flux, assign_orbits, get_transit
+
+
+class TestQuicklook(unittest.TestCase):
+    """ Test the exotic_uvis quick-look light curve. """
+
+    def test_a_box_flux(self):
+        images = np.arange(3*6*8, dtype=np.float32).reshape(3, 6, 8)
+        section = [1, 4, 2, 7]
+        expected = [images[k, 1:4, 2:7].sum() for k in range(3)]
+        self.assertTrue(np.allclose(box_flux(images, section), expected))
+
+        # A boolean mask of the same box gives the same flux, and any other aperture works too.
+        mask = np.zeros((6, 8), dtype=bool)
+        mask[1:4, 2:7] = True
+        self.assertTrue(np.allclose(box_flux(images, mask), expected))
+        mask[:] = False
+        mask[0, 0], mask[5, 7] = True, True
+        self.assertTrue(np.allclose(box_flux(images, mask), images[:, 0, 0] + images[:, 5, 7]))
+        self.assertEqual(box_flux(images, mask).dtype, np.float64)
+
+    def test_b_assign_orbits(self):
+        minute = 1/1440
+        exp_times = np.concatenate([np.arange(5)*2*minute, 100*minute + np.arange(4)*2*minute,
+                                    200*minute + np.arange(3)*2*minute])
+        self.assertEqual(assign_orbits(exp_times).tolist(), [0]*5 + [1]*4 + [2]*3)
+
+        # Orbits follow time order, whatever the order of the exposures.
+        shuffled = np.random.default_rng(1).permutation(len(exp_times))
+        self.assertTrue(np.array_equal(assign_orbits(exp_times[shuffled]), assign_orbits(exp_times)[shuffled]))
+
+        # Only gaps larger than orbit_gap split orbits.
+        self.assertEqual(assign_orbits(exp_times, orbit_gap=200*minute).tolist(), [0]*12)
+        self.assertEqual(assign_orbits([0, 44*minute, 90*minute]).tolist(), [0, 0, 1])
+
+    def test_c_get_transit(self):
+        minute = 1/1440
+        exp_times = np.concatenate([np.arange(5)*2*minute, 100*minute + np.arange(5)*2*minute])
+        levels = np.concatenate([np.full(5, 100.), np.full(5, 130.)])
+        levels[2] = 90.
+        images = np.ones((10, 6, 8))*levels[:, None, None]
+
+        for section in ([0, 6, 0, 8], np.ones((6, 8), dtype=bool)):
+            white_light = get_transit(exp_times, images, section)
+            self.assertEqual(white_light.orbit.values.tolist(), [0]*5 + [1]*5)
+            for orbit in (0, 1):
+                self.assertAlmostEqual(np.median(white_light.values[white_light.orbit.values == orbit]), 1.)
+            self.assertAlmostEqual(white_light.values[2], 0.9)
+            self.assertTrue(np.allclose(white_light.raw_flux.values, levels*48))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import unittest
+import numpy as np
+from PIL import Image
+
+from exotic_uvis.plotting.render_animation import render_frames, save_frames
+from exotic_uvis.stage_0.quicklookup import create_gif
+
+
+class TestRenderAnimation(unittest.TestCase):
+    """ Test the exotic_uvis headless quicklook animation. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_dir = 'test_exotic_uvis_render_animation'
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+
+        rng = np.random.default_rng(0)
+        cls.n_frames = 5
+        cls.images = rng.uniform(1, 1000, (cls.n_frames, 40, 60))
+        cls.exp_times = np.arange(cls.n_frames, dtype=float)
+        cls.total_flux = cls.images.sum(axis=(1, 2))
+        cls.partial_flux = cls.images[:, 10:20, 20:40].sum(axis=(1, 2))
+        cls.section = [10, 20, 20, 40]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.output_dir, ignore_errors=True)
+
+    def test_a_render_frames(self):
+        frames = render_frames(self.exp_times, self.images.copy(), self.total_flux, self.partial_flux, self.section,
+                               n_workers=1, chunk_size=2, figsize=(4, 3), dpi=50)
+        self.assertEqual(len(frames), self.n_frames)
+        self.assertEqual(frames[0].shape, (150, 200, 3))
+        self.assertEqual(frames[0].dtype, np.uint8)
+        # Each frame shows a different exposure.
+        self.assertFalse(np.array_equal(frames[0], frames[-1]))
+
+        # Frames rendered by a pool of workers come back in order and match the serial ones.
+        pooled = render_frames(self.exp_times, self.images.copy(), self.total_flux, self.partial_flux, self.section,
+                               n_workers=2, chunk_size=2, figsize=(4, 3), dpi=50)
+        for serial, parallel in zip(frames, pooled):
+            self.assertTrue(np.array_equal(serial, parallel))
+
+        path = os.path.join(self.output_dir, 'frames.gif')
+        save_frames(frames, path, fps=5)
+        with Image.open(path) as gif:
+            self.assertEqual(gif.n_frames, self.n_frames)
+            self.assertEqual(gif.size, (200, 150))
+
+    def test_b_create_gif(self):
+        # Nothing is written unless asked for.
+        create_gif(self.exp_times, self.images.copy(), self.total_flux, self.partial_flux, self.section, self.output_dir,
+                   n_workers=1)
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'quicklookup.gif')))
+        create_gif(self.exp_times, self.images.copy(), self.total_flux, self.partial_flux, self.section, self.output_dir,
+                   save_fig=True, n_workers=1)
+        with Image.open(os.path.join(self.output_dir, 'quicklookup.gif')) as gif:
+            self.assertEqual(gif.n_frames, self.n_frames)
+
+
+if __name__ == '__main__':
+    unittest.main()
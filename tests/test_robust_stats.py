@@ -0,0 +1,80 @@
+import unittest
+import numpy as np
+
+from exotic_uvis.utils import nanmedian, nanstd, nanmad, nanhistogram, nanmode, sigma_clip, sigma_clipped_stats
+
+
+class TestRobustStats(unittest.TestCase):
+    """ Test the exotic_uvis robust statistics kernels. """
+
+    @classmethod
+    def setUpClass(cls):
+        # Build a small cube with a few outliers and non-finite values.
+        rng = np.random.default_rng(42)
+        cls.cube = rng.normal(5., 10., (12, 30, 40)).astype(np.float32)
+        cls.cube[rng.integers(0, 12, 50), rng.integers(0, 30, 50), rng.integers(0, 40, 50)] += 500.
+        cls.cube[3, 4, 5] = np.nan
+        cls.cube[7, 1, 2] = np.inf
+
+    def test_a_histogram_and_mode(self):
+        for k, frame in enumerate(self.cube):
+            finite = frame[np.isfinite(frame)]
+            hist, edges = np.histogram(finite, bins=200)
+            ind = np.argmax(hist)
+            self.assertEqual(nanmode(self.cube, axis=(1, 2), bins=200)[k], (edges[ind] + edges[ind + 1])/2)
+
+            edges = np.linspace(-60, 60, 500)
+            counts, _ = nanhistogram(frame, bins=edges)
+            self.assertTrue(np.array_equal(counts, np.histogram(finite, bins=edges)[0]))
+
+    def test_b_median_std_mad(self):
+        finite = self.cube[np.isfinite(self.cube)]
+        self.assertEqual(nanmedian(self.cube[0], axis=None), np.median(self.cube[0]))
+        self.assertEqual(nanmedian(np.where(np.isinf(self.cube), np.nan, self.cube)), np.median(finite))
+        self.assertTrue(np.allclose(nanstd(self.cube[:2], axis=0), np.std(self.cube[:2], axis=0, dtype=np.float64)))
+        self.assertAlmostEqual(nanmad(self.cube[0]), np.median(np.abs(self.cube[0] - np.median(self.cube[0]))))
+
+    def test_c_sigma_clip(self):
+        # Clipping each pixel in time must match clipping each time series on its own.
+        series = self.cube[:, :, :10].reshape(12, -1)
+        kept, median, std = sigma_clip(series, axis=0, sigma=3.5, cumulative=False)
+        for j in range(series.shape[1]):
+            mask = np.isfinite(series[:, j])
+            while True:
+                n = np.sum(mask)
+                med = np.median(series[mask, j])
+                sig = np.std(series[mask, j], dtype=np.float64)
+                mask = np.isfinite(series[:, j]) & (np.abs(series[:, j] - med) < 3.5*sig)
+                if np.sum(mask) == n:
+                    break
+            self.assertTrue(np.array_equal(kept[:, j], mask))
+            self.assertEqual(median[j], med)
+
+        mean, median, std = sigma_clipped_stats(self.cube[0], sigma=3.)
+        self.assertLess(abs(median - 5.), 2.)
+        self.assertLess(abs(std - 10.), 2.)
+
+    def test_d_matches_astropy(self):
+        from astropy.stats import sigma_clip as astropy_sigma_clip, sigma_clipped_stats as astropy_stats
+
+        rng = np.random.default_rng(8)
+        data = np.concatenate([rng.normal(0., 1., 400), rng.normal(0., 6., 40), [30., -25., np.nan, np.inf]])
+        # Values exactly on the bounds are kept: the median is 0 and the std 1, so the bounds are -1 and 1.
+        on_bounds = np.tile([-1., 1.], 20)
+        for values, sigma in ((data, 2.), (data, 3.), (on_bounds, 1.)):
+            for maxiters in (1, 5, None):
+                expected = astropy_sigma_clip(values, sigma=sigma, maxiters=maxiters)
+                kept, _, _ = sigma_clip(values, sigma=sigma, maxiters=maxiters)
+                self.assertTrue(np.array_equal(kept, ~np.ma.getmaskarray(expected)))
+            for stat, expected in zip(sigma_clipped_stats(values, sigma=sigma), astropy_stats(values, sigma=sigma)):
+                self.assertAlmostEqual(stat, expected, places=10)
+
+        # Clipping along an axis matches too.
+        cube = self.cube.astype(np.float64)
+        kept, _, _ = sigma_clip(cube, axis=0, sigma=2.5)
+        expected = astropy_sigma_clip(cube, axis=0, sigma=2.5, maxiters=None)
+        self.assertTrue(np.array_equal(kept, ~np.ma.getmaskarray(expected)))
+
+
+if __name__ == '__main__':
+    unittest.main()
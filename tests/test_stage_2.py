@@ -0,0 +1,141 @@
+import os
+import shutil
+import unittest
+import numpy as np
+import xarray as xr
+
+from exotic_uvis import stage_2
+from exotic_uvis.stage_2.grism_config import trace_table
+from exotic_uvis.stage_2.bin_light_curves import wavelength_binning_matrix
+from exotic_uvis.stage_1.data_quality import packed_ones, flag_badpix
+
+# A GRISMCONF-format configuration with straight, slightly tilted +1 and -1 orders. The trace row
+# offset of the +1 order depends on the full-frame x position of the source.
+CONFIG = """
+INSTRUMENT WFC3
+FILTER G280
+# order +1
+DISPX_+1_0 0
+DISPX_+1_1 200
+DISPY_+1_0 2 0.01 0
+DISPY_+1_1 4
+DISPL_+1_0 2000
+DISPL_+1_1 4000
+# order -1
+DISPX_-1_0 -10
+DISPX_-1_1 -150
+DISPY_-1_0 -3
+DISPY_-1_1 -2
+DISPL_-1_0 2000
+DISPL_-1_1 3000
+"""
+
+
+def make_obs(config_path, n_frames=5, n_rows=100, n_cols=500, position=(250., 50.), sigma=1.5, noise=0.):
+    """ Builds an obs Dataset with the two orders of the configuration drawn as Gaussian traces. """
+    rng = np.random.default_rng(7)
+    config = stage_2.read_grismconf(config_path)
+    rows = np.arange(n_rows)[:, None]
+    images = np.zeros((n_frames, n_rows, n_cols))
+    true_flux = {}
+    for order in ['+1', '-1']:
+        columns, trace_rows, wavelengths = trace_table(
+            config[order], *position, np.arange(n_cols), field_position=(position[0] + 100, position[1]))
+        flux = 50 + wavelengths/100
+        profile = np.exp(-(rows - trace_rows[None, :])**2/(2*sigma**2))/np.sqrt(2*np.pi*sigma**2)
+        images[:, :, columns] += profile*flux
+        true_flux[order] = (wavelengths, flux)
+    errors = np.sqrt(1 + np.abs(images))
+    images += noise*errors*rng.standard_normal(images.shape)
+
+    obs = xr.Dataset(
+        data_vars=dict(
+            images=(["exp_time", "x", "y"], images.astype(np.float32)),
+            errors=(["exp_time", "x", "y"], errors.astype(np.float32)),
+            badpix_mask=(["exp_time", "x", "packed_y"], packed_ones(images.shape), dict(unpacked_size=n_cols)),
+            subarr_coords=(["exp_time", "index"], np.tile([101, 100 + n_cols, 1, n_rows], (n_frames, 1))),
+        ),
+        coords=dict(exp_time=np.arange(n_frames, dtype=float)),
+        attrs=dict(target_posx=position[0], target_posy=position[1]),
+    )
+    return obs, true_flux
+
+
+class TestStage2(unittest.TestCase):
+    """ Test exotic_uvis stage 2. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.local_data_path = 'test_exotic_uvis_stage_2'
+        if os.path.exists(cls.local_data_path):
+            shutil.rmtree(cls.local_data_path)
+        os.mkdir(cls.local_data_path)
+        cls.config_path = os.path.join(cls.local_data_path, 'G280_test.conf')
+        with open(cls.config_path, 'w') as f:
+            f.write(CONFIG)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.local_data_path, ignore_errors=True)
+
+    def test_a_read_config(self):
+        config = stage_2.read_grismconf(self.config_path)
+        self.assertEqual(sorted(config), ['+1', '-1'])
+        self.assertEqual(len(config['+1']['DISPY']), 2)
+        self.assertTrue(np.array_equal(config['+1']['DISPY'][0], [2, 0.01, 0]))
+        self.assertEqual(config['+1']['keywords']['FILTER'], ['G280'])
+
+    def test_b_tables(self):
+        obs, _ = make_obs(self.config_path)
+        tables = stage_2.extraction_tables(obs, self.config_path, halfwidth=6.5)
+        plus = tables['+1']
+        self.assertTrue(np.all(np.diff(plus['wavelengths']) > 0))
+        self.assertTrue(np.allclose(plus['wavelengths'], 2000 + 4000*(plus['columns'] - 250)/200))
+        # The field dependence is evaluated at the full-frame position, x0 + 100.
+        self.assertTrue(np.allclose(plus['trace_rows'], 50 + 2 + 0.01*350 + 4*(plus['columns'] - 250)/200))
+        self.assertTrue(np.allclose(plus['weights'].sum(axis=1), 13))
+
+    def test_c_box_and_optimal(self):
+        obs, true_flux = make_obs(self.config_path)
+        for method in ['box', 'optimal']:
+            spectra = stage_2.extract_spectra(obs, self.config_path, method=method, halfwidth=8)
+            for order, (wavelengths, flux) in true_flux.items():
+                spec = spectra[order]
+                self.assertEqual(spec.spec.shape, (5, len(flux)))
+                expected = np.interp(spec.wavelength.values, np.sort(wavelengths), flux[np.argsort(wavelengths)])
+                self.assertTrue(np.allclose(spec.spec.values, expected, rtol=1e-3), msg=(method, order))
+
+    def test_d_optimal_is_less_noisy(self):
+        obs, _ = make_obs(self.config_path, n_frames=30, noise=1.)
+        flag_badpix(obs, (np.array([0]), np.array([54]), np.array([300])))
+        box = stage_2.extract_spectra(obs, self.config_path, orders=('+1',), method='box', halfwidth=10)['+1']
+        optimal = stage_2.extract_spectra(obs, self.config_path, orders=('+1',), method='optimal', halfwidth=10)['+1']
+        self.assertTrue(np.all(optimal.spec_err < box.spec_err))
+        self.assertLess(np.std(optimal.spec.values, axis=0).mean(), np.std(box.spec.values, axis=0).mean())
+
+    def test_e_binning_matrix(self):
+        wavelengths = np.arange(10.)
+        matrix = wavelength_binning_matrix(wavelengths, [-0.5, 2, 9.5])
+        self.assertTrue(np.allclose(matrix.toarray().sum(axis=0), 1))
+        self.assertTrue(np.allclose(matrix.toarray()[0], [1, 1, 0.5, 0, 0, 0, 0, 0, 0, 0]))
+
+    def test_f_bin_light_curves(self):
+        obs, _ = make_obs(self.config_path, n_frames=4, noise=1.)
+        bin_edges = np.linspace(2500, 5500, 7)
+        spectra = stage_2.extract_spectra(obs, self.config_path, orders=('+1',), method='box', halfwidth=8)['+1']
+        binned = stage_2.bin_light_curves(spectra, bin_edges)
+        self.assertEqual(binned.light_curve.shape, (4, 6))
+
+        # Binning the pixels directly is the same as box extraction followed by binning.
+        direct = stage_2.bin_image_light_curves(obs, self.config_path, bin_edges, order='+1', halfwidth=8)
+        self.assertTrue(np.allclose(direct.light_curve, binned.light_curve, rtol=1e-5))
+        self.assertTrue(np.allclose(direct.light_curve_err, binned.light_curve_err, rtol=1e-5))
+
+        # Bins that hold whole spectral elements are their plain sums.
+        inside = (spectra.wavelength > bin_edges[1] + 20) & (spectra.wavelength < bin_edges[2] - 20)
+        self.assertLess(binned.light_curve.values[0, 1] - spectra.spec.values[0, inside.values].sum(), 2*spectra.spec.values[0].max())
+        self.assertGreater(binned.light_curve.values[0, 1], spectra.spec.values[0, inside.values].sum())
+
+
+if __name__ == '__main__':
+    unittest.main()
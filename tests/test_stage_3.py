@@ -0,0 +1,67 @@
+import unittest
+import numpy as np
+import xarray as xr
+
+from exotic_uvis import stage_3
+from exotic_uvis.stage_3.transit_model import circle_overlap
+
+
+def make_light_curves(rp, noise=100e-6, seed=0):
+    """ Builds four HST-like orbits of light curves of a transit with orbit ramps and a visit trend. """
+    rng = np.random.default_rng(seed)
+    time = np.concatenate([60000 + k*96/1440 + np.arange(25)*2/1440 for k in range(4)])
+    transit = stage_3.transit_light_curve(time, 60000.17, 3.0, rp, 10., 88., 0.3, 0.1)
+    orbit_phase = (time - np.repeat(time[::25], 25))/(48/1440)
+    systematics = (1 + 0.001*(time - time[0])/np.ptp(time))*(1 - 0.003*orbit_phase + 0.002*orbit_phase**2)
+    flux = 1e6*transit*systematics*(1 + noise*rng.standard_normal(transit.shape))
+    return xr.Dataset(
+        data_vars=dict(
+            light_curve=(["exp_time", "wavelength_bin"], flux.T),
+            light_curve_err=(["exp_time", "wavelength_bin"], np.full(flux.T.shape, 1e6*noise)),
+        ),
+        coords=dict(exp_time=time, wavelength_bin=np.arange(len(rp), dtype=float)),
+    )
+
+
+class TestStage3(unittest.TestCase):
+    """ Test exotic_uvis stage 3. """
+
+    def test_a_transit_model(self):
+        # Circles that are disjoint, nested, or crossing at a right angle.
+        self.assertEqual(circle_overlap(1., 0.1, 1.2), 0)
+        self.assertAlmostEqual(circle_overlap(1., 0.1, 0.5), np.pi*0.01)
+        self.assertAlmostEqual(circle_overlap(1., 1., np.sqrt(2)), np.pi/2 - 1)
+
+        # Without limb darkening, a planet fully on the disk blocks rp^2 of the light.
+        flux = stage_3.transit_light_curve(np.array([0., 0.01, 0.5]), 0., 3., [0.1, 0.2], 10., 90., 0., 0.)
+        self.assertEqual(flux.shape, (2, 3))
+        self.assertTrue(np.allclose(flux[:, 0], [1 - 0.01, 1 - 0.04], atol=1e-6))
+        self.assertTrue(np.all(flux[:, 2] == 1))
+
+        # Limb darkening deepens the transit at its centre.
+        darkened = stage_3.transit_light_curve(np.array([0.]), 0., 3., 0.1, 10., 90., 0.4, 0.2)
+        self.assertLess(darkened[0, 0], flux[0, 0])
+
+    def test_b_systematics_only(self):
+        rp = np.full(5, 0.1)
+        light_curves = make_light_curves(rp)
+        design, names = stage_3.systematics_design_matrix(light_curves.exp_time.values, jitter=np.ones((100, 2)))
+        self.assertEqual(names, ['constant', 'visit_1', 'orbit_1', 'orbit_2', 'jitter_0', 'jitter_1'])
+        self.assertEqual(design.shape, (100, 6))
+
+        result = stage_3.fit_light_curves(light_curves, 60000.17, 3.0, 10., 88., rp=rp, fit=(), verbose=0)
+        self.assertTrue(np.allclose(result.coefficients.sel(regressor='constant'), 1e6, rtol=1e-4))
+        self.assertLess(np.max(result.chi2)/100, 1.5)
+
+    def test_c_refine_radius(self):
+        rp = 0.1 + 0.005*np.sin(np.arange(20)/3)
+        light_curves = make_light_curves(rp)
+        result = stage_3.fit_light_curves(light_curves, 60000.17, 3.0, 10., 88., rp=0.09, fit=('rp', 't0'), verbose=0)
+        pulls = (result.rp.values - rp)/result.rp_err.values
+        self.assertLess(np.abs(pulls).max(), 4)
+        self.assertTrue(np.allclose(result.t0, 60000.17, atol=3e-4))
+        self.assertTrue(np.allclose(result.model + result.residuals, light_curves.light_curve))
+
+
+if __name__ == '__main__':
+    unittest.main()
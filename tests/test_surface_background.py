@@ -0,0 +1,66 @@
+import io
+import unittest
+import contextlib
+import numpy as np
+
+from exotic_uvis.stage_1 import surface_bckg_subtraction, full_frame_bckg_subtraction
+from exotic_uvis.stage_1.equivalence import synthetic_obs
+
+
+def make_obs(n_frames=12):
+    """ Builds a synthetic visit on top of a smooth background that brightens from frame to frame. """
+    obs = synthetic_obs(n_frames=n_frames, shape=(60, 200), n_cosmic_rays=40)
+    r, c = np.mgrid[:60, :200]
+    gradient = 5 + 0.05*c + 0.1*r + 1e-4*(c - 100)**2
+    scale = 1 + 0.1*np.arange(n_frames)
+    obs.images.values[:] += (gradient*scale[:, None, None]).astype(np.float32)
+    return obs, gradient, scale
+
+
+class TestSurfaceBackground(unittest.TestCase):
+    """ Test the exotic_uvis 2D background surface subtraction. """
+
+    def test_a_polynomial_surface(self):
+        obs, gradient, scale = make_obs()
+        raw = obs.images.values.copy()
+        mask = np.zeros((60, 200), dtype=bool)
+        mask[:20], mask[-20:] = True, True
+        obs, coefficients = surface_bckg_subtraction(obs, degree=2, mask=mask, n_batch=5)
+        self.assertEqual(coefficients.shape, (12, 6))
+
+        # Batched solution matches a least-squares fit of each frame on its own.
+        r, c = np.nonzero(mask)
+        vander = np.polynomial.legendre.legvander2d(*np.meshgrid(np.linspace(-1, 1, 60), np.linspace(-1, 1, 200),
+                                                                 indexing='ij'), (2, 2))[r, c]
+        design = vander[:, [i*3 + j for i in range(3) for j in range(3) if i + j <= 2]]
+        for k in (0, 7, 11):
+            own = np.linalg.lstsq(design, raw[k][r, c].astype(np.float64), rcond=None)[0]
+            self.assertTrue(np.allclose(own, coefficients[k], atol=1e-6))
+
+        # The sky away from the sources is flat after subtraction, and the mean background follows the visit.
+        self.assertLess(abs(np.median(obs.images.values[:, :15, 100:180])), 1.)
+        self.assertTrue(np.allclose(obs.bkg_vals.values, 20 + gradient.mean()*scale, atol=2.))
+
+    def test_b_spline_surface_and_mask(self):
+        obs, gradient, scale = make_obs()
+        obs, coefficients = surface_bckg_subtraction(obs, degree=3, basis='spline', n_knots=2)
+        self.assertEqual(coefficients.shape, (12, 25))
+        self.assertLess(abs(np.median(obs.images.values[:, :15, 100:180])), 1.)
+        with self.assertRaises(ValueError):
+            surface_bckg_subtraction(make_obs()[0], basis='fourier')
+
+    def test_c_full_frame_fine_mode(self):
+        # A Gaussian fit to the histogram finds the sky level more finely than the coarse histogram bins.
+        obs = synthetic_obs(n_frames=4, shape=(60, 200), n_cosmic_rays=40)
+        obs.images.values[:] += np.array([0., 3.3, 7.1, 12.6], dtype=np.float32)[:, None, None]
+        with contextlib.redirect_stdout(io.StringIO()):
+            obs, bckgs = full_frame_bckg_subtraction(obs, bin_number=50, fit='fine')
+        self.assertTrue(np.allclose(np.array(bckgs) - bckgs[0], [0., 3.3, 7.1, 12.6], atol=0.3))
+        self.assertLess(abs(bckgs[0] - 20), 1.)
+        for kwargs in (dict(fit='exact'), dict(value='mean')):
+            with self.assertRaises(ValueError):
+                full_frame_bckg_subtraction(obs, **kwargs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import unittest
+import numpy as np
+import xarray as xr
+import astropy.units as u
+from astropy.time import Time
+from astropy.coordinates import SkyCoord, EarthLocation, GCRS, ITRS, CartesianRepresentation
+
+from exotic_uvis.stage_1 import add_bjd_tdb, mjd_to_bjd_tdb
+from exotic_uvis.stage_1 import time_systems
+
+
+class TestTimeSystems(unittest.TestCase):
+    """ Test the exotic_uvis MJD to BJD_TDB conversion. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cache_dir = 'test_exotic_uvis_time_cache'
+        shutil.rmtree(cls.cache_dir, ignore_errors=True)
+        cls.mjd = 60000.3 + np.linspace(0, 0.3, 50)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cache_dir, ignore_errors=True)
+
+    def test_a_matches_astropy(self):
+        times = Time(self.mjd, format='mjd', scale='utc', location=EarthLocation.from_geocentric(0, 0, 0, unit=u.m))
+        target = SkyCoord(ra=150.*u.deg, dec=30.*u.deg)
+        expected = (times.tdb + times.light_travel_time(target, ephemeris='builtin')).jd
+        bjd_tdb = mjd_to_bjd_tdb(self.mjd, 150., 30.)
+        self.assertLess(np.abs(bjd_tdb - expected).max()*86400, 1e-3)
+
+    def test_b_cache(self):
+        first = mjd_to_bjd_tdb(self.mjd, 20., -5., cache_dir=self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        time_systems._light_travel_cache.clear()
+        self.assertTrue(np.array_equal(mjd_to_bjd_tdb(self.mjd, 20., -5., cache_dir=self.cache_dir), first))
+
+    def test_c_obs_coordinate(self):
+        obs = xr.Dataset(coords=dict(exp_time=self.mjd), attrs=dict(ra_targ=20., dec_targ=-5.))
+        add_bjd_tdb(obs)
+        self.assertEqual(obs.bjd_tdb.dims, ('exp_time',))
+        self.assertTrue(np.all(np.abs(obs.bjd_tdb.values - 2400000.5 - self.mjd)*86400 < 600))
+        self.assertEqual(obs.bjd_tdb.attrs['observer'], 'geocentre')
+
+    def test_d_spacecraft_position(self):
+        # A low Earth orbit of radius 6920 km and period 95 minutes, in the equatorial plane.
+        phase = 2*np.pi*(self.mjd - self.mjd[0])/(95/1440)
+        position = 6920*np.stack([np.cos(phase), np.sin(phase), np.zeros_like(phase)], axis=1)
+
+        # Place astropy's observer at the same positions, converted to the Earth-fixed frame it takes.
+        times = Time(self.mjd, format='mjd', scale='utc')
+        itrs = GCRS(CartesianRepresentation(*position.T*u.km), obstime=times).transform_to(ITRS(obstime=times))
+        located = Time(self.mjd, format='mjd', scale='utc', location=EarthLocation.from_geocentric(*itrs.cartesian.xyz))
+        target = SkyCoord(ra=150.*u.deg, dec=30.*u.deg)
+        expected = (located.tdb + located.light_travel_time(target, ephemeris='builtin')).jd
+
+        bjd_tdb = mjd_to_bjd_tdb(self.mjd, 150., 30., position=position)
+        self.assertLess(np.abs(bjd_tdb - expected).max()*86400, 1e-4)
+        # The orbit moves the times by up to its radius over c.
+        offset = (bjd_tdb - mjd_to_bjd_tdb(self.mjd, 150., 30.))*86400
+        self.assertGreater(np.abs(offset).max(), 0.015)
+        self.assertLess(np.abs(offset).max(), 6920/299792.458)
+
+        obs = xr.Dataset(coords=dict(exp_time=self.mjd), attrs=dict(ra_targ=150., dec_targ=30.))
+        add_bjd_tdb(obs, position=position)
+        self.assertTrue(np.array_equal(obs.bjd_tdb.values, bjd_tdb))
+        self.assertEqual(obs.bjd_tdb.attrs['observer'], 'spacecraft')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import unittest
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xarray as xr
+
+from exotic_uvis.stage_1 import create_zarr_store, write_zarr_frames, open_zarr_obs, load_zarr_obs
+
+STORE = 'test_exotic_uvis_store.zarr'
+
+
+def make_obs(n_frames=8):
+    """ Builds a small obs Dataset with the variables read_data makes. """
+    rng = np.random.default_rng(3)
+    shape = (n_frames, 20, 30)
+    return xr.Dataset(
+        data_vars=dict(
+            images=(["exp_time", "x", "y"], rng.normal(10., 1., shape).astype(np.float32)),
+            errors=(["exp_time", "x", "y"], np.ones(shape, dtype=np.float32)),
+            data_quality=(["exp_time", "x", "y"], np.zeros(shape, dtype=np.int16)),
+            badpix_mask=(["exp_time", "x", "packed_y"], np.full((n_frames, 20, 4), 255, dtype=np.uint8)),
+            direct_image=(["x", "y"], np.ones(shape[1:], dtype=np.float32)),
+        ),
+        coords=dict(exp_time=60000. + np.arange(n_frames)/1440.),
+        attrs=dict(precision='float32', active_region=[0, 20, 0, 30]),
+    )
+
+
+def clean_frames(frames):
+    """ Worker: subtracts a background from some frames and writes them back. """
+    obs = open_zarr_obs(STORE).isel(exp_time=frames).load()
+    obs['bkg_vals'] = ('exp_time', obs.images.values.mean(axis=(1, 2), dtype=np.float64))
+    obs['images'] = obs.images - obs.bkg_vals.astype(np.float32)
+    obs['data_quality'] = obs.data_quality + 1
+    write_zarr_frames(obs, STORE)
+
+
+@unittest.skipUnless(importlib.util.find_spec('zarr'), "zarr is not installed")
+class TestZarrStore(unittest.TestCase):
+    """ Test the exotic_uvis per-frame Zarr store. """
+
+    def tearDown(self):
+        shutil.rmtree(STORE, ignore_errors=True)
+
+    def test_a_round_trip(self):
+        obs = make_obs()
+        create_zarr_store(obs, STORE)
+        stored = open_zarr_obs(STORE)
+        self.assertEqual(stored.attrs['precision'], 'float32')
+        self.assertTrue(np.isnan(stored.bkg_vals.values).all())
+        self.assertEqual(stored.meanstar_disp.shape, (8, 2))
+        loaded = load_zarr_obs(STORE)
+        for name in obs.data_vars:
+            self.assertEqual(loaded[name].dtype, obs[name].dtype)
+            self.assertTrue(np.array_equal(loaded[name].values, obs[name].values), msg=name)
+
+    def test_b_concurrent_writers(self):
+        obs = make_obs()
+        create_zarr_store(obs, STORE)
+        with ProcessPoolExecutor(4) as pool:
+            list(pool.map(clean_frames, [slice(i, i + 2) for i in range(0, 8, 2)]))
+
+        loaded = load_zarr_obs(STORE)
+        bkg_vals = obs.images.values.mean(axis=(1, 2), dtype=np.float64)
+        self.assertTrue(np.array_equal(loaded.bkg_vals.values, bkg_vals))
+        self.assertTrue(np.array_equal(loaded.images.values, obs.images.values - bkg_vals.astype(np.float32)[:, None, None]))
+        self.assertTrue(np.all(loaded.data_quality.values == 1))
+
+    def test_c_frames_must_match(self):
+        obs = make_obs()
+        create_zarr_store(obs, STORE)
+        frames = obs.isel(exp_time=[1, 3])
+        with self.assertRaises(ValueError):
+            write_zarr_frames(frames, STORE)
+
+
+if __name__ == '__main__':
+    unittest.main()